@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    bench_datasource.py [options]
+
+Options:
+  --sizes=<list>        Comma-separated numbers of experiments [default: 100,10000,100000]
+  --repeat=<n>          Timed runs of each benchmark, after the first [default: 5]
+  --trees-dir=<dir>     Where generated trees are kept between runs [default: /tmp/gnomehat_bench]
+  --images=<n>          Sample images per experiment [default: 5]
+  --no-index            Disable the metadata index (METADATA_INDEX = False)
+  --only=<names>        Comma-separated benchmark names to run
+  --json=<file>         Also write the results to this file, for comparing runs
+
+Runs each datasource function and route against synthetic experiment trees (see synthetic_tree.py),
+reporting for each:
+  first: latency of the first call on that tree in this process (cold caches; builds the index)
+  median, max: latency of the following runs
+  syscalls: files opened, directories listed, stat calls and subprocesses run by one call
+            (stat counts os.stat and os.lstat, which os.path.isdir, getmtime etc. use, but not DirEntry.stat)
+  peak: peak Python memory allocated during one call, measured separately with tracemalloc
+"""
+import os
+import sys
+import json
+import time
+import tracemalloc
+import collections
+import docopt
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import synthetic_tree
+from gnomehat import server_config
+from gnomehat.server import app, config
+from gnomehat.server import datasource, stats, webapi
+
+FILES_URL = 'http://localhost/experiments'
+
+syscalls = collections.Counter()
+counting = False
+
+
+# Counts the same audit events as /_stats, in every thread
+def audit_hook(event, args):
+    if counting and event in stats.AUDIT_EVENTS:
+        syscalls[stats.AUDIT_EVENTS[event]] += 1
+
+
+# There is no audit event for stat(), so the counted run swaps in wrappers that count calls
+def counted_stat(fn):
+    def wrapper(*args, **kwargs):
+        syscalls['stat'] += 1
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+def get_tree(trees_dir, size, images):
+    path = os.path.join(trees_dir, 'tree_{}_images_{}'.format(size, images))
+    marker = os.path.join(path, '.complete')
+    if not os.path.exists(marker):
+        print('Generating {} experiments in {}...'.format(size, path))
+        if os.path.exists(path):
+            raise RuntimeError('{} is incomplete, delete it and try again'.format(path))
+        start = time.time()
+        synthetic_tree.generate_tree(path, experiments=size, images=images)
+        open(marker, 'w').close()
+        print('Generated in {:.1f} sec'.format(time.time() - start))
+    return path
+
+
+def get_route(url):
+    client = app.test_client()
+
+    def request():
+        response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError('GET {} returned {}'.format(url, response.status_code))
+        return response.data
+    return request
+
+
+def get_benchmarks(experiments_dir):
+    namespace_dir = os.path.join(experiments_dir, 'default')
+    first_experiment = os.path.join(namespace_dir, 'experiment_00000000')
+
+    def second_page():
+        page = datasource.get_results_page(FILES_URL, 'default')
+        if page['next_cursor']:
+            datasource.get_results_page(FILES_URL, 'default', page['next_cursor'])
+
+    def metrics_table():
+        table = datasource.get_metrics_table('default')
+        return table.query(sort='loss', descending=True, limit=100)
+
+    return collections.OrderedDict([
+        ('get_results', lambda: datasource.get_results(FILES_URL, 'default')),
+        ('get_results_page_2', second_page),
+        ('get_namespaces', lambda: datasource.get_namespaces('http://localhost/')),
+        ('get_images', lambda: list(datasource.get_images(first_experiment))),
+        ('get_all_experiment_metrics', lambda: datasource.get_all_experiment_metrics(experiments_dir, 'default')),
+        ('get_metrics_table', metrics_table),
+        ('get_directory_listing', lambda: datasource.get_directory_listing(namespace_dir)),
+        ('get_directory_page', lambda: datasource.get_directory_page(namespace_dir, 'mtime', True, limit=1000)),
+        ('GET /default', get_route('/default')),
+        ('GET /api/default/results', get_route('/api/default/results?limit=100')),
+        ('GET /metrics/default', get_route('/metrics/default?sort=loss&order=desc')),
+        ('GET /experiments/default', get_route('/experiments/default?sort=mtime&order=desc')),
+    ])
+
+
+def run_benchmark(fn, repeat):
+    global counting
+    with app.test_request_context('/'):
+        start = time.perf_counter()
+        fn()
+        first = time.perf_counter() - start
+
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+
+        syscalls.clear()
+        counting = True
+        real_stat, real_lstat = os.stat, os.lstat
+        os.stat, os.lstat = counted_stat(real_stat), counted_stat(real_lstat)
+        try:
+            fn()
+        finally:
+            os.stat, os.lstat = real_stat, real_lstat
+            counting = False
+        calls = dict(syscalls)
+
+        tracemalloc.start()
+        try:
+            fn()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    times.sort()
+    return {
+        'first_ms': 1000 * first,
+        'median_ms': 1000 * times[len(times) // 2] if times else None,
+        'max_ms': 1000 * times[-1] if times else None,
+        'syscalls': calls,
+        'peak_kb': peak / 1024,
+    }
+
+
+def format_syscalls(calls):
+    return ' '.join('{}={}'.format(k, v) for k, v in sorted(calls.items())) or '-'
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    sys.addaudithook(audit_hook)
+    only = args['--only'].split(',') if args['--only'] else None
+    results = []
+    for size in [int(s) for s in args['--sizes'].split(',')]:
+        experiments_dir = get_tree(args['--trees-dir'], size, int(args['--images']))
+        config.clear()
+        config.update(server_config.get_config(experiments_dir))
+        config['METADATA_INDEX'] = not args['--no-index']
+        config['CHANGE_FEED'] = 'off'
+        config['SLOW_REQUEST_SECONDS'] = float('inf')
+        print('\n{} experiments, metadata index {}'.format(size, 'on' if config['METADATA_INDEX'] else 'off'))
+        print('{:<28} {:>10} {:>10} {:>10} {:>10}  {}'.format(
+            'benchmark', 'first ms', 'median ms', 'max ms', 'peak KB', 'syscalls'))
+        for name, fn in get_benchmarks(experiments_dir).items():
+            if only and name not in only:
+                continue
+            r = run_benchmark(fn, int(args['--repeat']))
+            r.update({'benchmark': name, 'experiments': size, 'index': config['METADATA_INDEX']})
+            results.append(r)
+            print('{:<28} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.0f}  {}'.format(
+                name, r['first_ms'], r['median_ms'] or 0, r['max_ms'] or 0, r['peak_kb'],
+                format_syscalls(r['syscalls'])))
+            sys.stdout.flush()
+    if args['--json']:
+        with open(args['--json'], 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
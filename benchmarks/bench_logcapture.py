@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    bench_logcapture.py [--lines=<n>] [--line-bytes=<n>] [--rotate-bytes=<n>] [--only=<names>]
+
+Options:
+  --lines=<n>           Lines the experiment prints in each run [default: 1000000]
+  --line-bytes=<n>      Length of each line, including its newline [default: 80]
+  --rotate-bytes=<n>    Rotate stdout.txt at this size in the rotating run [default: 16000000]
+  --only=<names>        Comma-separated benchmark names to run
+
+Runs a child process that prints lines as fast as it can, and measures how many lines/sec each way
+of capturing its output into stdout.txt sustains, from starting the child to stdout.txt being closed:
+  legacy: the worker's old loop (text mode readline, strftime, worker_abort check, write and flush per line)
+  capture: gnomehat.logcapture reading binary chunks through a buffered writer
+  capture_rotating: the same, rotating and gzipping stdout.txt every --rotate-bytes
+  write_only: logcapture.LogCapture.write() fed from memory, with no child process (the pipeline's ceiling)
+"""
+import os
+import sys
+import time
+import gzip
+import shutil
+import signal
+import tempfile
+import subprocess
+from datetime import datetime
+import docopt
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from gnomehat import logcapture
+
+# Prints in blocks of lines, so the child is never the bottleneck
+PRINTER = '''
+import sys
+lines, line_bytes = int(sys.argv[1]), int(sys.argv[2])
+block = (b'x' * (line_bytes - 1) + b'\\n') * 1000
+out = sys.stdout.buffer
+for _ in range(lines // 1000):
+    out.write(block)
+out.flush()
+'''
+
+
+def start_printer(lines, line_bytes, **kwargs):
+    cmd = [sys.executable, '-c', PRINTER, str(lines), str(line_bytes)]
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+
+
+# The loop execute_runscript used before gnomehat.logcapture
+def legacy(dirname, lines, line_bytes, rotate_bytes):
+    with open(os.path.join(dirname, 'stdout.txt'), 'a') as log_fp:
+        proc = start_printer(lines, line_bytes, bufsize=1, universal_newlines=True)
+        for line in iter(proc.stdout.readline, ''):
+            if os.path.exists(os.path.join(dirname, 'worker_abort')):
+                os.kill(proc.pid, signal.SIGTERM)
+                raise Exception("Abort experiment")
+            timestamp = datetime.now().strftime('%H:%M:%S')
+            log_fp.write('[{}] {}'.format(timestamp, line))
+            log_fp.flush()
+        proc.wait()
+
+
+def run_capture(dirname, lines, line_bytes, rotate_bytes):
+    abort_filename = os.path.join(dirname, 'worker_abort')
+    log_capture = logcapture.LogCapture(os.path.join(dirname, 'stdout.txt'), rotate_bytes=rotate_bytes)
+    try:
+        proc = start_printer(lines, line_bytes, bufsize=0)
+        logcapture.pump(proc.stdout.fileno(), log_capture, should_abort=lambda: os.path.exists(abort_filename))
+        proc.wait()
+    finally:
+        log_capture.close()
+
+
+def capture(dirname, lines, line_bytes, rotate_bytes):
+    run_capture(dirname, lines, line_bytes, None)
+
+
+def capture_rotating(dirname, lines, line_bytes, rotate_bytes):
+    run_capture(dirname, lines, line_bytes, rotate_bytes)
+
+
+def write_only(dirname, lines, line_bytes, rotate_bytes):
+    chunk = (b'x' * (line_bytes - 1) + b'\n') * (logcapture.READ_BYTES // line_bytes)
+    lines_per_chunk = chunk.count(b'\n')
+    log_capture = logcapture.LogCapture(os.path.join(dirname, 'stdout.txt'), rotate_bytes=None)
+    for _ in range(-(-lines // lines_per_chunk)):
+        log_capture.write(chunk)
+    log_capture.close()
+
+
+BENCHMARKS = [legacy, capture, capture_rotating, write_only]
+
+
+def count_lines(dirname):
+    total = 0
+    for filename in os.listdir(dirname):
+        path = os.path.join(dirname, filename)
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(path, 'rb') as fp:
+            while True:
+                block = fp.read(logcapture.READ_BYTES)
+                if not block:
+                    break
+                total += block.count(b'\n')
+    return total
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    lines = int(args['--lines'])
+    line_bytes = int(args['--line-bytes'])
+    rotate_bytes = int(args['--rotate-bytes'])
+    only = args['--only'].split(',') if args['--only'] else None
+
+    print('{} lines of {} bytes'.format(lines, line_bytes))
+    print('{:<20} {:>10} {:>14} {:>10} {:>10}'.format('benchmark', 'seconds', 'lines/sec', 'MB/sec', 'files'))
+    for benchmark in BENCHMARKS:
+        if only and benchmark.__name__ not in only:
+            continue
+        dirname = tempfile.mkdtemp(prefix='gnomehat_bench_logcapture_')
+        try:
+            start = time.perf_counter()
+            benchmark(dirname, lines, line_bytes, rotate_bytes)
+            seconds = time.perf_counter() - start
+            captured = count_lines(dirname)
+            if captured < lines - lines % 1000:
+                print('Warning: {} captured only {} lines'.format(benchmark.__name__, captured))
+            print('{:<20} {:>10.2f} {:>14,.0f} {:>10.1f} {:>10}'.format(
+                benchmark.__name__, seconds, captured / seconds, captured * line_bytes / seconds / 1e6,
+                len(os.listdir(dirname))))
+        finally:
+            shutil.rmtree(dirname)
+
+
+if __name__ == '__main__':
+    main()
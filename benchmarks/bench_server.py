@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    bench_server.py [--mode=<mode>] [--experiments=<n>] [--seconds=<s>] [--clients=<list>] [--port=<port>]
+
+Options:
+  --mode=<mode>         GNOMEHAT_SERVER_MODE: development, threaded or gunicorn [default: threaded]
+  --experiments=<n>     Number of experiments in the synthetic namespace [default: 500]
+  --seconds=<s>         Duration of each measurement [default: 10]
+  --clients=<list>      Comma-separated numbers of concurrent clients [default: 1,4,16]
+  --port=<port>         Port for the server under test [default: 8099]
+
+Starts gnomehat_server on a temporary experiments directory, then measures requests/sec
+and latency of the front page with each number of concurrent keep-alive clients.
+Half the requests revalidate with If-None-Match, like a browser polling the page.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import docopt
+import requests
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_SCRIPT = os.path.join(REPO_DIR, 'scripts', 'gnomehat_server')
+
+
+def make_experiments(experiments_dir, count):
+    for i in range(count):
+        dir_path = os.path.join(experiments_dir, 'default', 'bench_{:08d}'.format(i))
+        os.makedirs(dir_path)
+        with open(os.path.join(dir_path, 'gnomehat_start.sh'), 'w') as fp:
+            fp.write("#!/bin/bash\nscript -q -c 'python main.py' /dev/null\n")
+        with open(os.path.join(dir_path, 'stdout.txt'), 'w') as fp:
+            fp.write(''.join('[12:00:{:02d}] epoch {}\n'.format(j % 60, j) for j in range(100)))
+        with open(os.path.join(dir_path, '.last_summary.json'), 'w') as fp:
+            fp.write(json.dumps({'loss': 1.0 / (i + 1), 'accuracy': i / count}))
+        open(os.path.join(dir_path, 'worker_finished'), 'w').close()
+
+
+def start_server(experiments_dir, mode, port):
+    with open(os.path.join(experiments_dir, 'gnomehat_config.json'), 'w') as fp:
+        fp.write(json.dumps({'GNOMEHAT_SERVER_MODE': mode, 'GNOMEHAT_PORT': port, 'CHANGE_FEED': 'off'}))
+    log = open(os.path.join(experiments_dir, 'server.txt'), 'w')
+    # Benchmark this checkout, even if another version of gnomehat is installed
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    proc = subprocess.Popen([sys.executable, SERVER_SCRIPT, experiments_dir],
+                            stdout=log, stderr=subprocess.STDOUT, env=env)
+    url = 'http://127.0.0.1:{}/default'.format(port)
+    for _ in range(100):
+        try:
+            requests.get(url, timeout=60)
+            return proc, url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError('Server did not start, see {}/server.txt'.format(experiments_dir))
+
+
+def client(url, deadline, latencies):
+    session = requests.Session()
+    etag = None
+    i = 0
+    while time.time() < deadline:
+        headers = {'If-None-Match': etag} if etag and i % 2 else {}
+        start = time.time()
+        response = session.get(url, headers=headers)
+        latencies.append(time.time() - start)
+        etag = response.headers.get('ETag', etag)
+        i += 1
+
+
+def measure(url, clients, seconds):
+    latencies = []
+    deadline = time.time() + seconds
+    threads = [threading.Thread(target=client, args=(url, deadline, latencies)) for _ in range(clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    latencies.sort()
+    return {
+        'clients': clients,
+        'requests': len(latencies),
+        'requests_per_sec': len(latencies) / elapsed,
+        'p50_ms': 1000 * latencies[len(latencies) // 2],
+        'p99_ms': 1000 * latencies[int(len(latencies) * 0.99)],
+    }
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    experiments_dir = tempfile.mkdtemp()
+    try:
+        make_experiments(experiments_dir, int(args['--experiments']))
+        proc, url = start_server(experiments_dir, args['--mode'], int(args['--port']))
+        try:
+            print('mode={} experiments={}'.format(args['--mode'], args['--experiments']))
+            print('{:>8} {:>10} {:>10} {:>10} {:>10}'.format('clients', 'requests', 'req/s', 'p50 ms', 'p99 ms'))
+            for clients in [int(c) for c in args['--clients'].split(',')]:
+                r = measure(url, clients, float(args['--seconds']))
+                print('{clients:>8} {requests:>10} {requests_per_sec:>10.1f} {p50_ms:>10.1f} {p99_ms:>10.1f}'.format(**r))
+        finally:
+            proc.terminate()
+            proc.wait()
+    finally:
+        shutil.rmtree(experiments_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Usage:
+    synthetic_tree.py <experiments_dir> [options]
+
+Options:
+  --namespaces=<n>      Number of namespaces [default: 1]
+  --experiments=<n>     Experiments per namespace [default: 100]
+  --images=<n>          Sample images per experiment [default: 5]
+  --stdout-lines=<n>    Lines of stdout.txt per experiment [default: 200]
+  --mix=<spec>          Status mix, as status:fraction pairs [default: finished:0.7,failed:0.1,running:0.1,queued:0.1]
+  --days=<n>            Spread experiment start times over this many days [default: 30]
+  --seed=<n>            Random seed, so trees are repeatable [default: 0]
+
+Builds a realistic EXPERIMENTS_DIR tree of finished, failed, running and queued experiments,
+each with a start script, notes, a progress-bar stdout, metrics and sample images.
+"""
+import os
+import json
+import time
+import random
+import base64
+import docopt
+
+# A valid 1x1 PNG, so thumbnails can be generated from the sample images
+PNG_BYTES = base64.b64decode(
+    'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg==')
+STATUS_FILES = {
+    'finished': ['worker_started', 'worker_finished'],
+    'failed': ['worker_started', 'worker_error'],
+    'running': ['worker_started', 'worker_lockfile'],
+    'queued': [],
+}
+DEFAULT_MIX = {'finished': 0.7, 'failed': 0.1, 'running': 0.1, 'queued': 0.1}
+IMAGE_GROUPS = ['samples', 'reconstructions', 'attention']
+
+
+def parse_mix(spec):
+    mix = {}
+    for pair in spec.split(','):
+        status, fraction = pair.split(':')
+        if status not in STATUS_FILES:
+            raise ValueError('Unknown status {}, expected one of {}'.format(status, sorted(STATUS_FILES)))
+        mix[status] = float(fraction)
+    return mix
+
+
+def choose_status(rng, mix):
+    x = rng.random() * sum(mix.values())
+    for status, fraction in sorted(mix.items()):
+        x -= fraction
+        if x < 0:
+            return status
+    return status
+
+
+def write(path, content, mode='w'):
+    with open(path, mode) as fp:
+        fp.write(content)
+
+
+def make_experiment(dir_path, rng, status, images, stdout_lines, timestamp):
+    os.makedirs(dir_path)
+    write(os.path.join(dir_path, 'gnomehat_start.sh'),
+          "#!/bin/bash\nscript -q -c 'python main.py --lr {:.4f}' /dev/null\n".format(rng.random()))
+    write(os.path.join(dir_path, 'gnomehat_notes.txt'), 'lr sweep' if rng.random() < 0.3 else '')
+    epochs = max(stdout_lines, 1)
+    done = epochs if status in ['finished', 'failed'] else rng.randrange(epochs)
+    lines = []
+    for i in range(stdout_lines if status != 'queued' else 0):
+        lines.append('[{}] epoch {} loss {:.4f}\n'.format(
+            time.strftime('%H:%M:%S', time.localtime(timestamp + i)), i, 1.0 / (i + 1)))
+        if i < done:
+            pct = 100 * (i + 1) // epochs
+            lines.append('{:3d}%|{:<10}| {}/{} [00:{:02d}<00:{:02d}, 1.00it/s]\n'.format(
+                pct, '#' * (pct // 10), i + 1, epochs, i % 60, (epochs - i) % 60))
+    write(os.path.join(dir_path, 'stdout.txt'), ''.join(lines))
+    if status != 'queued':
+        write(os.path.join(dir_path, '.last_summary.json'), json.dumps({
+            'loss': rng.random(),
+            'accuracy': rng.random(),
+            'epoch': done,
+        }))
+    for i in range(images):
+        group = IMAGE_GROUPS[i % len(IMAGE_GROUPS)]
+        write(os.path.join(dir_path, '{}_{:06d}.png'.format(group, i)), PNG_BYTES, mode='wb')
+    for filename in STATUS_FILES[status]:
+        write(os.path.join(dir_path, filename), 'OK')
+    os.utime(dir_path, (timestamp, timestamp))
+
+
+def generate_tree(experiments_dir, namespaces=1, experiments=100, images=5, stdout_lines=200,
+                  mix=None, days=30, seed=0):
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    now = time.time()
+    for n in range(namespaces):
+        namespace = 'default' if n == 0 else 'namespace_{}'.format(n)
+        namespace_dir = os.path.join(experiments_dir, namespace)
+        for i in range(experiments):
+            timestamp = now - rng.random() * days * 24 * 3600
+            dir_path = os.path.join(namespace_dir, 'experiment_{:08d}'.format(i))
+            make_experiment(dir_path, rng, choose_status(rng, mix), images, stdout_lines, timestamp)
+    return experiments_dir
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    start = time.time()
+    generate_tree(args['<experiments_dir>'],
+                  namespaces=int(args['--namespaces']),
+                  experiments=int(args['--experiments']),
+                  images=int(args['--images']),
+                  stdout_lines=int(args['--stdout-lines']),
+                  mix=parse_mix(args['--mix']),
+                  days=float(args['--days']),
+                  seed=int(args['--seed']))
+    print('Generated {} in {:.1f} sec'.format(args['<experiments_dir>'], time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,402 @@
+# A feed of changes to the experiments directory, shared by the server, websocket server and workers
+# Uses Linux inotify when possible, and falls back to polling (inotify can't see writes made by other NFS clients)
+#
+# Usage:
+#   feed = ChangeFeed('/path/to/experiments')
+#   feed.subscribe(lambda event: print(event.kind, event.namespace, event.experiment_id))
+#   feed.start()
+import os
+import sys
+import time
+import errno
+import asyncio
+import ctypes
+import select
+import struct
+import threading
+import collections
+
+EXPERIMENT_CREATED = 'experiment_created'
+EXPERIMENT_DELETED = 'experiment_deleted'
+STATUS_CHANGED = 'status_changed'
+IMAGE_WRITTEN = 'image_written'
+STDOUT_APPENDED = 'stdout_appended'
+NOTES_CHANGED = 'notes_changed'
+METRICS_CHANGED = 'metrics_changed'
+# Events were lost (eg. the inotify queue overflowed): subscribers should assume anything changed
+RESCAN = 'rescan'
+
+Event = collections.namedtuple('Event', ['kind', 'namespace', 'experiment_id', 'filename'])
+
+STATUS_FILES = [
+    'gnomehat_start.sh',
+    'gnomehat_hide',
+    'worker_lockfile',
+    'worker_started',
+    'worker_finished',
+    'worker_error',
+    'worker_abort',
+]
+DEFAULT_IMAGE_EXTENSIONS = ['jpg', 'png', 'tiff', 'bmp', 'gif']
+
+# Filesystems where inotify only reports changes made by this machine
+NETWORK_FILESYSTEMS = ['nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'lustre', 'gpfs', 'ceph', 'glusterfs', 'fuse.sshfs']
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+DIRECTORY_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+EXPERIMENT_MASK = DIRECTORY_MASK | IN_MODIFY | IN_CLOSE_WRITE
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def classify(filename, image_extensions=DEFAULT_IMAGE_EXTENSIONS):
+    if filename in STATUS_FILES:
+        return STATUS_CHANGED
+    if filename == 'stdout.txt':
+        return STDOUT_APPENDED
+    if filename == 'gnomehat_notes.txt':
+        return NOTES_CHANGED
+    if filename in ['.last_summary.json', '.last_summary.log']:
+        return METRICS_CHANGED
+    if any(filename.endswith('.' + ext) for ext in image_extensions):
+        return IMAGE_WRITTEN
+    return None
+
+
+def filesystem_type(path):
+    path = os.path.realpath(path)
+    best_mount, best_type = '', None
+    try:
+        with open('/proc/mounts') as fp:
+            for line in fp:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point, fs_type = fields[1], fields[2]
+                if path == mount_point or path.startswith(mount_point.rstrip('/') + '/'):
+                    if len(mount_point) >= len(best_mount):
+                        best_mount, best_type = mount_point, fs_type
+    except OSError:
+        return None
+    return best_type
+
+
+def inotify_supported(path):
+    if not sys.platform.startswith('linux'):
+        return False
+    return filesystem_type(path) not in NETWORK_FILESYSTEMS
+
+
+class ChangeFeed(object):
+    # mode is one of 'auto', 'inotify' or 'poll'
+    def __init__(self, experiments_dir, mode='auto', poll_seconds=2.0, image_extensions=DEFAULT_IMAGE_EXTENSIONS):
+        self.experiments_dir = os.path.abspath(experiments_dir)
+        self.poll_seconds = poll_seconds
+        self.image_extensions = image_extensions
+        if mode == 'auto':
+            mode = 'inotify' if inotify_supported(self.experiments_dir) else 'poll'
+        self.mode = mode
+        # Cleared if inotify fails after it has started, when changes may have gone unreported
+        self.trusted = True
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+
+    @property
+    def polling(self):
+        return self.mode == 'poll'
+
+    def subscribe(self, callback):
+        with self.lock:
+            self.subscribers = self.subscribers + [callback]
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s is not callback]
+
+    def emit(self, kind, namespace=None, experiment_id=None, filename=None):
+        if kind is None:
+            return
+        event = Event(kind, namespace, experiment_id, filename)
+        for callback in self.subscribers:
+            try:
+                callback(event)
+            except Exception as e:
+                print('Error in change feed subscriber {}: {}'.format(callback, e))
+
+    def start(self):
+        self.running = True
+        target = self.run_inotify if self.mode == 'inotify' else self.run_polling
+        self.thread = threading.Thread(target=target, name='gnomehat-changefeed', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    # Polling: compare snapshots of the tree every few seconds
+    # Experiments that have finished only get their directory mtime checked
+    def run_polling(self):
+        snapshot = None
+        while self.running:
+            try:
+                snapshot = self.take_snapshot(snapshot or {}, emit=snapshot is not None)
+            except Exception as e:
+                print('Change feed: error polling {}: {}'.format(self.experiments_dir, e))
+            time.sleep(self.poll_seconds)
+
+    def take_snapshot(self, old, emit=False):
+        new = {}
+        for namespace in list_directories(self.experiments_dir):
+            namespace_dir = os.path.join(self.experiments_dir, namespace)
+            old_experiments = old.get(namespace, {})
+            try:
+                experiment_ids = list_directories(namespace_dir)
+            except OSError:
+                continue
+            experiments = {}
+            for eid in experiment_ids:
+                if emit and eid not in old_experiments:
+                    self.emit(EXPERIMENT_CREATED, namespace, eid)
+                experiments[eid] = self.snapshot_experiment(namespace, eid, old_experiments.get(eid), emit)
+            if emit:
+                for eid in set(old_experiments) - set(experiments):
+                    self.emit(EXPERIMENT_DELETED, namespace, eid)
+            new[namespace] = experiments
+        return new
+
+    def snapshot_experiment(self, namespace, eid, old, emit):
+        dir_path = os.path.join(self.experiments_dir, namespace, eid)
+        try:
+            dir_mtime = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            return old
+        if old is not None and old['settled'] and old['mtime'] == dir_mtime:
+            return old
+        files = {}
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        st = entry.stat()
+                        files[entry.name] = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return old
+        if emit and old is not None:
+            for name, stat in files.items():
+                if old['files'].get(name) != stat:
+                    self.emit(classify(name, self.image_extensions), namespace, eid, name)
+            for name in set(old['files']) - set(files):
+                self.emit(classify(name, self.image_extensions), namespace, eid, name)
+        settled = 'worker_finished' in files or ('worker_error' in files and 'worker_lockfile' not in files)
+        return {'mtime': dir_mtime, 'files': files, 'settled': settled}
+
+    # inotify: one watch on the root, each namespace, and each experiment directory
+    def run_inotify(self):
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            print('Change feed: inotify unavailable, falling back to polling')
+            self.mode = 'poll'
+            return self.run_polling()
+        self.watches = {}
+        try:
+            self.add_watch(libc, fd, self.experiments_dir, None, None)
+            for namespace in list_directories(self.experiments_dir):
+                self.watch_namespace(libc, fd, namespace)
+        except OSError as e:
+            # Usually ENOSPC: fs.inotify.max_user_watches is too low for this many experiments
+            print('Change feed: {}, falling back to polling'.format(e))
+            os.close(fd)
+            self.mode = 'poll'
+            return self.run_polling()
+
+        failed = False
+        try:
+            while self.running:
+                readable, _, _ = select.select([fd], [], [], 1.0)
+                if not readable:
+                    continue
+                try:
+                    buf = os.read(fd, 64 * 1024)
+                except BlockingIOError:
+                    continue
+                self.handle_inotify_events(libc, fd, buf)
+        except Exception as e:
+            # Eg. ENOSPC watching a new experiment: from here on, changes would go unreported
+            print('Change feed: {}, falling back to polling'.format(e))
+            failed = True
+        finally:
+            os.close(fd)
+        if failed:
+            self.mode = 'poll'
+            self.trusted = False
+            self.emit(RESCAN)
+            self.run_polling()
+
+    def add_watch(self, libc, fd, path, namespace, experiment_id):
+        mask = DIRECTORY_MASK if experiment_id is None else EXPERIMENT_MASK
+        wd = libc.inotify_add_watch(fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOENT:
+                return
+            raise OSError(err, 'inotify_add_watch {}: {}'.format(path, os.strerror(err)))
+        self.watches[wd] = (namespace, experiment_id)
+
+    def watch_namespace(self, libc, fd, namespace):
+        namespace_dir = os.path.join(self.experiments_dir, namespace)
+        self.add_watch(libc, fd, namespace_dir, namespace, None)
+        for eid in list_directories(namespace_dir):
+            self.add_watch(libc, fd, os.path.join(namespace_dir, eid), namespace, eid)
+
+    def handle_inotify_events(self, libc, fd, buf):
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buf, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(buf[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                self.emit(RESCAN)
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches:
+                continue
+            namespace, experiment_id = self.watches[wd]
+            created = mask & (IN_CREATE | IN_MOVED_TO)
+            deleted = mask & (IN_DELETE | IN_MOVED_FROM)
+
+            if namespace is None:
+                # A namespace was added to the experiments directory
+                if created and mask & IN_ISDIR:
+                    self.watch_namespace(libc, fd, name)
+            elif experiment_id is None:
+                # An experiment was added to or removed from a namespace
+                if not mask & IN_ISDIR:
+                    continue
+                if created:
+                    self.add_watch(libc, fd, os.path.join(self.experiments_dir, namespace, name), namespace, name)
+                    self.emit(EXPERIMENT_CREATED, namespace, name)
+                elif deleted:
+                    self.emit(EXPERIMENT_DELETED, namespace, name)
+            elif not mask & IN_ISDIR:
+                kind = classify(name, self.image_extensions)
+                # Only report a new image once it has been completely written
+                if kind == IMAGE_WRITTEN and mask & IN_MODIFY:
+                    continue
+                self.emit(kind, namespace, experiment_id, name)
+
+
+# A cached set of the experiments in each namespace, for checking requests without listing directories
+# A change feed keeps it current; without one, a namespace is listed again after ttl_seconds.
+# An experiment that isn't found causes at most one listing every miss_refresh_seconds per namespace,
+# so a newly created experiment is found before the feed reports it.
+# Namespaces that don't exist are never cached, and at most max_namespaces are, least recently used first out.
+# On an event loop, use contains_async(), which lists directories in the default executor.
+class ExperimentSet(object):
+    def __init__(self, experiments_dir, ttl_seconds=5.0, miss_refresh_seconds=1.0, max_namespaces=1024):
+        self.experiments_dir = os.path.abspath(experiments_dir)
+        self.ttl_seconds = ttl_seconds
+        self.miss_refresh_seconds = miss_refresh_seconds
+        self.max_namespaces = max_namespaces
+        self.namespaces = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.feed = None
+
+    def attach(self, feed):
+        feed.subscribe(self.on_change)
+        self.feed = feed
+
+    def on_change(self, event):
+        with self.lock:
+            if event.kind == RESCAN:
+                self.namespaces.clear()
+            elif event.kind in [EXPERIMENT_CREATED, EXPERIMENT_DELETED] and event.namespace in self.namespaces:
+                experiment_ids, loaded_at = self.namespaces[event.namespace]
+                if event.kind == EXPERIMENT_CREATED:
+                    experiment_ids.add(event.experiment_id)
+                else:
+                    experiment_ids.discard(event.experiment_id)
+
+    def load(self, namespace):
+        try:
+            experiment_ids = set(list_directories(os.path.join(self.experiments_dir, namespace)))
+        except OSError:
+            return set()
+        with self.lock:
+            self.namespaces[namespace] = (experiment_ids, time.time())
+            self.namespaces.move_to_end(namespace)
+            while len(self.namespaces) > self.max_namespaces:
+                self.namespaces.popitem(last=False)
+        return experiment_ids
+
+    # Returns whether the experiment is known, or None if the namespace must be listed to find out
+    def cached(self, namespace, experiment_id):
+        with self.lock:
+            experiment_ids, loaded_at = self.namespaces.get(namespace, (None, 0))
+            if experiment_ids is not None:
+                self.namespaces.move_to_end(namespace)
+        age = time.time() - loaded_at
+        trusted = self.feed is not None and self.feed.trusted
+        if experiment_ids is None or (not trusted and age > self.ttl_seconds):
+            return None
+        if experiment_id not in experiment_ids and age > self.miss_refresh_seconds:
+            return None
+        return experiment_id in experiment_ids
+
+    def contains(self, namespace, experiment_id):
+        if not is_valid_name(namespace) or not is_valid_name(experiment_id):
+            return False
+        found = self.cached(namespace, experiment_id)
+        if found is None:
+            found = experiment_id in self.load(namespace)
+        return found
+
+    async def contains_async(self, namespace, experiment_id):
+        if not is_valid_name(namespace) or not is_valid_name(experiment_id):
+            return False
+        found = self.cached(namespace, experiment_id)
+        if found is None:
+            experiment_ids = await asyncio.get_running_loop().run_in_executor(None, self.load, namespace)
+            found = experiment_id in experiment_ids
+        return found
+
+
+def is_valid_name(name):
+    return bool(name) and not name.startswith('.') and '/' not in name
+
+
+def list_directories(path):
+    with os.scandir(path) as entries:
+        return [entry.name for entry in entries if entry.is_dir() and not entry.name.startswith('.')]
+
+
+# Returns a running ChangeFeed configured by a server config dict, or None if disabled
+def start_feed(config):
+    mode = config.get('CHANGE_FEED', 'auto')
+    if not mode or mode == 'off':
+        return None
+    feed = ChangeFeed(config['EXPERIMENTS_DIR'],
+                      mode=mode,
+                      poll_seconds=config.get('CHANGE_FEED_POLL_SECONDS', 2.0),
+                      image_extensions=config.get('IMAGE_EXTENSIONS', DEFAULT_IMAGE_EXTENSIONS))
+    print('Starting {} change feed for {}'.format(feed.mode, feed.experiments_dir))
+    return feed.start()
@@ -13,6 +13,7 @@ STANDARD_COMMANDS = [
     'start',
     'stop',
     'restart',
+    'restart-server',
     'status',
     'demo',
     'logs',
@@ -30,20 +31,26 @@ def print_usage():
     print('\tgnomehat start [experiments_dir]')
     print('\tgnomehat stop')
     print('\tgnomehat restart')
+    print('\tgnomehat restart-server')
     print('\tgnomehat status')
     print('\tgnomehat logs')
     print('\tgnomehat doctor')
-    print('\tgnomehat run [-n namespace] [-m message] <command...>')
+    print('\tgnomehat run [-n namespace] [-m message] [-p priority] [--cpus N] [--memory SIZE] [--gpus N] <command...>')
     print('')
-    print('start: Starts a gnomehat_server daemon and one gnomehat_worker per GPU')
+    print('start: Starts a gnomehat_server daemon and a gnomehat_worker, which runs as many jobs as fit on this machine')
     print('stop: Kills all gnomehat daemons on this machine')
-    print('restart: Alias for gnomehat stop && gnomehat start')
+    print('restart: Alias for gnomehat stop && gnomehat start, but reloads the server gracefully if it can')
+    print('restart-server: Reloads only the web server')
     print('status: Prints all running gnomehat processes')
     print('logs: Tails log files for all gnomehat daemons')
     print('doctor: Checks for common configuration problems')
     print('run: Executes a shell command as a Gnomehat experiment. Requires an active server.')
     print('\t-n namespace: Optional namespace to organize experiments. Defaults to "default"')
     print('\t-m message: Optional comment string to remember why you ran this experiment')
+    print('\t-p priority: Jobs with higher priority run first. Defaults to 0')
+    print('\t--cpus N: CPU cores to reserve for the experiment. Defaults to 1')
+    print('\t--memory SIZE: Memory to reserve, eg. 8G. Defaults to none')
+    print('\t--gpus N: GPUs to reserve, or a fraction of one GPU. Defaults to 1 on machines with GPUs')
     print('Note: "gnomehat python" is an alias to "gnomehat run python"')
     print('')
 
@@ -8,8 +8,9 @@ import shutil
 import requests
 import argparse
 import json
+import sqlite3
 
-from gnomehat import server_config
+from gnomehat import server_config, jobqueue, scheduler
 from gnomehat.console.wizard import load_cli_config
 from gnomehat.file_input import read_directory_name
 
@@ -17,12 +18,23 @@ USAGE = '''
 gnomehat_run: Run a shell command as a Gnomehat experiment
 
 Usage:
-    gnomehat_run [-m "message"] [-n namespace] <command ...>
+    gnomehat_run [-m "message"] [-n namespace] [-p priority] [--cpus N] [--memory SIZE] [--gpus N] <command ...>
+
+Scheduling:
+    -p, --priority N   Jobs with higher priority run first (default 0, may be negative)
+                       Jobs of equal priority are shared fairly between namespaces
+
+Resources (by default, one core and one GPU if the worker's machine has any):
+    --cpus N        CPU cores to reserve; the experiment is pinned to them
+    --memory SIZE   Memory to reserve, eg. 512M or 8G
+    --gpus N        GPUs to reserve: a whole number, or a fraction like 0.5 to share one GPU
 
 Examples:
     gnomehat python main.py
     gnomehat python my_experiment_with_args.py --arg1 foo --arg2 bar
     gnomehat -m "Add frob layers" python main.py --frob=True
+    gnomehat --cpus 4 --memory 8G --gpus 0 python preprocess.py
+    gnomehat -p 10 python urgent_fix.py
 '''
 
 verbose = False
@@ -123,6 +135,8 @@ def parse_args(argv):
         'ignore-git': False,
         'delete-when-finished': False,
         'hide-from-ui': False,
+        'resources': None,
+        'priority': 0,
     }
     i = 0
     while True:
@@ -141,6 +155,13 @@ def parse_args(argv):
         elif argv[i] in ['--hide-from-ui']:
             options['hide-from-ui'] = True
             i += 1
+        elif argv[i] in ['-p', '--priority']:
+            options['priority'] = parse_priority(argv[i+1])
+            i += 2
+        elif argv[i] in ['--cpus', '--memory', '--gpus']:
+            options['resources'] = options['resources'] or {}
+            options['resources'].update(parse_resource(argv[i], argv[i+1]))
+            i += 2
         elif argv[i] in ['--delete-when-finished']:
             options['delete-when-finished'] = True
             i += 1
@@ -162,6 +183,29 @@ def parse_args(argv):
     return options
 
 
+def parse_resource(flag, value):
+    try:
+        if flag == '--cpus':
+            request = {'cpus': int(value)}
+        elif flag == '--memory':
+            request = {'memory_mb': scheduler.parse_memory(value)}
+        else:
+            request = {'gpus': float(value)}
+        scheduler.normalize_request(request)
+    except ValueError as e:
+        print('Error: invalid {} {}: {}'.format(flag, value, e))
+        exit(1)
+    return request
+
+
+def parse_priority(value):
+    try:
+        return int(value)
+    except ValueError:
+        print('Error: invalid priority {}, expected a whole number'.format(value))
+        exit(1)
+
+
 def get_default_namespace():
     return load_cli_config().get('NAMESPACE', 'default')
 
@@ -203,6 +247,21 @@ def gnomehat_run(options):
     if options['hide-from-ui']:
         open('gnomehat_hide', 'w').close()
 
+    resources = None
+    if options['resources']:
+        resources = scheduler.normalize_request(options['resources'])
+        scheduler.write_resources(target_dir, resources)
+
+    if options['priority']:
+        jobqueue.write_priority(target_dir, options['priority'])
+
+    # Hand the experiment to the workers, who would otherwise only find it on their next directory scan
+    try:
+        jobqueue.enqueue(experiments_dir, options['namespace'], experiment_name,
+                         resources=resources, priority=options['priority'])
+    except sqlite3.Error as e:
+        print('Warning: could not add experiment to the job queue ({}), it will start within a minute'.format(e))
+
     # TODO: Interactive Mode
     # Display a tmux-style info bar: "Press ctrl+T to run in background"
     # Open a connection to the worker and stream stdout/stderr
@@ -0,0 +1,445 @@
+# A durable queue of experiments waiting for a worker, stored as SQLite in EXPERIMENTS_DIR
+# `gnomehat run` enqueues each new experiment, and workers claim the oldest one in a single transaction,
+# instead of every worker listing every experiment directory every few seconds.
+#
+# Enqueueing wakes the workers on this machine at once through their FIFOs in .gnomehat_queue_wakeup/.
+# Workers on other machines (or without a FIFO) notice new jobs at their next poll, which is one query.
+# The queue is only a hint: a worker still takes the experiment's worker_lockfile before running it,
+# and rescans the directories now and then to enqueue anything the queue missed.
+#
+# Jobs are taken in order of priority (higher first, set with `gnomehat run --priority`), and then by fair share:
+# among jobs of equal priority, the next one comes from the namespace that has used the fewest GPU-hours lately,
+# so one namespace's sweep of 500 jobs doesn't keep everyone else waiting. Within a namespace, oldest first.
+# Usage decays with a half-life of FAIR_SHARE_HALF_LIFE_HOURS, and counts every CPUS_PER_GPU cores as a GPU.
+#
+# Usage:
+#   jobqueue.enqueue(experiments_dir, 'default', 'my_experiment_00000001')
+#   job = jobqueue.claim(experiments_dir, jobqueue.worker_name())    # ('default', 'my_experiment_00000001') or None
+#   jobqueue.mark_running(experiments_dir, *job, gpus=1, cpus=4)
+#   jobqueue.finish(experiments_dir, *job)
+import os
+import json
+import time
+import fcntl
+import heapq
+import errno
+import sqlite3
+import statistics
+import threading
+import collections
+from socket import gethostname
+
+QUEUE_FILENAME = '.gnomehat_queue.sqlite'
+WAKEUP_DIRNAME = '.gnomehat_queue_wakeup'
+# A claimed job that never got its worker_lockfile is given to another worker after this long
+CLAIM_TIMEOUT_SECONDS = 120
+# A FIFO nobody has opened for reading is only removed once it is this old, in case its worker is starting
+STALE_FIFO_SECONDS = 60
+QUEUED = 'queued'
+CLAIMED = 'claimed'
+DONE = 'done'
+# claim() looks this far down each namespace's queue for a job that fits in a worker's free slots
+MAX_CLAIM_SCAN = 1000
+PRIORITY_FILENAME = 'gnomehat_priority.txt'
+FAIR_SHARE_HALF_LIFE_HOURS = 24
+# Finished jobs older than this no longer count towards fair share, and are forgotten
+FAIR_SHARE_HORIZON_HOURS = 7 * 24
+CPUS_PER_GPU = 8
+# How long a job is guessed to take in a namespace that hasn't finished any recently
+DEFAULT_JOB_HOURS = 1.0
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    namespace TEXT NOT NULL,
+    experiment_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    enqueued_at REAL NOT NULL,
+    claimed_by TEXT,
+    claimed_at REAL,
+    finished_at REAL,
+    resources TEXT,
+    priority INTEGER NOT NULL DEFAULT 0,
+    charge REAL,
+    PRIMARY KEY (namespace, experiment_id)
+);
+'''
+# Created after migrate(), since they use columns older queues lack
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, enqueued_at);
+CREATE INDEX IF NOT EXISTS jobs_by_namespace ON jobs (state, namespace, priority, enqueued_at);
+'''
+# Columns added since the first version of the queue, with their definitions
+# charge: GPUs (or GPU-equivalents of cores) a running or finished job held, for fair share
+ADDED_COLUMNS = [
+    ('resources', 'TEXT'),
+    ('priority', 'INTEGER NOT NULL DEFAULT 0'),
+    ('charge', 'REAL'),
+]
+
+# A queued job, as returned by queued_jobs()
+QueuedJob = collections.namedtuple('QueuedJob', ['namespace', 'experiment_id', 'priority', 'enqueued_at', 'resources'])
+
+_local = threading.local()
+
+
+def worker_name():
+    return '{}_{}'.format(gethostname(), os.getpid())
+
+
+def queue_path(experiments_dir):
+    return os.path.join(experiments_dir, QUEUE_FILENAME)
+
+
+# SQLite connections can't be shared between threads, so keep one per thread
+def connect(experiments_dir):
+    path = queue_path(experiments_dir)
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.path == path:
+        return conn
+    # Transactions are managed by hand, so claims can take the write lock before reading
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.executescript(SCHEMA)
+    migrate(conn)
+    conn.executescript(INDEXES)
+    _local.conn = conn
+    _local.path = path
+    return conn
+
+
+# Queues made by older versions get new columns added in place
+def migrate(conn):
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(jobs)')]
+    for name, definition in ADDED_COLUMNS:
+        if name not in columns:
+            conn.execute('ALTER TABLE jobs ADD COLUMN {} {}'.format(name, definition))
+
+
+def dump_resources(resources):
+    return json.dumps(resources) if resources is not None else None
+
+
+# Returns the resource request stored with a job, or None if it was queued without one
+def load_resources(text):
+    return json.loads(text) if text else None
+
+
+# The priority is kept in the experiment directory too, so it survives the queue being rebuilt
+def read_priority(dirname):
+    try:
+        with open(os.path.join(dirname, PRIORITY_FILENAME)) as fp:
+            return int(fp.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def write_priority(dirname, priority):
+    with open(os.path.join(dirname, PRIORITY_FILENAME), 'w') as fp:
+        fp.write('{}\n'.format(int(priority)))
+
+
+def enqueue(experiments_dir, namespace, experiment_id, enqueued_at=None, wake=True, resources=None, priority=0):
+    conn = connect(experiments_dir)
+    conn.execute('INSERT OR REPLACE INTO jobs (namespace, experiment_id, state, enqueued_at, resources, priority) '
+                 'VALUES (?, ?, ?, ?, ?, ?)',
+                 (namespace, experiment_id, QUEUED, enqueued_at or time.time(), dump_resources(resources), priority))
+    if wake:
+        wake_workers(experiments_dir)
+
+
+# Changes the priority of a job; returns False if it isn't waiting in the queue
+def set_priority(experiments_dir, namespace, experiment_id, priority):
+    cursor = connect(experiments_dir).execute(
+        'UPDATE jobs SET priority=? WHERE namespace=? AND experiment_id=? AND state=?',
+        (int(priority), namespace, experiment_id, QUEUED))
+    return cursor.rowcount > 0
+
+
+# Atomically takes the next queued job, returning (namespace, experiment_id), or None if there are none
+# If fits is given, it is called with each job's resource request (or None), in queue order,
+# and the first job it accepts is taken, so a big job at the front doesn't keep small ones off free slots.
+def claim(experiments_dir, name, fits=None):
+    conn = connect(experiments_dir)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        limit = 1 if fits is None else MAX_CLAIM_SCAN
+        row = None
+        for job in queue_order(conn, time.time(), limit):
+            if fits is None or fits(load_resources(job.resources)):
+                row = (job.namespace, job.experiment_id)
+                break
+        if row is not None:
+            conn.execute('UPDATE jobs SET state=?, claimed_by=?, claimed_at=? WHERE namespace=? AND experiment_id=?',
+                         (CLAIMED, name, time.time(), row[0], row[1]))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return row
+
+
+# Records that a claimed job has started, and what it holds, for fair share
+def mark_running(experiments_dir, namespace, experiment_id, gpus=0, cpus=0):
+    connect(experiments_dir).execute(
+        'UPDATE jobs SET claimed_at=?, charge=? WHERE namespace=? AND experiment_id=?',
+        (time.time(), job_charge(gpus, cpus), namespace, experiment_id))
+
+
+def finish(experiments_dir, namespace, experiment_id):
+    connect(experiments_dir).execute(
+        'UPDATE jobs SET state=?, finished_at=? WHERE namespace=? AND experiment_id=?',
+        (DONE, time.time(), namespace, experiment_id))
+
+
+# Puts a claimed job back, eg. if it turned out not to fit in the worker's free slots
+# If resources is given, it replaces the job's stored resource request.
+def release(experiments_dir, namespace, experiment_id, resources=None):
+    conn = connect(experiments_dir)
+    conn.execute(
+        'UPDATE jobs SET state=?, claimed_by=NULL, claimed_at=NULL WHERE namespace=? AND experiment_id=? AND state=?',
+        (QUEUED, namespace, experiment_id, CLAIMED))
+    if resources is not None:
+        conn.execute('UPDATE jobs SET resources=? WHERE namespace=? AND experiment_id=?',
+                     (dump_resources(resources), namespace, experiment_id))
+
+
+# Brings the queue up to date with a scan of the experiment directories
+# runnable is a list of (namespace, experiment_id, dir mtime, resource request or None, priority)
+# for experiments that have not been started.
+# Anything runnable but missing or finished in the queue is (re)queued, and so are claims that timed out.
+# Returns the number of jobs that were requeued.
+def recover(experiments_dir, runnable):
+    conn = connect(experiments_dir)
+    now = time.time()
+    count = 0
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for namespace, experiment_id, dir_mtime, resources, priority in runnable:
+            row = conn.execute('SELECT state, claimed_at FROM jobs WHERE namespace=? AND experiment_id=?',
+                               (namespace, experiment_id)).fetchone()
+            if row is None or row[0] == DONE or (row[0] == CLAIMED and now - row[1] > CLAIM_TIMEOUT_SECONDS):
+                conn.execute('INSERT OR REPLACE INTO jobs '
+                             '(namespace, experiment_id, state, enqueued_at, resources, priority) VALUES (?, ?, ?, ?, ?, ?)',
+                             (namespace, experiment_id, QUEUED, dir_mtime, dump_resources(resources), priority))
+                count += 1
+        conn.execute('DELETE FROM jobs WHERE state=? AND finished_at < ?',
+                     (DONE, now - FAIR_SHARE_HORIZON_HOURS * 3600))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return count
+
+
+# Finishes claims whose worker has gone, eg. killed by `gnomehat stop`, so they stop counting as running
+# The job is charged until its last output to stdout.txt. Returns [(namespace, experiment_id)] reaped.
+def reap(experiments_dir):
+    conn = connect(experiments_dir)
+    now = time.time()
+    claims = conn.execute('SELECT namespace, experiment_id, claimed_by, claimed_at FROM jobs '
+                          'WHERE state=? AND claimed_at < ?', (CLAIMED, now - CLAIM_TIMEOUT_SECONDS)).fetchall()
+    reaped = []
+    for namespace, experiment_id, claimed_by, claimed_at in claims:
+        dirname = os.path.join(experiments_dir, namespace, experiment_id)
+        if not worker_gone(dirname, claimed_by):
+            continue
+        try:
+            last_output = os.path.getmtime(os.path.join(dirname, 'stdout.txt'))
+        except OSError:
+            last_output = claimed_at
+        cursor = conn.execute(
+            'UPDATE jobs SET state=?, finished_at=? WHERE namespace=? AND experiment_id=? AND state=? AND claimed_at=?',
+            (DONE, min(now, max(claimed_at, last_output)), namespace, experiment_id, CLAIMED, claimed_at))
+        if cursor.rowcount:
+            reaped.append((namespace, experiment_id))
+    return reaped
+
+
+# Workers are named hostname_pid: one on this machine is gone if its process is
+# Elsewhere, a running job holds a lock on its worker_lockfile, which is released when its worker dies.
+def worker_gone(dirname, claimed_by):
+    host, _, pid = (claimed_by or '').rpartition('_')
+    if host == gethostname() and pid.isdigit():
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+    try:
+        fp = open(os.path.join(dirname, 'worker_lockfile'))
+    except FileNotFoundError:
+        return True
+    with fp:
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        fcntl.flock(fp, fcntl.LOCK_UN)
+        return True
+
+
+def count_jobs(experiments_dir, state=QUEUED):
+    return connect(experiments_dir).execute('SELECT COUNT(*) FROM jobs WHERE state=?', (state,)).fetchone()[0]
+
+
+# GPU-equivalents held by a job
+def job_charge(gpus, cpus):
+    return float(gpus or 0) + float(cpus or 0) / CPUS_PER_GPU
+
+
+# GPU-equivalents a queued job is expected to hold, from its resource request
+# A request for the default GPU is counted as one GPU, though it gets none on a machine without GPUs.
+def request_charge(resources):
+    resources = resources or {}
+    gpus = resources.get('gpus')
+    return job_charge(1 if gpus is None else gpus, resources.get('cpus', 1))
+
+
+# Returns ({namespace: decayed GPU-hours}, {namespace: median hours of recent jobs}) from jobs run lately
+# Running jobs count as if they finished now. Only time within FAIR_SHARE_HORIZON_HOURS is charged.
+def job_history(conn, now):
+    usage = collections.defaultdict(float)
+    durations = collections.defaultdict(list)
+    horizon = now - FAIR_SHARE_HORIZON_HOURS * 3600
+    rows = conn.execute('SELECT namespace, state, claimed_at, finished_at, charge FROM jobs '
+                        'WHERE charge IS NOT NULL AND (state=? OR (state=? AND finished_at >= ?))',
+                        (CLAIMED, DONE, horizon))
+    for namespace, state, claimed_at, finished_at, charge in rows:
+        end = now if state == CLAIMED else finished_at
+        hours = max(0, end - max(claimed_at, horizon)) / 3600
+        age_hours = (now - end) / 3600
+        usage[namespace] += charge * hours * 0.5 ** (age_hours / FAIR_SHARE_HALF_LIFE_HOURS)
+        if state == DONE:
+            durations[namespace].append(max(0, finished_at - claimed_at) / 3600)
+    return dict(usage), {namespace: statistics.median(hours) for namespace, hours in durations.items()}
+
+
+# Returns the first limit queued jobs of each namespace, highest priority and then oldest first
+def queued_jobs(conn, limit):
+    namespaces = [row[0] for row in conn.execute('SELECT DISTINCT namespace FROM jobs WHERE state=?', (QUEUED,))]
+    jobs = {}
+    for namespace in namespaces:
+        rows = conn.execute('SELECT namespace, experiment_id, priority, enqueued_at, resources FROM jobs '
+                            'WHERE state=? AND namespace=? ORDER BY priority DESC, enqueued_at LIMIT ?',
+                            (QUEUED, namespace, limit))
+        jobs[namespace] = collections.deque(QueuedJob(*row) for row in rows)
+    return jobs
+
+
+# Yields queued jobs in the order they should run
+# Each job handed out is charged to its namespace for its expected GPU-hours, so namespaces take turns.
+def queue_order(conn, now, limit=MAX_CLAIM_SCAN):
+    usage, durations = job_history(conn, now)
+    jobs = queued_jobs(conn, limit)
+    while jobs:
+        namespace = min(jobs, key=lambda ns: (-jobs[ns][0].priority, usage.get(ns, 0), jobs[ns][0].enqueued_at))
+        job = jobs[namespace].popleft()
+        if not jobs[namespace]:
+            del jobs[namespace]
+        hours = durations.get(namespace, DEFAULT_JOB_HOURS)
+        usage[namespace] = usage.get(namespace, 0) + request_charge(load_resources(job.resources)) * hours
+        yield job
+
+
+# Returns the queue as the workers will take it: a list of dicts with each job's position, and a rough
+# estimate of when it will start, assuming each job takes one of the slots running jobs use now,
+# and runs as long as its namespace's recent jobs took.
+def queue_estimates(experiments_dir, limit=MAX_CLAIM_SCAN):
+    conn = connect(experiments_dir)
+    now = time.time()
+    usage, durations = job_history(conn, now)
+    running = conn.execute('SELECT namespace, claimed_at FROM jobs WHERE state=?', (CLAIMED,)).fetchall()
+    slots = [max(now, claimed_at + durations.get(namespace, DEFAULT_JOB_HOURS) * 3600)
+             for namespace, claimed_at in running] or [now]
+    heapq.heapify(slots)
+    estimates = []
+    for position, job in enumerate(queue_order(conn, now, limit)):
+        if position >= limit:
+            break
+        start = heapq.heappop(slots)
+        heapq.heappush(slots, start + durations.get(job.namespace, DEFAULT_JOB_HOURS) * 3600)
+        estimates.append({
+            'position': position + 1,
+            'namespace': job.namespace,
+            'experiment_id': job.experiment_id,
+            'priority': job.priority,
+            'resources': load_resources(job.resources),
+            'enqueued_at': job.enqueued_at,
+            'estimated_start': start,
+        })
+    return estimates
+
+
+# Returns {namespace: decayed GPU-hours used recently}
+def namespace_usage(experiments_dir):
+    return job_history(connect(experiments_dir), time.time())[0]
+
+
+def wakeup_dir(experiments_dir):
+    return os.path.join(experiments_dir, WAKEUP_DIRNAME)
+
+
+# Creates a FIFO for this worker, and returns (its path, a file descriptor that becomes readable on wakeup)
+# A writer end is held open too, so the reader doesn't see end-of-file whenever a waker closes its end.
+def open_wakeup_fifo(experiments_dir, name):
+    os.makedirs(wakeup_dir(experiments_dir), exist_ok=True)
+    path = os.path.join(wakeup_dir(experiments_dir), '{}.fifo'.format(name))
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    os.mkfifo(path)
+    fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+    return path, fd
+
+
+def drain_wakeups(fd):
+    try:
+        while os.read(fd, 4096):
+            pass
+    except BlockingIOError:
+        pass
+
+
+# Writes a byte to every worker FIFO; FIFOs with no reader belong to workers that have exited
+def wake_workers(experiments_dir):
+    try:
+        filenames = os.listdir(wakeup_dir(experiments_dir))
+    except FileNotFoundError:
+        return 0
+    woken = 0
+    for filename in filenames:
+        path = os.path.join(wakeup_dir(experiments_dir), filename)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            # A FIFO from another machine can't be opened here; only remove our own dead ones
+            if e.errno == errno.ENXIO and filename.startswith(gethostname() + '_'):
+                remove_stale_fifo(path)
+            continue
+        try:
+            os.write(fd, b'!')
+            woken += 1
+        except BlockingIOError:
+            # Its buffer is full of wakeups it hasn't read yet: it will wake up anyway
+            woken += 1
+        finally:
+            os.close(fd)
+    return woken
+
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def remove_stale_fifo(path):
+    try:
+        if time.time() - os.stat(path).st_mtime > STALE_FIFO_SECONDS:
+            os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,183 @@
+# Capture a running experiment's output into stdout.txt, fast enough to keep up with very chatty scripts
+# Output is read from the pipe in large binary chunks, and every line is stamped with the time it arrived.
+# The timestamp is only formatted once per second, and stamping a whole chunk is a few bytes.replace() calls.
+# Writes are buffered and flushed every FLUSH_SECONDS, rather than once per line.
+#
+# Once stdout.txt grows past ROTATE_BYTES it is moved aside and gzipped in the background,
+# as stdout.txt.1.gz, stdout.txt.2.gz, ... and a new stdout.txt is started. Followers of stdout.txt
+# (see logstream.py) see the file replaced, and start again from the top of the new one.
+# Rotation waits for the end of a line, unless the file reaches HARD_ROTATE_FACTOR times ROTATE_BYTES,
+# so a job that never prints a newline can't grow it without limit.
+#
+# Usage:
+#   capture = LogCapture('/path/to/experiment/stdout.txt')
+#   capture.note('starting at {}'.format(timestamp()))
+#   finished = pump(proc.stdout.fileno(), capture, should_abort=lambda: os.path.exists(abort_filename))
+#   capture.close()
+import os
+import re
+import time
+import gzip
+import select
+import shutil
+import threading
+
+READ_BYTES = 1024 * 1024
+BUFFER_BYTES = 256 * 1024
+FLUSH_SECONDS = 0.25
+ABORT_CHECK_SECONDS = 1.0
+ROTATE_BYTES = 512 * 1024 * 1024
+HARD_ROTATE_FACTOR = 2
+LINE_TIMESTAMP_FORMAT = '%H:%M:%S'
+# The same format as date(1), which the worker used to run for this
+NOTE_TIMESTAMP_FORMAT = '%a %b %d %H:%M:%S %Z %Y'
+
+
+def timestamp():
+    return time.strftime(NOTE_TIMESTAMP_FORMAT)
+
+
+# Formats the line prefix at most once per second, however many lines arrive
+class CachedClock(object):
+    def __init__(self, fmt=LINE_TIMESTAMP_FORMAT):
+        self.fmt = fmt
+        self.second = None
+        self.cached = b''
+
+    def prefix(self):
+        second = int(time.time())
+        if second != self.second:
+            self.second = second
+            self.cached = '[{}] '.format(time.strftime(self.fmt, time.localtime(second))).encode()
+        return self.cached
+
+
+class LogCapture(object):
+    def __init__(self, path, rotate_bytes=ROTATE_BYTES, flush_seconds=FLUSH_SECONDS, buffer_bytes=BUFFER_BYTES):
+        self.path = path
+        self.rotate_bytes = rotate_bytes
+        self.flush_seconds = flush_seconds
+        self.buffer_bytes = buffer_bytes
+        self.clock = CachedClock()
+        self.fp = open(path, 'ab', buffering=buffer_bytes)
+        self.size = self.fp.tell()
+        self.at_line_start = self.size == 0 or last_byte(path) == b'\n'
+        # A carriage return at the end of a chunk may be the first half of a \r\n
+        self.pending_cr = False
+        self.last_flush = time.monotonic()
+        self.compressing = []
+
+    # Writes a chunk of output, stamping the start of every line in it
+    # Line endings are normalized as in text mode: \r\n and lone \r both end a line.
+    def write(self, data):
+        if self.pending_cr:
+            data = b'\r' + data
+            self.pending_cr = False
+        if data.endswith(b'\r'):
+            data = data[:-1]
+            self.pending_cr = True
+        if not data:
+            return
+        if b'\r' in data:
+            data = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+        prefix = self.clock.prefix()
+        stamped = data.replace(b'\n', b'\n' + prefix)
+        if data.endswith(b'\n'):
+            stamped = stamped[:-len(prefix)]
+        if self.at_line_start:
+            stamped = prefix + stamped
+        self.at_line_start = data.endswith(b'\n')
+        self.fp.write(stamped)
+        self.size += len(stamped)
+        if self.rotate_bytes and self.size >= self.rotate_bytes:
+            if self.at_line_start or self.size >= HARD_ROTATE_FACTOR * self.rotate_bytes:
+                self.rotate()
+
+    # Writes a line from the worker itself, like [Worker finished experiment at ...]
+    def note(self, text):
+        self.end_pending_line()
+        if not self.at_line_start:
+            self.fp.write(b'\n')
+            self.size += 1
+        line = '[{}]\n'.format(text).encode()
+        self.fp.write(line)
+        self.size += len(line)
+        self.at_line_start = True
+
+    def flush(self):
+        self.fp.flush()
+        self.last_flush = time.monotonic()
+
+    def maybe_flush(self, now=None):
+        now = time.monotonic() if now is None else now
+        if now - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    # Moves the current file aside to be compressed, and starts a new one
+    def rotate(self):
+        self.fp.close()
+        segment = '{}.{}'.format(self.path, next_segment_number(self.path))
+        os.rename(self.path, segment)
+        self.fp = open(self.path, 'ab', buffering=self.buffer_bytes)
+        self.size = 0
+        self.last_flush = time.monotonic()
+        thread = threading.Thread(target=compress_segment, args=(segment,))
+        thread.start()
+        self.compressing.append(thread)
+
+    # A held back \r that turned out not to be part of a \r\n still ends its line
+    def end_pending_line(self):
+        if self.pending_cr:
+            self.pending_cr = False
+            self.write(b'\n')
+
+    # Flushes everything, and waits for any segments still being compressed
+    def close(self):
+        self.end_pending_line()
+        self.fp.close()
+        for thread in self.compressing:
+            thread.join()
+        self.compressing = []
+
+
+def last_byte(path):
+    with open(path, 'rb') as fp:
+        fp.seek(-1, os.SEEK_END)
+        return fp.read(1)
+
+
+# Segments are numbered in order, oldest first, so the next one is one more than any that exist
+def next_segment_number(path):
+    dirname, basename = os.path.split(path)
+    pattern = re.compile(r'^{}\.(\d+)(\.gz)?$'.format(re.escape(basename)))
+    numbers = [int(match.group(1)) for match in map(pattern.match, os.listdir(dirname or '.')) if match]
+    return max(numbers, default=0) + 1
+
+
+# The .gz appears only once it is complete, and then the uncompressed segment is removed
+def compress_segment(segment):
+    with open(segment, 'rb') as src, gzip.open(segment + '.gz.tmp', 'wb', compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, READ_BYTES)
+    os.rename(segment + '.gz.tmp', segment + '.gz')
+    os.remove(segment)
+
+
+# Copies everything from fd into capture until end of file, flushing at least every capture.flush_seconds
+# should_abort is checked every abort_check_seconds; returns False if it asked to stop, True at end of file.
+def pump(fd, capture, should_abort=None, abort_check_seconds=ABORT_CHECK_SECONDS):
+    last_check = time.monotonic()
+    while True:
+        readable, _, _ = select.select([fd], [], [], capture.flush_seconds)
+        if readable:
+            data = os.read(fd, READ_BYTES)
+            if not data:
+                capture.flush()
+                return True
+            capture.write(data)
+        now = time.monotonic()
+        capture.maybe_flush(now)
+        if should_abort is not None and now - last_check >= abort_check_seconds:
+            last_check = now
+            if should_abort():
+                capture.flush()
+                return False
@@ -0,0 +1,365 @@
+# Follow growing log files from asyncio, with one follower per file shared by every client watching it
+# Each Follower reads only the bytes appended since its last read, and broadcasts them to its subscribers.
+# Followers are reference counted: the first subscriber starts one, and the last to leave stops it.
+# A follower keeps the last RING_LINES lines in memory, so new subscribers get their backlog without touching disk.
+#
+# Each Subscriber buffers at most HIGH_WATER_BYTES: a client that falls further behind loses the oldest
+# output, and is told how much it missed. Output is handed out in frames of many lines, so a script
+# printing thousands of lines per second costs a few messages per second, not thousands.
+#
+# Every frame carries the byte offset of its data in the file, and the file's id (its inode), so a client
+# that reconnects can ask for exactly the bytes it missed, or page backwards through earlier output.
+#
+# Usage:
+#   subscriber, backlog = await subscribe('/path/to/stdout.txt', tail_lines=200)
+#   try:
+#       while True:
+#           frame = await subscriber.get_frame()    # None when the follower stops
+#   finally:
+#       unsubscribe('/path/to/stdout.txt', subscriber)
+import os
+import asyncio
+import itertools
+import collections
+
+from gnomehat import changefeed, logtail
+
+# With a change feed, followers are woken as soon as the file changes, and this is only a fallback
+POLL_SECONDS = 0.5
+MAX_READ_BYTES = 1024 * 1024
+RING_LINES = 1000
+# Lines arriving within FRAME_SECONDS of each other are sent together, up to FRAME_BYTES per frame
+FRAME_SECONDS = 0.05
+FRAME_BYTES = 64 * 1024
+HIGH_WATER_BYTES = 1024 * 1024
+# The most a reconnecting client is sent to catch up, or a single page of earlier output
+MAX_RESUME_BYTES = 1024 * 1024
+MAX_PAGE_BYTES = 256 * 1024
+TRUNCATED_MESSAGE = '[{} was truncated, following from the start]\n'
+DROPPED_MESSAGE = '[... skipped {} bytes of output while this connection was behind ...]\n'
+
+
+# offset: where data starts in the file
+# truncated: the file was truncated or replaced since the previous frame, and offsets start over
+# dropped_lines, dropped_bytes: output skipped between the previous frame and this one (lines may be 0 if unknown)
+Frame = collections.namedtuple('Frame', ['file_id', 'offset', 'data', 'truncated', 'dropped_lines', 'dropped_bytes'])
+
+
+def frame_end(frame):
+    return frame.offset + len(frame.data)
+
+
+# The text of a frame, with any truncation or skipped output described inline
+def frame_text(frame, path):
+    text = ''
+    if frame.truncated:
+        text += TRUNCATED_MESSAGE.format(os.path.basename(path))
+    if frame.dropped_bytes:
+        text += DROPPED_MESSAGE.format(frame.dropped_bytes)
+    return text + logtail.decode(frame.data)
+
+
+# One client's bounded buffer of data waiting to be sent
+# Chunks are (offset, bytes), and always contiguous unless output was dropped.
+class Subscriber(object):
+    def __init__(self, high_water_bytes=None):
+        self.high_water_bytes = high_water_bytes or HIGH_WATER_BYTES
+        self.chunks = collections.deque()
+        self.size = 0
+        self.file_id = None
+        self.truncated = False
+        self.dropped_lines = 0
+        self.dropped_bytes = 0
+        self.closed = False
+        self.ready = asyncio.Event()
+
+    def put(self, file_id, offset, data):
+        self.file_id = file_id
+        self.chunks.append((offset, data))
+        self.size += len(data)
+        while self.size > self.high_water_bytes and len(self.chunks) > 1:
+            offset, dropped = self.chunks.popleft()
+            self.size -= len(dropped)
+            self.dropped_lines += dropped.count(b'\n')
+            self.dropped_bytes += len(dropped)
+        self.ready.set()
+
+    # Anything waiting was from the old file, which no longer exists
+    def restart(self, file_id):
+        self.chunks.clear()
+        self.size = 0
+        self.dropped_lines = self.dropped_bytes = 0
+        self.file_id = file_id
+        self.truncated = True
+        self.ready.set()
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+    # Returns the next Frame, waiting up to max_seconds for more lines to batch with it
+    # Returns None once the follower has stopped and everything has been sent.
+    async def get_frame(self, max_bytes=None, max_seconds=None):
+        max_bytes = max_bytes or FRAME_BYTES
+        max_seconds = FRAME_SECONDS if max_seconds is None else max_seconds
+        while not self.chunks and not self.truncated:
+            if self.closed:
+                return None
+            self.ready.clear()
+            await self.ready.wait()
+        if not self.closed and self.size < max_bytes and max_seconds > 0:
+            await asyncio.sleep(max_seconds)
+        offset = self.chunks[0][0] if self.chunks else 0
+        data = b''
+        while self.chunks and len(data) < max_bytes:
+            chunk_offset, chunk = self.chunks.popleft()
+            self.size -= len(chunk)
+            room = max_bytes - len(data)
+            if len(chunk) > room:
+                # Split long chunks at a line break, unless a single line is longer than a frame
+                cut = chunk.rfind(b'\n', 0, room) + 1
+                if not cut and data:
+                    self.chunks.appendleft((chunk_offset, chunk))
+                    self.size += len(chunk)
+                    break
+                cut = cut or room
+                self.chunks.appendleft((chunk_offset + cut, chunk[cut:]))
+                self.size += len(chunk) - cut
+                chunk = chunk[:cut]
+            data += chunk
+        if not self.chunks and not self.closed:
+            self.ready.clear()
+        frame = Frame(self.file_id, offset, data, self.truncated, self.dropped_lines, self.dropped_bytes)
+        self.truncated = False
+        self.dropped_lines = self.dropped_bytes = 0
+        return frame
+
+
+class Follower(object):
+    def __init__(self, path):
+        self.path = path
+        self.subscribers = []
+        self.inode = None
+        self.offset = 0
+        self.recent = collections.deque(maxlen=RING_LINES)
+        self.recent_bytes = 0
+        self.wake_event = asyncio.Event()
+        # Set once the follower has found the end of the file; subscribers arriving before then wait for it
+        self.ready = asyncio.Event()
+        self.waiting = 0
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        for subscriber in self.subscribers:
+            subscriber.close()
+
+    def wake(self):
+        self.wake_event.set()
+
+    def remember(self, lines):
+        for line in lines:
+            if len(self.recent) == self.recent.maxlen:
+                self.recent_bytes -= len(self.recent[0])
+            self.recent.append(line)
+            self.recent_bytes += len(line)
+
+    # Returns (offset, bytes) of the last n lines before the current offset
+    # New subscribers start exactly where the stream does, without reading the file again.
+    def backlog(self, n):
+        start = max(0, len(self.recent) - n)
+        data = b''.join(itertools.islice(self.recent, start, None))
+        return self.offset - len(data), data
+
+    # Returns the bytes from offset up to the current offset if they are all still in memory, otherwise None
+    def recent_since(self, offset):
+        if offset > self.offset or offset < self.offset - self.recent_bytes:
+            return None
+        data = b''.join(self.recent)
+        return data[len(data) - (self.offset - offset):]
+
+    # Returns (file id, offset, last lines) for the end of the file as it is when the first subscriber arrives,
+    # or None if it doesn't exist yet. Like read(), this runs in an executor thread and changes nothing.
+    def read_end(self):
+        try:
+            fp = open(self.path, 'rb')
+        except FileNotFoundError:
+            return None
+        with fp:
+            st = os.fstat(fp.fileno())
+            lines, partial = logtail.read_last_lines(fp, st.st_size, RING_LINES)
+        return st.st_ino, st.st_size - len(partial), lines
+
+    # Returns (file id, offset, bytes appended since the last read, whether the file was truncated or replaced)
+    # Only complete lines are returned, unless more than MAX_READ_BYTES are waiting.
+    # This runs in an executor thread, so it changes nothing: run() moves the offset on the event loop,
+    # in the same step as adding the lines to the ring, so subscribe() never sees one without the other.
+    def read(self):
+        try:
+            fp = open(self.path, 'rb')
+        except FileNotFoundError:
+            return self.inode, self.offset, b'', False
+        with fp:
+            st = os.fstat(fp.fileno())
+            truncated = self.inode is not None and (st.st_ino != self.inode or st.st_size < self.offset)
+            offset = 0 if truncated or self.inode is None else self.offset
+            if st.st_size == offset:
+                return st.st_ino, offset, b'', truncated
+            fp.seek(offset)
+            data = fp.read(min(st.st_size - offset, MAX_READ_BYTES))
+        newline = data.rfind(b'\n')
+        if len(data) < MAX_READ_BYTES:
+            data = data[:newline + 1]
+        return st.st_ino, offset, data, truncated
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        try:
+            end = await loop.run_in_executor(None, self.read_end)
+            if end is not None:
+                self.inode, self.offset, lines = end
+                self.remember(lines)
+        finally:
+            self.ready.set()
+        while True:
+            try:
+                await asyncio.wait_for(self.wake_event.wait(), POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self.wake_event.clear()
+            while True:
+                # Reads go to a thread, so a slow disk (or NFS) doesn't stall every other stream
+                inode, offset, data, truncated = await loop.run_in_executor(None, self.read)
+                if truncated:
+                    self.recent.clear()
+                    self.recent_bytes = 0
+                    for subscriber in self.subscribers:
+                        subscriber.restart(inode)
+                self.inode = inode
+                self.offset = offset + len(data)
+                if not data:
+                    break
+                self.remember(data.splitlines(keepends=True))
+                for subscriber in self.subscribers:
+                    subscriber.put(self.inode, offset, data)
+
+
+followers = {}
+
+
+# Returns (a Subscriber to new output, a Frame of the last tail_lines lines written before it)
+# If resume_from is (file_id, offset), the first frame instead holds everything written since offset,
+# up to MAX_RESUME_BYTES, so a client that reconnects misses nothing and sees nothing twice.
+# Files are only read in the default executor, never on the event loop.
+async def subscribe(path, tail_lines=0, high_water_bytes=None, resume_from=None):
+    path = os.path.abspath(path)
+    follower = followers.get(path)
+    if follower is None:
+        follower = Follower(path)
+        follower.start()
+        followers[path] = follower
+    if not follower.ready.is_set():
+        follower.waiting += 1
+        try:
+            await follower.ready.wait()
+        except BaseException:
+            follower.waiting -= 1
+            release(path, follower)
+            raise
+        follower.waiting -= 1
+
+    # The backlog is taken in the same step as joining, so no line is both in it and sent to the subscriber
+    subscriber = Subscriber(high_water_bytes)
+    subscriber.file_id = follower.inode
+    follower.subscribers.append(subscriber)
+    offset, data = follower.backlog(tail_lines)
+    first = Frame(follower.inode, offset, data, False, 0, 0)
+    if resume_from is not None:
+        file_id, resume_offset = resume_from
+        inode, end = follower.inode, follower.offset
+        if file_id != inode or resume_offset > end:
+            first = first._replace(truncated=True)
+        else:
+            data = follower.recent_since(resume_offset)
+            if data is None:
+                try:
+                    data = await asyncio.get_running_loop().run_in_executor(
+                        None, read_range, path, resume_offset, end, inode, MAX_RESUME_BYTES)
+                except BaseException:
+                    unsubscribe(path, subscriber)
+                    raise
+            skipped = end - len(data) - resume_offset
+            first = Frame(inode, end - len(data), data, False, 0, skipped)
+    return subscriber, first
+
+
+def unsubscribe(path, subscriber):
+    path = os.path.abspath(path)
+    follower = followers.get(path)
+    if follower is None:
+        return
+    follower.subscribers = [s for s in follower.subscribers if s is not subscriber]
+    release(path, follower)
+
+
+# Stops a follower once nobody is subscribed to it or waiting to be
+def release(path, follower):
+    if not follower.subscribers and not follower.waiting and followers.get(path) is follower:
+        del followers[path]
+        follower.stop()
+
+
+def subscriber_count():
+    return sum(len(follower.subscribers) for follower in followers.values())
+
+
+# Returns the bytes of path between start and end, or only the last max_bytes of them
+# Reads that don't start at the beginning of the file begin at the next whole line.
+# Returns b'' if the file has been replaced since file_id was sent.
+def read_range(path, start, end, file_id, max_bytes=MAX_PAGE_BYTES):
+    try:
+        fp = open(path, 'rb')
+    except FileNotFoundError:
+        return b''
+    with fp:
+        if os.fstat(fp.fileno()).st_ino != file_id:
+            return b''
+        trimmed = max(start, end - max_bytes)
+        fp.seek(trimmed)
+        data = fp.read(end - trimmed)
+    if trimmed > start:
+        newline = data.find(b'\n')
+        data = data[newline + 1:] if newline >= 0 else b''
+    return data
+
+
+# Returns a Frame of up to max_bytes of whole lines ending at offset before, for paging back through a file
+def page_before(path, file_id, before, max_bytes=MAX_PAGE_BYTES):
+    max_bytes = min(max_bytes, MAX_PAGE_BYTES)
+    data = read_range(path, 0, before, file_id, max_bytes) if before > 0 else b''
+    return Frame(file_id, before - len(data), data, False, 0, 0)
+
+
+# Wake the follower of any stdout.txt the change feed sees written to
+# The feed calls back from its own thread, so the wakeup is handed to the event loop
+def attach_change_feed(feed, loop):
+    def on_change(event):
+        if event.kind == changefeed.RESCAN:
+            loop.call_soon_threadsafe(wake_followers, None)
+        elif event.kind == changefeed.STDOUT_APPENDED:
+            path = os.path.join(feed.experiments_dir, event.namespace, event.experiment_id, event.filename)
+            loop.call_soon_threadsafe(wake_followers, path)
+    feed.subscribe(on_change)
+
+
+# Wakes the follower of path, or every follower if path is None
+def wake_followers(path):
+    if path is None:
+        for follower in followers.values():
+            follower.wake()
+    elif path in followers:
+        followers[path].wake()
@@ -0,0 +1,157 @@
+# Read the end of log files in-process, instead of forking `tail` or `grep` for every experiment
+# Logs can be many gigabytes, so we only ever seek backwards from EOF in fixed-size blocks.
+# Append-only files (eg. stdout.txt) are cached, so repeat reads only touch the newly appended bytes.
+import os
+import re
+import threading
+import collections
+
+BLOCK_SIZE = 8192
+MAX_CACHED_FILES = 4096
+
+# The progress bar printed by tqdm, eg. " 45%|████     | 45/100 [00:10<00:12,  4.51it/s]"
+TQDM_PATTERN = re.compile(r'\|.*\|.*/.*\[.*\]')
+
+TailState = collections.namedtuple('TailState', ['inode', 'offset', 'lines', 'partial'])
+
+cache = collections.OrderedDict()
+cache_lock = threading.Lock()
+
+
+# Returns the last n lines of an append-only file (like `tail -n`), and the file offset they end at
+def tail(path, n):
+    try:
+        fp = open(path, 'rb')
+    except FileNotFoundError:
+        return [], 0
+    with fp:
+        st = os.fstat(fp.fileno())
+        key = (path, n)
+        with cache_lock:
+            state = cache.get(key)
+        if state is None or state.inode != st.st_ino or st.st_size < state.offset:
+            # New or truncated file: start over from the end
+            lines, partial = read_last_lines(fp, st.st_size, n)
+            state = TailState(st.st_ino, st.st_size, collections.deque(lines, maxlen=n), partial)
+        elif st.st_size > state.offset:
+            fp.seek(state.offset)
+            data = state.partial + fp.read(st.st_size - state.offset)
+            lines, partial = split_lines(data)
+            state.lines.extend(lines)
+            state = TailState(st.st_ino, st.st_size, state.lines, partial)
+        with cache_lock:
+            cache[key] = state
+            cache.move_to_end(key)
+            while len(cache) > MAX_CACHED_FILES:
+                cache.popitem(last=False)
+        result = list(state.lines)
+        if state.partial:
+            result = result[1:] if len(result) == n else result
+            result.append(state.partial)
+        return [decode(line) for line in result], state.offset
+
+
+def tail_lines(path, n):
+    return tail(path, n)[0]
+
+
+# Returns (complete lines, trailing partial line) for the last n lines ending at offset end
+def read_last_lines(fp, end, n):
+    pos = end
+    data = b''
+    while pos > 0 and data.count(b'\n') <= n:
+        step = min(BLOCK_SIZE, pos)
+        pos -= step
+        fp.seek(pos)
+        data = fp.read(step) + data
+    lines, partial = split_lines(data)
+    if pos > 0 and lines:
+        # The first line we read is probably only the end of a longer line
+        lines = lines[1:]
+    return lines[-n:], partial
+
+
+def split_lines(data):
+    lines = data.split(b'\n')
+    partial = lines.pop()
+    return [line + b'\n' for line in lines], partial
+
+
+# Returns the last line matching pattern, scanning backwards from EOF
+def find_last_line(path, pattern):
+    try:
+        fp = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    with fp:
+        pos = os.fstat(fp.fileno()).st_size
+        remainder = b''
+        while pos > 0:
+            step = min(BLOCK_SIZE, pos)
+            pos -= step
+            fp.seek(pos)
+            data = fp.read(step) + remainder
+            lines = data.split(b'\n')
+            # Keep the first (possibly incomplete) line for the next block
+            remainder = lines[0] if pos > 0 else b''
+            candidates = lines[1:] if pos > 0 else lines
+            for line in reversed(candidates):
+                line = decode(line)
+                if pattern.search(line):
+                    return line
+    return None
+
+
+# Returns the last max_bytes or less of a file, starting at a line boundary, or None if there is no file
+# For files that are rewritten in place rather than appended to, so nothing is cached.
+def read_end(path, max_bytes):
+    try:
+        fp = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    with fp:
+        size = os.fstat(fp.fileno()).st_size
+        fp.seek(max(0, size - max_bytes))
+        data = fp.read(max_bytes)
+    if size > max_bytes:
+        data = data[data.find(b'\n') + 1:]
+    return decode(data)
+
+
+# Returns the text appended to path since offset, and the offset to continue from
+# Only complete lines are returned, unless more than max_bytes are waiting.
+# If the file was truncated or replaced, reading starts over from the beginning.
+def read_from(path, offset, max_bytes=1024 * 1024):
+    try:
+        fp = open(path, 'rb')
+    except FileNotFoundError:
+        return '', 0
+    with fp:
+        size = os.fstat(fp.fileno()).st_size
+        if size < offset:
+            offset = 0
+        if size == offset:
+            return '', offset
+        fp.seek(offset)
+        data = fp.read(min(size - offset, max_bytes))
+    if len(data) < max_bytes:
+        # Hold back an unfinished last line, even if it is the only one
+        data = data[:data.rfind(b'\n') + 1]
+    return decode(data), offset + len(data)
+
+
+# Parses a tqdm progress bar into (percent, elapsed, remaining), or None
+def parse_tqdm(line):
+    if line is None or not TQDM_PATTERN.search(line):
+        return None
+    try:
+        percentage_complete = line.split('%')[0].split('\r')[-1].strip()
+        elapsed_remaining = line.split('[')[1].split(',')[0]
+        time_elapsed, time_remaining = elapsed_remaining.split('<')
+    except (IndexError, ValueError):
+        return None
+    return percentage_complete, time_elapsed, time_remaining.rstrip(']')
+
+
+def decode(data):
+    return data.decode('utf-8', errors='replace')
@@ -0,0 +1,251 @@
+# Packs jobs onto one host's CPU cores, memory and GPUs
+# Each experiment may ask for resources in gnomehat_resources.json (written by `gnomehat run --cpus/--memory/--gpus`):
+#   {"cpus": 2, "memory_mb": 8192, "gpus": 0.5}
+# Experiments without one get DEFAULT_REQUEST: one core, and a whole GPU if the host has any.
+#
+# What a host has is decided by providers, so the packing can be tested without GPUs:
+#   CpuProvider: the cores this process may run on, and physical memory
+#   NvidiaGpuProvider: GPUs listed by lspci, limited by CUDA_VISIBLE_DEVICES
+#   FakeGpuProvider: a given number of imaginary GPUs (set GNOMEHAT_FAKE_GPUS=n)
+#
+# Usage:
+#   scheduler = SlotScheduler.for_host()
+#   scheduler.refresh_gpus()    # notice GPUs being used outside gnomehat
+#   allocation = scheduler.allocate('default/foo_00000001', read_resources(dirname))
+#   ... run the job with allocation.cpus as its CPU affinity and allocation.gpus as CUDA_VISIBLE_DEVICES ...
+#   scheduler.release('default/foo_00000001')
+import os
+import re
+import json
+import threading
+import subprocess
+import collections
+
+from gnomehat import sysinfo
+
+RESOURCES_FILENAME = 'gnomehat_resources.json'
+# gpus=None means one whole GPU on hosts that have GPUs, and none on hosts that don't
+DEFAULT_REQUEST = {'cpus': 1, 'memory_mb': 0, 'gpus': None}
+# GPUs using more memory than this, and not running one of our jobs, are being used by someone else
+GPU_BUSY_MEMORY_PERCENT = 10.0
+GPU_EPSILON = 1e-6
+
+Allocation = collections.namedtuple('Allocation', ['cpus', 'memory_mb', 'gpus'])
+
+
+# Parses a memory size like '512M', '8G' or '8GB' into megabytes
+def parse_memory(text):
+    match = re.match(r'^\s*([0-9.]+)\s*([kmgt]?)i?b?\s*$', str(text).lower())
+    if match is None:
+        raise ValueError('Invalid memory size {}, expected eg. 512M or 8G'.format(text))
+    number, unit = float(match.group(1)), match.group(2) or 'm'
+    return int(number * {'k': 1. / 1024, 'm': 1, 'g': 1024, 't': 1024 * 1024}[unit])
+
+
+# Returns a complete, validated resource request
+def normalize_request(request):
+    request = dict(DEFAULT_REQUEST, **(request or {}))
+    cpus = int(request['cpus'])
+    memory_mb = int(request['memory_mb'])
+    gpus = request['gpus']
+    if cpus < 1 or memory_mb < 0:
+        raise ValueError('Invalid resource request {}'.format(request))
+    if gpus is not None:
+        gpus = float(gpus)
+        # Fractions share one GPU; more than one GPU must be a whole number
+        if gpus < 0 or (gpus > 1 and gpus != int(gpus)):
+            raise ValueError('Invalid GPU request {}: use a fraction of one GPU, or a whole number'.format(gpus))
+    return {'cpus': cpus, 'memory_mb': memory_mb, 'gpus': gpus}
+
+
+def read_resources(dirname):
+    try:
+        with open(os.path.join(dirname, RESOURCES_FILENAME)) as fp:
+            return normalize_request(json.load(fp))
+    except FileNotFoundError:
+        return normalize_request(None)
+    except ValueError as e:
+        print('Ignoring invalid {} in {}: {}'.format(RESOURCES_FILENAME, dirname, e))
+        return normalize_request(None)
+
+
+def write_resources(dirname, request):
+    with open(os.path.join(dirname, RESOURCES_FILENAME), 'w') as fp:
+        json.dump(normalize_request(request), fp)
+
+
+class CpuProvider(object):
+    def cpus(self):
+        if hasattr(os, 'sched_getaffinity'):
+            return sorted(os.sched_getaffinity(0))
+        return list(range(os.cpu_count() or 1))
+
+    def memory_mb(self):
+        try:
+            with open('/proc/meminfo') as fp:
+                for line in fp:
+                    if line.startswith('MemTotal:'):
+                        return int(line.split()[1]) // 1024
+        except OSError:
+            pass
+        return 0
+
+
+class NvidiaGpuProvider(object):
+    def gpus(self):
+        visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+        if visible is not None:
+            return [int(g) for g in visible.split(',') if g.strip()]
+        return list(range(len(sysinfo.get_gpu_info())))
+
+    def in_use(self, gpu):
+        cmd = "nvidia-smi -q -i {} | egrep Memory.*% | awk '{{print $3}}'".format(int(gpu))
+        try:
+            memory_used = float(subprocess.check_output(cmd, shell=True))
+        except (subprocess.CalledProcessError, ValueError):
+            return False
+        return memory_used >= GPU_BUSY_MEMORY_PERCENT
+
+
+class FakeGpuProvider(object):
+    def __init__(self, count, busy=()):
+        self.count = count
+        self.busy = set(busy)
+
+    def gpus(self):
+        return list(range(self.count))
+
+    def in_use(self, gpu):
+        return gpu in self.busy
+
+
+def get_gpu_provider():
+    fake_gpus = os.environ.get('GNOMEHAT_FAKE_GPUS')
+    if fake_gpus is not None:
+        return FakeGpuProvider(int(fake_gpus))
+    return NvidiaGpuProvider()
+
+
+class SlotScheduler(object):
+    def __init__(self, cpus, memory_mb, gpus, gpu_provider=None):
+        self.cpus = list(cpus)
+        self.memory_mb = memory_mb
+        self.gpus = list(gpus)
+        self.gpu_provider = gpu_provider
+        self.lock = threading.Lock()
+        self.cpu_owner = {cpu: None for cpu in self.cpus}
+        self.gpu_used = {gpu: 0.0 for gpu in self.gpus}
+        self.gpus_busy_elsewhere = set()
+        self.allocations = {}
+
+    @classmethod
+    def for_host(cls, cpu_provider=None, gpu_provider=None):
+        cpu_provider = cpu_provider or CpuProvider()
+        gpu_provider = gpu_provider or get_gpu_provider()
+        return cls(cpu_provider.cpus(), cpu_provider.memory_mb(), gpu_provider.gpus(), gpu_provider)
+
+    def describe(self):
+        return '{} cores, {} MB memory, {} GPUs'.format(len(self.cpus), self.memory_mb, len(self.gpus))
+
+    def memory_free(self):
+        return self.memory_mb - sum(allocation.memory_mb for allocation, wanted in self.allocations.values())
+
+    def gpus_wanted(self, request):
+        if request['gpus'] is None:
+            return 1.0 if self.gpus else 0.0
+        return request['gpus']
+
+    # Returns the GPUs to use for a request, or None if it can't be placed now
+    # A fraction goes on the fullest GPU it fits on, keeping other GPUs free for whole-GPU jobs.
+    def choose_gpus(self, wanted):
+        if wanted == 0:
+            return []
+        candidates = [gpu for gpu in self.gpus if gpu not in self.gpus_busy_elsewhere]
+        if wanted < 1:
+            fitting = [gpu for gpu in candidates if self.gpu_used[gpu] + wanted <= 1 + GPU_EPSILON]
+            if not fitting:
+                return None
+            return [max(fitting, key=lambda gpu: (self.gpu_used[gpu], -gpu))]
+        free = [gpu for gpu in candidates if self.gpu_used[gpu] < GPU_EPSILON]
+        if len(free) < wanted:
+            return None
+        return free[:int(wanted)]
+
+    # A GPU none of our jobs are using may still be in use by someone outside gnomehat
+    # This asks nvidia-smi, so it is done once before each claim rather than for every job considered.
+    def refresh_gpus(self):
+        if self.gpu_provider is None:
+            return
+        with self.lock:
+            idle = [gpu for gpu in self.gpus if self.gpu_used[gpu] < GPU_EPSILON]
+        busy = set(gpu for gpu in idle if self.gpu_provider.in_use(gpu))
+        with self.lock:
+            self.gpus_busy_elsewhere = busy
+
+    # Returns the lowest-numbered free cores, preferring a contiguous run of them
+    def choose_cpus(self, wanted):
+        free = [cpu for cpu in self.cpus if self.cpu_owner[cpu] is None]
+        if len(free) < wanted:
+            return None
+        for i in range(len(free) - wanted + 1):
+            if free[i + wanted - 1] - free[i] == wanted - 1:
+                return free[i:i + wanted]
+        return free[:wanted]
+
+    # Whether a request could ever run on this host, even with nothing else running
+    def can_ever_fit(self, request):
+        request = normalize_request(request)
+        wanted = self.gpus_wanted(request)
+        if wanted > 0 and not self.gpus:
+            return False
+        return (request['cpus'] <= len(self.cpus) and
+                request['memory_mb'] <= self.memory_mb and
+                (wanted <= 1 if wanted < 1 else wanted <= len(self.gpus)))
+
+    def fits(self, request):
+        with self.lock:
+            return self.place(normalize_request(request)) is not None
+
+    def place(self, request):
+        if request['memory_mb'] > self.memory_free():
+            return None
+        cpus = self.choose_cpus(request['cpus'])
+        if cpus is None:
+            return None
+        gpus = self.choose_gpus(self.gpus_wanted(request))
+        if gpus is None:
+            return None
+        return Allocation(cpus, request['memory_mb'], gpus)
+
+    # Returns an Allocation for job_id, or None if the request doesn't fit right now
+    def allocate(self, job_id, request):
+        request = normalize_request(request)
+        with self.lock:
+            allocation = self.place(request)
+            if allocation is None:
+                return None
+            wanted = self.gpus_wanted(request)
+            for cpu in allocation.cpus:
+                self.cpu_owner[cpu] = job_id
+            for gpu in allocation.gpus:
+                self.gpu_used[gpu] += min(wanted, 1.0)
+            self.allocations[job_id] = (allocation, wanted)
+            return allocation
+
+    def release(self, job_id):
+        with self.lock:
+            allocation, wanted = self.allocations.pop(job_id)
+            for cpu in allocation.cpus:
+                self.cpu_owner[cpu] = None
+            for gpu in allocation.gpus:
+                self.gpu_used[gpu] = max(0.0, self.gpu_used[gpu] - min(wanted, 1.0))
+
+    # The number of GPUs a job holds, which may be a fraction
+    def gpus_held(self, job_id):
+        with self.lock:
+            allocation, wanted = self.allocations[job_id]
+            return wanted if allocation.gpus else 0.0
+
+    def running(self):
+        with self.lock:
+            return len(self.allocations)
@@ -12,7 +12,14 @@ def arg(name):
 
 def run(app_config):
     config.update(app_config)
-    from . import webapi
-    app.run(config.get('GNOMEHAT_BIND_IP'),
-            port=config.get('GNOMEHAT_PORT'),
-            debug=config.get('DEBUG'))
+    from . import serving
+    serving.run(start_app)
+
+
+# Load the routes and start watching for changes; in gunicorn mode this runs in each worker
+def start_app():
+    from . import webapi, datasource
+    from gnomehat import changefeed
+    feed = changefeed.start_feed(config)
+    if feed is not None:
+        datasource.attach_change_feed(feed)
@@ -0,0 +1,61 @@
+# A small thread-safe LRU cache that counts its hits and misses
+import threading
+import collections
+
+
+# With weigh (eg. a function returning the length of a list), items are also evicted until their
+# total weight is at most max_weight, and an item heavier than that on its own isn't kept at all
+class LRUCache(object):
+    def __init__(self, max_size, weigh=None, max_weight=None):
+        self.max_size = max_size
+        self.weigh = weigh
+        self.max_weight = max_weight
+        self.items = collections.OrderedDict()
+        self.weights = {}
+        self.weight = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        weight = self.weigh(value) if self.weigh else 0
+        with self.lock:
+            self.remove(key)
+            if self.max_weight is not None and weight > self.max_weight:
+                return
+            self.items[key] = value
+            self.weights[key] = weight
+            self.weight += weight
+            while len(self.items) > self.max_size or (self.max_weight is not None and self.weight > self.max_weight):
+                self.remove(next(iter(self.items)))
+
+    # Call with the lock held
+    def remove(self, key):
+        if key in self.items:
+            del self.items[key]
+            self.weight -= self.weights.pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.weights.clear()
+            self.weight = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.items),
+                'max_size': self.max_size,
+                'weight': self.weight,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -1,23 +1,32 @@
 # Right now the UI is all based on data we read from the filesystem
 # All that file IO should happen in this module
 import time
+import heapq
+import bisect
+import fnmatch
+import hashlib
 import socket
 import random
 import base64
 import datetime
 import pickle
-import flask
 import json
 import os
 import sys
 import pytz
-import subprocess
+import threading
+import concurrent.futures
 
-from gnomehat.server import app, config
+from gnomehat import changefeed, logtail, timeseries
+from gnomehat.server import app, config, index, stats
+from gnomehat.server.cache import LRUCache
+from gnomehat.server.metrics_table import MetricsTable
 
 # TODO: Rest of world
 TIMEZONE = 'US/Pacific'
 DEFAULT_NAMESPACE = 'default'
+# Cards show images 128 pixels high, so this is sharp on high-DPI screens
+CARD_THUMBNAIL_SIZE = 256
 
 
 # Every experiment is a directory within a namespace
@@ -28,19 +37,69 @@ def get_namespaces(url_prefix):
     namespaces = []
     for namespace in os.listdir(config['EXPERIMENTS_DIR']):
         path = os.path.join(config['EXPERIMENTS_DIR'], namespace)
-        if path.startswith('.'):
+        if namespace.startswith('.'):
             continue
         if not os.path.isdir(path):
             continue
-        namespaces.append({
-            'name': namespace,
-            'url': os.path.join(url_prefix, namespace),
-            'count': len(ls_directories(path)),
-            'last_modified': timestamp_to_str(os.stat(path).st_mtime),
-        })
+        summary = get_namespace_summary(namespace)
+        namespaces.append(dict(summary, url=os.path.join(url_prefix, namespace)))
     return namespaces
 
 
+# Experiment counts for one namespace, cached until the namespace changes
+# Namespaces that are already in the metadata index get per-status counts too
+namespace_summaries = {}
+# Without a change feed, how long per-status counts may go without checking running experiments
+NAMESPACE_SUMMARY_SECONDS = 10
+
+
+def get_namespace_summary(namespace):
+    path = get_experiments_dir(namespace)
+    namespace_mtime = os.stat(path).st_mtime
+    indexed = index.enabled() and index.get_namespace_mtime(namespace) is not None
+    cached = namespace_summaries.get(path)
+    if indexed and summary_may_be_stale(namespace, namespace_mtime, cached):
+        refresh_index(namespace)
+        checked_at = time.time()
+    else:
+        checked_at = cached[2] if cached is not None else time.time()
+    generation = index.get_generation(namespace)[0] if indexed else None
+    if cached is not None and cached[0] == (namespace_mtime, generation):
+        namespace_summaries[path] = (cached[0], cached[1], checked_at)
+        return cached[1]
+
+    summary = {
+        'name': namespace,
+        'count': None,
+        'running': None,
+        'finished': None,
+        'failed': None,
+        'last_modified': timestamp_to_str(namespace_mtime),
+        'last_modified_timestamp': namespace_mtime,
+    }
+    if indexed and index.get_namespace_mtime(namespace) == namespace_mtime:
+        status_counts = index.count_statuses(namespace)
+        summary['count'] = sum(status_counts.values())
+        for status in ['running', 'finished', 'failed']:
+            summary[status] = status_counts.get(status, 0)
+    else:
+        summary['count'] = len(get_experiment_ids(path))
+    namespace_summaries[path] = ((namespace_mtime, generation), summary, checked_at)
+    return summary
+
+
+# Whether refresh_index() could change a namespace's summary, without refreshing it
+# Adding or removing experiments changes the namespace mtime, and a trusted change feed reports the rest.
+def summary_may_be_stale(namespace, namespace_mtime, cached):
+    if namespace_mtime != index.get_namespace_mtime(namespace):
+        return True
+    if change_feed is not None and change_feed.trusted:
+        with dirty_lock:
+            if namespace in trusted_namespaces:
+                return bool(dirty_experiments.get(namespace))
+    return cached is None or time.time() - cached[2] > NAMESPACE_SUMMARY_SECONDS
+
+
 # At least one namespace (the default namespace) must always exist
 def ensure_default_namespace():
     default_namespace_path = os.path.join(config['EXPERIMENTS_DIR'], DEFAULT_NAMESPACE)
@@ -55,15 +114,72 @@ def ls_directories(path):
 
 
 def get_results(files_url, namespace=None):
+    return get_results_page(files_url, namespace)['results']
+
+
+# Returns one page of experiment cards, newest first
+# Pages are addressed by an opaque cursor, so deep pages cost the same as the first one
+# refresh=False skips bringing the index up to date, for callers that just did
+def get_results_page(files_url, namespace=None, cursor=None, limit=None, refresh=True):
+    limit = limit or config['MAX_RESULTS_PER_PAGE']
+    before = decode_cursor(cursor)
+    if namespace is not None and index.enabled():
+        if refresh:
+            refresh_index(namespace)
+        records = index.query_records(namespace, limit=limit + 1, before=before)
+        keys = [(r['timestamp'], os.path.basename(r['experiment_id'])) for r in records]
+        results = [card_from_record(record, files_url) for record in records[:limit]]
+    else:
+        experiments_dir = get_experiments_dir(namespace)
+        newest = newest_result_dirs(experiments_dir, limit + 1, before)
+        keys = [key for key, dir_path in newest]
+        result_dirs = [dir_path for key, dir_path in newest]
+        records = read_experiments(result_dirs[:limit])
+        results = [card_from_record(record, files_url) for record in records
+                   if record is not None and record['visible']]
+    next_cursor = None
+    if len(keys) > limit:
+        next_cursor = encode_cursor(keys[limit - 1])
+    return {
+        'results': results,
+        'next_cursor': next_cursor,
+    }
+
+
+# Returns (fingerprint, last modified time) for the experiments of a namespace
+# The fingerprint changes whenever anything shown on a page of results might have changed
+def get_namespace_fingerprint(namespace, cursor=None, limit=None):
+    if index.enabled():
+        refresh_index(namespace)
+        generation, changed_at = index.get_generation(namespace)
+        return 'g{}'.format(generation), changed_at
+
     experiments_dir = get_experiments_dir(namespace)
-    result_dirs = get_result_dirs(experiments_dir)
+    namespace_mtime = os.stat(experiments_dir).st_mtime
+    parts = [str(namespace_mtime)]
+    last_modified = namespace_mtime
+    for key, dir_path in newest_result_dirs(experiments_dir, limit or sys.maxsize, decode_cursor(cursor)):
+        try:
+            parts.append(experiment_fingerprint(dir_path))
+        except FileNotFoundError:
+            continue
+        last_modified = max(last_modified, key[0])
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest(), last_modified
 
-    results = []
-    for dir_path in result_dirs:
-        experiment = experiment_from_filesystem(dir_path, files_url)
-        if experiment is not None:
-            results.append(experiment)
-    return sorted(results, key=lambda x: x['last_modified_timestamp'], reverse=True)
+
+# A cursor is the (timestamp, experiment id) sort key of the last experiment on the previous page
+def encode_cursor(key):
+    return str(base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')), 'utf-8')
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        timestamp, name = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+        return int(timestamp), str(name)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor {}'.format(cursor))
 
 
 # The experiments_dir contains subdirectories, each of which is a shallow clone
@@ -74,36 +190,257 @@ def get_experiments_dir(namespace=None):
 
 
 def get_result_dirs(experiments_dir):
-    # List all subdirectories
-    result_dirs = [os.path.join(experiments_dir, r)
-                   for r in os.listdir(experiments_dir)]
-    result_dirs = [r for r in result_dirs if os.path.isdir(r)]
-
-    # Return the most recent N results
-    result_dirs.sort(key=os.path.getmtime)
+    # Return the most recent N results, oldest first
     max_results = config['MAX_RESULTS_PER_PAGE']
-    result_dirs = result_dirs[-max_results:]
-    return result_dirs
+    newest = newest_result_dirs(experiments_dir, max_results)
+    return [dir_path for key, dir_path in reversed(newest)]
+
+
+# Returns the top N [(sort key, path)] of subdirectories, newest first, older than before
+# A heap keeps this O(N log limit) instead of sorting every directory in the namespace
+def newest_result_dirs(experiments_dir, limit, before=None):
+    candidates = []
+    with os.scandir(experiments_dir) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            key = (int(entry.stat().st_mtime), entry.name)
+            if before is None or key < before:
+                candidates.append((key, entry.path))
+    return heapq.nlargest(limit, candidates)
+
+
+# Bring the metadata index for one namespace up to date with the filesystem
+# Creating or deleting an experiment changes the mtime of the namespace directory,
+# so if that mtime is unchanged we only need to look at experiments that are still running.
+# With a change feed attached, we only need to look at the experiments it reported.
+def refresh_index(namespace):
+    namespace_dir = get_experiments_dir(namespace)
+    namespace_mtime = os.stat(namespace_dir).st_mtime
+    known = index.get_fingerprints(namespace)
+    trust_feed, dirty = take_dirty_experiments(namespace)
+    retry = take_failed_reads(namespace)
+    if namespace_mtime != index.get_namespace_mtime(namespace):
+        candidates = get_experiment_ids(namespace_dir)
+        index.delete_records(namespace, set(known) - set(candidates))
+    elif trust_feed:
+        candidates = [eid for eid in dirty if eid in known]
+    else:
+        candidates = [eid for eid, (fingerprint, settled) in known.items() if not settled]
+    candidates = candidates + sorted(retry - set(candidates))
+
+    changed = []
+    for eid in candidates:
+        dir_path = os.path.join(namespace_dir, eid)
+        try:
+            fingerprint = experiment_fingerprint(dir_path)
+        except FileNotFoundError:
+            index.delete_records(namespace, [eid])
+            continue
+        if eid not in known or known[eid][0] != fingerprint:
+            changed.append((eid, fingerprint, dir_path))
+    records = read_experiments([dir_path for eid, fingerprint, dir_path in changed])
+    index.put_records(namespace, [(eid, fingerprint, record)
+                                  for (eid, fingerprint, dir_path), record in zip(changed, records)
+                                  if record is not None])
+    # Experiments that failed or timed out are retried next time, whatever the namespace mtime and feed say
+    failed = set(eid for (eid, fingerprint, dir_path), record in zip(changed, records) if record is None)
+    if failed:
+        with dirty_lock:
+            failed_reads.setdefault(namespace, set()).update(failed)
+
+    # Coarse (eg. NFS) timestamps can hide a change made in the same second we looked
+    if time.time() - namespace_mtime > MTIME_SETTLE_SECONDS:
+        index.set_namespace_mtime(namespace, namespace_mtime)
+
+
+# Experiments reported by the change feed since the last refresh, per namespace
+# A namespace is only trusted once it has been fully checked after the feed started, and while the feed is
+change_feed = None
+dirty_experiments = {}
+trusted_namespaces = set()
+# Experiments whose last read failed, per namespace, which refresh_index() tries again
+failed_reads = {}
+dirty_lock = threading.Lock()
+
+
+def attach_change_feed(feed):
+    global change_feed
+    change_feed = feed
+    feed.subscribe(on_filesystem_change)
+
+
+def on_filesystem_change(event):
+    with dirty_lock:
+        if event.kind == changefeed.RESCAN:
+            trusted_namespaces.clear()
+        elif event.namespace is not None:
+            dirty_experiments.setdefault(event.namespace, set()).add(event.experiment_id)
+
+
+def take_failed_reads(namespace):
+    with dirty_lock:
+        return failed_reads.pop(namespace, set())
+
+
+def take_dirty_experiments(namespace):
+    if change_feed is None:
+        return False, set()
+    with dirty_lock:
+        trusted = change_feed.trusted and namespace in trusted_namespaces
+        trusted_namespaces.add(namespace)
+        return trusted, dirty_experiments.pop(namespace, set())
+
+
+# Files that are written in-place inside an experiment directory
+# Creating or deleting a file changes the directory mtime, but appending to one does not
+FINGERPRINT_FILES = ['stdout.txt', 'gnomehat_notes.txt', '.last_summary.json', '.last_summary.log']
+MTIME_SETTLE_SECONDS = 2
+
+
+# A cheap summary of everything experiment_from_filesystem() reads from dir_path
+def experiment_fingerprint(dir_path):
+    parts = [str(os.stat(dir_path).st_mtime_ns)]
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.name in FINGERPRINT_FILES or entry.is_dir():
+                st = entry.stat()
+                parts.append('{}:{}:{}'.format(entry.name, st.st_mtime_ns, st.st_size))
+    return ' '.join(sorted(parts))
+
+
+# The notes file of a finished experiment is not watched, so edits must be reported
+def invalidate_experiment(experiment_id):
+    if index.enabled():
+        namespace, eid = os.path.split(experiment_id)
+        index.mark_stale(namespace, eid)
 
 
 def experiment_from_filesystem(dir_path, files_url):
+    record = read_experiment(dir_path)
+    if not record['visible']:
+        return None
+    return card_from_record(record, files_url)
+
+
+# Read many experiments at once, in parallel when CARD_LOADER_THREADS > 1
+# Returns records in the same order as dir_paths, with None for any experiment that
+# failed or took longer than CARD_LOAD_TIMEOUT_SECONDS (eg. on a stale NFS mount)
+# A read that timed out may still be stuck in its thread: that experiment is not read again while it is,
+# nor for CARD_RETRY_SECONDS afterwards, so a hung directory ties up at most one thread.
+def read_experiments(dir_paths):
+    threads = config.get('CARD_LOADER_THREADS') or 0
+    slow_seconds = config.get('CARD_SLOW_SECONDS', 1.0)
+    if threads <= 1 or len(dir_paths) <= 1:
+        return [timed_read_experiment(dir_path, {}, 0)[0] for dir_path in dir_paths]
+
+    timeout = config.get('CARD_LOAD_TIMEOUT_SECONDS', 10)
+    # Files the pool threads open are counted against this request in /_stats
+    context = stats.request_context()
+    now = time.time()
+    with card_loader_lock:
+        skipped = set(i for i, dir_path in enumerate(dir_paths)
+                      if dir_path in card_loader_in_flight or card_loader_retry_after.get(dir_path, 0) > now)
+        pool = get_card_loader_pool(threads, timeout)
+        start_times = {}
+        futures = {}
+        for i, dir_path in enumerate(dir_paths):
+            if i not in skipped:
+                card_loader_in_flight[dir_path] = now
+                future = pool.submit(stats.run_as_part_of, context, timed_read_experiment, dir_path, start_times, i)
+                futures[future] = i
+    # Experiments still waiting for a thread get extra time, in case the pool is busy
+    queue_deadline = time.time() + timeout * (1 + len(futures) // threads)
+
+    records = [None] * len(dir_paths)
+    slow, timed_out = 0, []
+    pending = set(futures)
+    while pending:
+        done, pending = concurrent.futures.wait(pending, timeout=0.1,
+                                                return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            records[futures[future]], duration = future.result()
+            if duration > slow_seconds:
+                slow += 1
+        now = time.time()
+        for future in list(pending):
+            start_time = start_times.get(futures[future])
+            deadline = start_time + timeout if start_time else queue_deadline
+            if now > deadline:
+                future.cancel()
+                pending.remove(future)
+                timed_out.append(dir_paths[futures[future]])
+                print('Timed out reading experiment {}'.format(dir_paths[futures[future]]))
+
+    loaded = sum(1 for record in records if record is not None)
+    with card_loader_lock:
+        for dir_path in timed_out:
+            card_loader_retry_after[dir_path] = time.time() + config.get('CARD_RETRY_SECONDS', 60)
+        card_loader_stats['loaded'] += loaded
+        card_loader_stats['failed'] += len(futures) - loaded - len(timed_out)
+        card_loader_stats['slow'] += slow
+        card_loader_stats['timed_out'] += len(timed_out)
+        card_loader_stats['skipped'] += len(skipped)
+    if slow or timed_out or skipped:
+        print('Read {} experiments: {} slow, {} timed out, {} skipped after earlier timeouts'.format(
+            len(dir_paths), slow, len(timed_out), len(skipped)))
+    return records
+
+
+card_loader_pool = None
+card_loader_stats = {'loaded': 0, 'failed': 0, 'slow': 0, 'timed_out': 0, 'skipped': 0}
+card_loader_lock = threading.Lock()
+# {dir_path: time submitted} for reads that haven't returned, including ones that timed out
+card_loader_in_flight = {}
+# {dir_path: time} before which an experiment whose read timed out is not tried again
+card_loader_retry_after = {}
+
+
+# Called with card_loader_lock held
+# If every thread is stuck in a read that timed out, the pool is abandoned and a new one started;
+# the stuck threads finish (or not) on their own.
+def get_card_loader_pool(threads, timeout):
+    global card_loader_pool
+    now = time.time()
+    stuck = sum(1 for started in card_loader_in_flight.values() if now - started > timeout)
+    if card_loader_pool is not None and stuck >= threads:
+        print('All {} card loader threads are stuck, starting new ones'.format(threads))
+        card_loader_pool.shutdown(wait=False)
+        card_loader_pool = None
+        card_loader_in_flight.clear()
+    if card_loader_pool is None:
+        card_loader_pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+    return card_loader_pool
+
+
+# Returns (record or None, seconds taken)
+def timed_read_experiment(dir_path, start_times, i):
+    start_time = time.time()
+    start_times[i] = start_time
+    try:
+        record = read_experiment(dir_path)
+    except Exception as e:
+        print('Error reading experiment {}: {}'.format(dir_path, e))
+        record = None
+    finally:
+        with card_loader_lock:
+            card_loader_in_flight.pop(dir_path, None)
+    return record, time.time() - start_time
+
+
+# Everything the UI needs to know about an experiment, as plain JSON-serializable data
+def read_experiment(dir_path):
     # TODO: parse this in a non-fragile way
     assert dir_path.startswith(config['EXPERIMENTS_DIR'])
     chop = len(config['EXPERIMENTS_DIR']) + 1
     experiment_id = dir_path[chop:]
 
     timestamp = int(os.path.getmtime(dir_path))
-
-    started_at = datetime.datetime.fromtimestamp(timestamp).replace(tzinfo=pytz.timezone(TIMEZONE))
     full_path = os.path.join(config['EXPERIMENTS_DIR'], experiment_id)
     dir_contents = get_dir_contents(full_path)
-    if 'gnomehat_start.sh' not in dir_contents:
-        return None
-    if 'gnomehat_hide' in dir_contents:
-        return None
+    has_start_script = 'gnomehat_start.sh' in dir_contents
 
-    image_url = default_image_url()
-    last_modified_timestamp = started_at
+    image = None
     jpgs = [filename for filename in dir_contents if has_image_extension(filename)]
     if jpgs:
         def last_modified(x):
@@ -112,41 +449,77 @@ def experiment_from_filesystem(dir_path, files_url):
             except:
                 return 0
         jpgs.sort(key=last_modified)
-        last_modified_timestamp = last_modified(jpgs[-1])
-        image_url = '{}/{}/{}'.format(files_url, experiment_id, jpgs[-1])
-
-    running_job = os.path.exists(os.path.join(full_path, 'worker_lockfile'))
-    finished_job = os.path.exists(os.path.join(full_path, 'worker_finished'))
-    started_job = os.path.exists(os.path.join(full_path, 'worker_started'))
-    broken_job = os.path.exists(os.path.join(full_path, 'worker_error'))
-    color = 'orangeish'
-    if finished_job:
-        color = 'blueish'
-    elif broken_job and not running_job:
-        color = 'reddish'
-    elif not started_job and not running_job:
-        color = 'greenish'
+        image = jpgs[-1]
 
-    experiment_name = experiment_id[:-8]
-    experiment_name = experiment_name.replace('_', ' ').replace('-', ' ').strip()
-    experiment_name = experiment_name.title()
-
-    headline = ""
-    headline = get_command(full_path)
+    running_job = 'worker_lockfile' in dir_contents
+    finished_job = 'worker_finished' in dir_contents
+    started_job = 'worker_started' in dir_contents
+    broken_job = 'worker_error' in dir_contents
 
     notes = get_notes(experiment_id)
-    if notes:
-        subtitle = notes
-    else:
-        subtitle = stdout_last_n_lines(experiment_id, n=1)
-
-    completion_stats = get_completion_stats(experiment_id)
+    last_line = ''
+    if not notes:
+        last_line = stdout_last_n_lines(experiment_id, n=1)
 
     metrics_summary = {}
     metrics_summary_filename = os.path.join(dir_path, '.last_summary.json')
     if os.path.exists(metrics_summary_filename):
         metrics_summary = json.loads(open(metrics_summary_filename).read())
 
+    status = 'running'
+    if finished_job:
+        status = 'finished'
+    elif broken_job and not running_job:
+        status = 'failed'
+    elif not started_job and not running_job:
+        status = 'queued'
+
+    return {
+        'experiment_id': experiment_id,
+        'timestamp': timestamp,
+        'status': status,
+        'visible': has_start_script and 'gnomehat_hide' not in dir_contents,
+        'settled': finished_job or (broken_job and not running_job),
+        'image': image,
+        'running': running_job,
+        'finished': finished_job,
+        'started': started_job,
+        'broken': broken_job,
+        'command': get_command(full_path) if has_start_script else '',
+        'notes': notes,
+        'last_line': last_line,
+        'completion_stats': get_completion_stats(experiment_id),
+        'metrics_summary': metrics_summary,
+        'last_log_summary': get_log_summary(experiment_id),
+    }
+
+
+STATUS_COLORS = {
+    'running': 'orangeish',
+    'finished': 'blueish',
+    'failed': 'reddish',
+    'queued': 'greenish',
+}
+
+
+# Format a record from read_experiment() as an experiment card for the front page
+def card_from_record(record, files_url):
+    experiment_id = record['experiment_id']
+    timestamp = record['timestamp']
+    started_at = datetime.datetime.fromtimestamp(timestamp).replace(tzinfo=pytz.timezone(TIMEZONE))
+
+    image_url = default_image_url()
+    if record['image']:
+        image_url = '{}/{}/{}?thumb={}'.format(files_url, experiment_id, record['image'], CARD_THUMBNAIL_SIZE)
+
+    color = STATUS_COLORS[record['status']]
+
+    experiment_name = experiment_id[:-8]
+    experiment_name = experiment_name.replace('_', ' ').replace('-', ' ').strip()
+    experiment_name = experiment_name.title()
+
+    headline = record['command']
+    subtitle = record['notes'] or record['last_line']
     if len(headline) > 128:
         headline = headline[:128] + '...'
     if len(subtitle) > 128:
@@ -156,23 +529,22 @@ def experiment_from_filesystem(dir_path, files_url):
         'experiment_name': experiment_name,
         'headline': headline,
         'subtitle': subtitle,
-        'notes': notes,
-        'completion_stats': completion_stats,
+        'notes': record['notes'],
+        'completion_stats': record['completion_stats'],
         'dir_name': experiment_id,
         'name': experiment_id.replace('_', ' '),
         'start_timestamp': timestamp,
         'last_modified_timestamp': timestamp,
         'started_at': started_at.strftime('%a %I:%M%p'),
-        'finished': finished_job,
+        'finished': record['finished'],
         'color': color,
         'image_url': image_url,
-        'last_log_summary': get_log_summary(experiment_id),
-        'metrics_summary': metrics_summary,
+        'last_log_summary': record['last_log_summary'],
+        'metrics_summary': record['metrics_summary'],
     }
     return result
 
 
-
 def get_worker_count():
     # TODO: Get more information about workers: GPUs, etc
     def parse_worker_filename(filename):
@@ -205,17 +577,11 @@ def get_notes(dir_path):
 
 def get_completion_stats(dir_path):
     summary_filename = os.path.join(config['EXPERIMENTS_DIR'], dir_path, '.last_summary.log')
-    if not os.path.exists(summary_filename):
-        return ''
     # Look for the TQDM line and parse it, if possible
-    try:
-        cmd = ['grep', '|.*|.*/.*\[.*\]', summary_filename]
-        summary_line = str(subprocess.check_output(cmd), 'utf-8')
-    except subprocess.CalledProcessError:
+    progress = logtail.parse_tqdm(logtail.find_last_line(summary_filename, logtail.TQDM_PATTERN))
+    if progress is None:
         return ''
-    percentage_complete = summary_line.split('%')[0]
-    elapsed_remaining = summary_line.split('[')[1].split(',')[0]
-    time_elapsed, time_remaining = elapsed_remaining.split('<')
+    percentage_complete, time_elapsed, time_remaining = progress
     return "{}% complete ({} remaining)".format(percentage_complete, time_remaining)
 
 
@@ -233,18 +599,20 @@ def get_command(dir_path):
 
 def stdout_last_n_lines(dir_name, n):
     stdout_path = os.path.join(config['EXPERIMENTS_DIR'], dir_name, 'stdout.txt')
-    if not os.path.exists(stdout_path):
-        return ''
-    last_log_summary = subprocess.check_output(['tail', '-{}'.format(n), stdout_path])
-    return last_log_summary.decode().strip()
+    return ''.join(logtail.tail_lines(stdout_path, n)).strip()
+
+
+# A card only has room for the end of a long .last_summary.log
+LOG_SUMMARY_BYTES = 16 * 1024
 
 
 def get_log_summary(dir_name):
     last_log_summary = 'No Logs Available'
     log_summary_path = os.path.join(config['EXPERIMENTS_DIR'], dir_name, '.last_summary.log')
     stdout_path = os.path.join(config['EXPERIMENTS_DIR'], dir_name, 'stdout.txt')
-    if os.path.exists(log_summary_path):
-        last_log_summary = open(log_summary_path).read()
+    log_summary = logtail.read_end(log_summary_path, LOG_SUMMARY_BYTES)
+    if log_summary is not None:
+        last_log_summary = log_summary
     elif os.path.exists(stdout_path):
         last_log_summary = stdout_last_n_lines(dir_name, 8)
     return last_log_summary
@@ -288,28 +656,44 @@ def get_dir_images(dir_name):
     return [f for f in files if has_image_extension(f)]
 
 
+# Root-relative, so cards can be built outside of a request (eg. for front page events)
 def default_image_url():
-    return os.path.join(flask.request.url_root, '/static/images/default.png')
+    return '/static/images/default.png'
 
 
 def get_experiment_ids(experiments_dir):
-    return [d for d in os.listdir(experiments_dir) if os.path.isdir(os.path.join(experiments_dir, d))]
+    with os.scandir(experiments_dir) as entries:
+        return [entry.name for entry in entries if entry.is_dir()]
 
 
 def get_experiment_metrics(experiments_dir, experiment_id, number_format=None):
     filename = os.path.join(experiments_dir, experiment_id, '.last_summary.json')
     if os.path.exists(filename):
         items = json.load(open(filename))
-        if number_format:
-            for k in items:
-                if isinstance(items[k], float):
-                    items[k] = number_format % items[k]
-        return items
+        return format_metrics(items, number_format)
     # No metrics available for this experiment
     return {}
 
 
+def format_metrics(items, number_format=None):
+    if number_format:
+        for k in items:
+            if isinstance(items[k], float):
+                items[k] = number_format % items[k]
+    return items
+
+
 def get_all_experiment_metrics(experiments_dir, namespace, include_notes=True, number_format='%.04f'):
+    if index.enabled() and experiments_dir == config['EXPERIMENTS_DIR']:
+        refresh_index(namespace)
+        metrics = {}
+        for record in index.query_records(namespace, visible_only=False):
+            eid = os.path.basename(record['experiment_id'])
+            metrics[eid] = format_metrics(record['metrics_summary'], number_format)
+            if include_notes:
+                metrics[eid]['notes'] = record['notes']
+        return metrics
+
     experiment_ids = get_experiment_ids(os.path.join(experiments_dir, namespace))
     metrics = {}
     for eid in experiment_ids:
@@ -319,18 +703,170 @@ def get_all_experiment_metrics(experiments_dir, namespace, include_notes=True, n
     return metrics
 
 
+# A MetricsTable per namespace, updated one experiment at a time as experiments change
+metrics_tables = {}
+metrics_tables_lock = threading.Lock()
+
+
+def get_metrics_table(namespace, refresh=True):
+    path = get_experiments_dir(namespace)
+    with metrics_tables_lock:
+        table = metrics_tables.setdefault(path, MetricsTable())
+        if index.enabled():
+            update_metrics_table_from_index(table, namespace, refresh)
+        else:
+            update_metrics_table_from_filesystem(table, namespace)
+        return table
+
+
+def update_metrics_table_from_index(table, namespace, refresh=True):
+    if refresh:
+        refresh_index(namespace)
+    generation = index.get_generation(namespace)[0]
+    if table.generation == generation:
+        return
+    fingerprints = index.get_fingerprints(namespace)
+    stale = [eid for eid, (fingerprint, settled) in fingerprints.items()
+             if table.version(eid) != fingerprint]
+    for eid, record in index.get_records(namespace, stale).items():
+        table.update(eid, fingerprints[eid][0], record['timestamp'], record['metrics_summary'], record['notes'])
+    table.retain(fingerprints)
+    table.generation = generation
+
+
+def update_metrics_table_from_filesystem(table, namespace):
+    namespace_dir = get_experiments_dir(namespace)
+    experiment_ids = get_experiment_ids(namespace_dir)
+    for eid in experiment_ids:
+        dir_path = os.path.join(namespace_dir, eid)
+        version = tuple(mtime_or_none(os.path.join(dir_path, f))
+                        for f in ['', '.last_summary.json', 'gnomehat_notes.txt'])
+        if version[0] is None:
+            continue
+        if table.version(eid) != version:
+            metrics = get_experiment_metrics(namespace_dir, eid)
+            notes = get_notes(os.path.join(namespace, eid))
+            table.update(eid, version, int(version[0] / 1e9), metrics, notes)
+    table.retain(experiment_ids)
+
+
+# Parsed time series, keyed by experiment directory
+# The files are append-only, so a cached entry is extended by reading only the new bytes
+timeseries_cache = LRUCache(64)
+
+
+# Returns {key: (steps, wall times, values)} for one experiment, as numpy arrays
+def get_timeseries(namespace, experiment_id):
+    import numpy as np
+    dir_path = os.path.join(get_experiments_dir(namespace), experiment_id)
+    try:
+        st = os.stat(os.path.join(dir_path, timeseries.DATA_FILENAME))
+    except FileNotFoundError:
+        return {}
+    cached = timeseries_cache.get(dir_path)
+    if cached is None or cached['inode'] != st.st_ino or cached['offset'] > st.st_size:
+        cached = {'inode': st.st_ino, 'offset': 0, 'series': {}}
+    if cached['offset'] < st.st_size:
+        new_series, offset = timeseries.read_series(dir_path, cached['offset'])
+        series = dict(cached['series'])
+        for key, arrays in new_series.items():
+            if key in series:
+                arrays = tuple(np.concatenate([old, new]) for old, new in zip(series[key], arrays))
+            series[key] = arrays
+        cached = {'inode': st.st_ino, 'offset': offset, 'series': series}
+        timeseries_cache.put(dir_path, cached)
+    return cached['series']
+
+
+def mtime_or_none(filename):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
 def get_directory_listing(full_path):
-    # Serve a directory of filenames
-    listing = []
-    for filename in os.listdir(full_path):
-        stat = os.stat(os.path.join(full_path, filename))
-        listing.append({
-            'name': filename,
-            'size': stat.st_size,
-            'last_modified': timestamp_to_str(stat.st_mtime),
-        })
-    listing.sort(key=lambda x: x['name'])
-    return listing
+    return get_directory_page(full_path)['listing']
+
+
+LISTING_SORT_KEYS = ['name', 'size', 'mtime']
+LISTING_CACHE_SECONDS = 5
+# Each cached file costs a few hundred bytes, so this keeps the cache to tens of megabytes
+LISTING_CACHE_ENTRIES = 100000
+
+# Recently listed directories, keyed by path: the listing is reused until the directory changes
+# Bounded by the total number of files in them, so a few huge directories can't fill memory
+listing_cache = LRUCache(16, weigh=lambda listing: len(listing['entries']), max_weight=LISTING_CACHE_ENTRIES)
+
+
+# Serve one page of a directory of filenames, sorted by name, size or mtime
+# Only entries matching the glob pattern are included. Returns {'listing', 'total', 'next_cursor'}
+def get_directory_page(full_path, sort='name', descending=False, pattern=None, cursor=None, limit=None):
+    if sort not in LISTING_SORT_KEYS:
+        raise ValueError('Unknown sort key {}'.format(sort))
+    entries = list_directory(full_path)
+    if pattern:
+        entries = [e for e in entries if fnmatch.fnmatch(e['name'], pattern)]
+    sort_key = lambda e: (e[sort], e['name'])
+    entries.sort(key=sort_key)
+    keys = [sort_key(e) for e in entries]
+
+    start, end = 0, len(entries)
+    after = decode_listing_cursor(cursor)
+    try:
+        if after is not None and descending:
+            end = bisect.bisect_left(keys, after)
+        elif after is not None:
+            start = bisect.bisect_right(keys, after)
+    except TypeError:
+        raise ValueError('Cursor {} does not match sort key {}'.format(cursor, sort))
+    if limit is not None:
+        if descending:
+            start = max(start, end - limit)
+        else:
+            end = min(end, start + limit)
+    page = [dict(e, last_modified=timestamp_to_str(e['mtime'])) for e in entries[start:end]]
+    more = start > 0 if descending else end < len(entries)
+    if descending:
+        page.reverse()
+    return {
+        'listing': page,
+        'total': len(entries),
+        'next_cursor': encode_cursor(sort_key(page[-1])) if page and more and limit is not None else None,
+    }
+
+
+# scandir gives the name and file type without a stat() call, so only size and mtime cost a syscall each
+def list_directory(full_path):
+    dir_mtime = os.stat(full_path).st_mtime_ns
+    cached = listing_cache.get(full_path)
+    if cached and cached['dir_mtime'] == dir_mtime and time.time() - cached['listed_at'] < LISTING_CACHE_SECONDS:
+        return list(cached['entries'])
+    entries = []
+    with os.scandir(full_path) as it:
+        for entry in it:
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append({
+                'name': entry.name,
+                'is_dir': entry.is_dir(),
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+            })
+    listing_cache.put(full_path, {'dir_mtime': dir_mtime, 'listed_at': time.time(), 'entries': entries})
+    return list(entries)
+
+
+def decode_listing_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        value, name = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+        return value, str(name)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor {}'.format(cursor))
 
 
 def timestamp_to_str(timestamp):
@@ -339,3 +875,12 @@ def timestamp_to_str(timestamp):
     value.replace(tzinfo=pytz.timezone(TIMEZONE))
     return value.strftime('%Y-%m-%d %H:%M:%S')
 
+
+# Time what the web API calls, and the reads behind it, for /_stats and the slow request log
+TIMED_FUNCTIONS = [
+    'get_namespaces', 'get_namespace_summary', 'get_namespace_fingerprint', 'get_results_page',
+    'get_metrics_table', 'get_all_experiment_metrics', 'get_timeseries', 'get_directory_page',
+    'get_directory_listing', 'get_images', 'get_completion_stats', 'get_notes', 'get_log_summary',
+    'refresh_index', 'read_experiments', 'read_experiment',
+]
+stats.instrument_module(sys.modules[__name__], TIMED_FUNCTIONS)
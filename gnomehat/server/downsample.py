@@ -0,0 +1,59 @@
+# Reduce a long series of (x, y) points to a few hundred, keeping the shape of the curve
+import numpy as np
+
+
+# Largest-Triangle-Three-Buckets (Steinarsson, 2013)
+# Returns the indices of the n points that best preserve the visual shape of the curve
+def lttb(x, y, n):
+    length = len(x)
+    if n >= length or n < 3:
+        return np.arange(length)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # The first and last points are always kept; the rest are split into n - 2 buckets
+    edges = np.linspace(1, length - 1, n - 1).astype(np.int64)
+    indices = np.empty(n, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = length - 1
+    previous = 0
+    for i in range(n - 2):
+        start, end = edges[i], edges[i + 1]
+        # The average of the next bucket (or the last point) is the third corner of the triangle
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+            next_x = x[next_start:next_end].mean()
+            next_y = y[next_start:next_end].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        areas = np.abs((x[previous] - next_x) * (y[start:end] - y[previous]) -
+                       (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        indices[i + 1] = previous
+    return indices
+
+
+# Keep the minimum and maximum of each of n / 2 buckets, so no spike is ever hidden
+def min_max(x, y, n):
+    length = len(x)
+    if n >= length or n < 2:
+        return np.arange(length)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(0, length, n // 2 + 1).astype(np.int64)
+    indices = []
+    for start, end in zip(edges[:-1], edges[1:]):
+        if end <= start:
+            continue
+        bucket = y[start:end]
+        if np.all(np.isnan(bucket)):
+            indices.append(start)
+            continue
+        low = start + int(np.nanargmin(bucket))
+        high = start + int(np.nanargmax(bucket))
+        indices.extend(sorted(set([low, high])))
+    return np.array(indices, dtype=np.int64)
+
+
+METHODS = {
+    'lttb': lttb,
+    'minmax': min_max,
+}
@@ -0,0 +1,186 @@
+# Live updates for the front page, as server-sent events
+# One publisher thread per server process recomputes the first page of a namespace when
+# the change feed reports something in it (or every few seconds, without a change feed),
+# and sends the cards that changed to every viewer of that namespace.
+# So the cost of keeping pages live grows with the rate of changes, not the number of viewers.
+import json
+import time
+import queue
+import threading
+import flask
+
+from gnomehat import changefeed
+from gnomehat.server import app, datasource
+
+# Wait this long after a change for more changes, then publish them together
+COALESCE_SECONDS = 0.5
+# Without a change feed, check each watched namespace this often
+POLL_SECONDS = 5
+# Sent when nothing happens, so proxies and browsers keep the connection open
+KEEPALIVE_SECONDS = 15
+SUBSCRIBER_QUEUE_SIZE = 100
+
+channels = {}
+channels_lock = threading.Lock()
+wakeup = threading.Event()
+publisher = None
+
+
+# Everyone watching the first page of one namespace, served from one files_url
+class Channel(object):
+    def __init__(self, namespace, files_url):
+        self.namespace = namespace
+        self.files_url = files_url
+        self.subscribers = []
+        self.cards = None
+        self.dirty = True
+
+    # Returns a list of (event name, data) for every card added, changed or removed
+    def diff(self):
+        page = datasource.get_results_page(self.files_url, self.namespace)
+        cards = {card['dir_name']: card for card in page['results']}
+        if self.cards is None:
+            self.cards = cards
+            return []
+        messages = []
+        # Oldest first, so the newest added card ends up on top
+        for card in reversed(page['results']):
+            eid = card['dir_name']
+            if eid not in self.cards:
+                messages.append(('added', {'id': eid, 'html': render_card(card)}))
+            elif self.cards[eid] != card:
+                messages.append(('changed', {'id': eid, 'html': render_card(card)}))
+        for eid in self.cards:
+            if eid not in cards:
+                messages.append(('removed', {'id': eid}))
+        self.cards = cards
+        return messages
+
+    def publish(self, messages):
+        for subscriber in list(self.subscribers):
+            for message in messages:
+                try:
+                    subscriber.put_nowait(message)
+                except queue.Full:
+                    # This viewer isn't keeping up: tell its browser to reload the page instead
+                    self.subscribers.remove(subscriber)
+                    drop_backlog(subscriber)
+                    subscriber.put(('reload', {}))
+                    subscriber.put(None)
+                    break
+
+
+def drop_backlog(subscriber):
+    try:
+        while True:
+            subscriber.get_nowait()
+    except queue.Empty:
+        pass
+
+
+def render_card(card):
+    with app.app_context():
+        return flask.render_template('card.html', result=card)
+
+
+def on_filesystem_change(event):
+    with channels_lock:
+        for channel in channels.values():
+            if event.kind == changefeed.RESCAN or event.namespace == channel.namespace:
+                channel.dirty = True
+    wakeup.set()
+
+
+# Returns a queue of (event name, data) messages; a None message ends the stream
+def subscribe(namespace, files_url):
+    start_publisher()
+    subscriber = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+    with channels_lock:
+        key = (namespace, files_url)
+        if key not in channels:
+            channels[key] = Channel(namespace, files_url)
+        channels[key].subscribers.append(subscriber)
+    wakeup.set()
+    return subscriber
+
+
+def unsubscribe(namespace, files_url, subscriber):
+    with channels_lock:
+        channel = channels.get((namespace, files_url))
+        if channel is None:
+            return
+        if subscriber in channel.subscribers:
+            channel.subscribers.remove(subscriber)
+        if not channel.subscribers:
+            del channels[(namespace, files_url)]
+
+
+# End every stream, eg. so the server can shut down; browsers will reconnect
+def close_all():
+    with channels_lock:
+        for channel in channels.values():
+            for subscriber in channel.subscribers:
+                drop_backlog(subscriber)
+                subscriber.put(None)
+            channel.subscribers = []
+        channels.clear()
+
+
+def subscriber_count():
+    with channels_lock:
+        return sum(len(c.subscribers) for c in channels.values())
+
+
+def start_publisher():
+    global publisher
+    with channels_lock:
+        if publisher is not None:
+            return
+        if datasource.change_feed is not None:
+            datasource.change_feed.subscribe(on_filesystem_change)
+        publisher = threading.Thread(target=publish_forever, daemon=True)
+        publisher.start()
+
+
+def publish_forever():
+    while True:
+        wakeup.wait(timeout=POLL_SECONDS)
+        wakeup.clear()
+        time.sleep(COALESCE_SECONDS)
+        try:
+            publish_changes()
+        except Exception as e:
+            print('Error publishing front page events: {}'.format(e))
+
+
+def publish_changes():
+    feed = datasource.change_feed
+    trust_feed = feed is not None and feed.trusted and not feed.polling
+    with channels_lock:
+        stale = [c for c in channels.values() if c.dirty or not trust_feed]
+        for channel in stale:
+            channel.dirty = False
+    for channel in stale:
+        messages = channel.diff()
+        if messages:
+            with channels_lock:
+                channel.publish(messages)
+
+
+# Yields the text/event-stream body for one viewer
+def event_stream(namespace, files_url):
+    subscriber = subscribe(namespace, files_url)
+    try:
+        yield 'retry: {}\n\n'.format(POLL_SECONDS * 1000)
+        while True:
+            try:
+                message = subscriber.get(timeout=KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            if message is None:
+                return
+            name, data = message
+            yield 'event: {}\ndata: {}\n\n'.format(name, json.dumps(data))
+    finally:
+        unsubscribe(namespace, files_url, subscriber)
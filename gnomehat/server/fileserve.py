@@ -0,0 +1,126 @@
+# Serve large experiment files (checkpoints, videos, multi-GB stdout.txt) with HTTP Range support
+# Downloads can resume, and under a server that provides wsgi.file_wrapper (eg. gunicorn)
+# the bytes are sent with sendfile() instead of being copied through Python.
+# Optionally the response only names the file, and a fronting proxy sends it (FILE_OFFLOAD).
+import os
+import datetime
+import mimetypes
+import urllib.parse
+import flask
+import pytz
+
+from gnomehat.server import config
+
+CHUNK_SIZE = 1024 * 1024
+TEXT_EXTENSIONS = ['txt', 'py', 'json', 'sh', 'c', 'gitignore', 'log']
+
+
+# A strong validator: any change to the file's content changes its size or mtime
+def file_etag(st):
+    return '{:x}-{:x}-{:x}'.format(st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def guess_mimetype(full_path):
+    extension = full_path.lower().split('.')[-1]
+    if extension in TEXT_EXTENSIONS:
+        return 'text/plain'
+    return mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+
+
+def serve_file(full_path, mimetype=None):
+    try:
+        st = os.stat(full_path)
+    except FileNotFoundError:
+        flask.abort(404)
+    mimetype = mimetype or guess_mimetype(full_path)
+    etag = file_etag(st)
+    last_modified = datetime.datetime.fromtimestamp(int(st.st_mtime), pytz.utc)
+
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    offload = config.get('FILE_OFFLOAD')
+    if offload:
+        response = offload_response(offload, full_path, mimetype)
+    else:
+        response = range_response(full_path, st.st_size, etag, last_modified, mimetype)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
+
+# The proxy handles Range requests itself
+def offload_response(offload, full_path, mimetype):
+    response = flask.Response(mimetype=mimetype)
+    if offload == 'x-accel-redirect':
+        # nginx decodes the URI, so names with spaces, '%', '?' or '#' in them reach the right file
+        relative_path = urllib.parse.quote(os.path.relpath(full_path, config['EXPERIMENTS_DIR']))
+        response.headers['X-Accel-Redirect'] = config['FILE_OFFLOAD_PREFIX'].rstrip('/') + '/' + relative_path
+    elif offload == 'x-sendfile':
+        response.headers['X-Sendfile'] = os.path.abspath(full_path)
+    else:
+        raise ValueError('Unknown FILE_OFFLOAD mode {}'.format(offload))
+    return response
+
+
+def range_response(full_path, size, etag, last_modified, mimetype):
+    start, stop = 0, size
+    status = 200
+    byte_range = flask.request.range
+    if byte_range is not None and if_range_matches(etag, last_modified):
+        # Multiple ranges are allowed to be answered with the whole file
+        if len(byte_range.ranges) == 1:
+            bounds = byte_range.range_for_length(size)
+            if bounds is None:
+                response = flask.Response(status=416)
+                response.headers['Content-Range'] = 'bytes */{}'.format(size)
+                return response
+            start, stop = bounds
+            status = 206
+
+    fp = open(full_path, 'rb')
+    fp.seek(start)
+    response = flask.Response(file_body(fp, stop - start), status=status, mimetype=mimetype,
+                              direct_passthrough=True)
+    response.content_length = stop - start
+    if status == 206:
+        response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1, size)
+    return response
+
+
+# Without If-Range, a Range request always applies; with it, only if the file is unchanged
+def if_range_matches(etag, last_modified):
+    if_range = flask.request.if_range
+    if not flask.request.headers.get('If-Range'):
+        return True
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    return if_range.date is not None and if_range.date >= last_modified
+
+
+# The server's file_wrapper can use sendfile(), sending exactly Content-Length bytes
+# from the current file position. Otherwise, copy through Python a chunk at a time.
+def file_body(fp, length):
+    file_wrapper = flask.request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None and not is_werkzeug_wrapper(file_wrapper):
+        return file_wrapper(fp, CHUNK_SIZE)
+    return read_chunks(fp, length)
+
+
+def is_werkzeug_wrapper(file_wrapper):
+    return getattr(file_wrapper, '__module__', '').startswith('werkzeug')
+
+
+def read_chunks(fp, length):
+    try:
+        while length > 0:
+            chunk = fp.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        fp.close()
@@ -0,0 +1,182 @@
+# A persistent index of experiment metadata, stored as SQLite in EXPERIMENTS_DIR
+# Crawling every experiment directory on every page load is slow (especially on NFS)
+# Instead, datasource.refresh_index() re-reads only the experiments that changed,
+# and the UI reads everything else from here.
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from gnomehat.server import config
+
+INDEX_FILENAME = '.gnomehat_index.sqlite'
+
+# Bump this whenever the schema or the contents of a record change
+SCHEMA_VERSION = 3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS experiments (
+    namespace TEXT NOT NULL,
+    experiment_id TEXT NOT NULL,
+    dir_mtime REAL NOT NULL,
+    fingerprint TEXT NOT NULL,
+    visible INTEGER NOT NULL,
+    settled INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    record TEXT NOT NULL,
+    PRIMARY KEY (namespace, experiment_id)
+);
+CREATE INDEX IF NOT EXISTS experiments_by_mtime ON experiments (namespace, dir_mtime);
+CREATE TABLE IF NOT EXISTS namespaces (
+    namespace TEXT PRIMARY KEY,
+    dir_mtime REAL NOT NULL,
+    generation INTEGER NOT NULL DEFAULT 0,
+    changed_at REAL
+);
+'''
+
+_local = threading.local()
+
+
+def index_path():
+    return config.get('METADATA_INDEX_PATH') or os.path.join(config['EXPERIMENTS_DIR'], INDEX_FILENAME)
+
+
+def enabled():
+    return bool(config.get('METADATA_INDEX'))
+
+
+# SQLite connections can't be shared between threads, so keep one per thread
+def connect():
+    path = index_path()
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.path == path:
+        return conn
+    conn = sqlite3.connect(path, timeout=30)
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version != SCHEMA_VERSION:
+        # The index is only a cache: throw it away and rebuild it from the filesystem
+        print('Rebuilding metadata index {} (version {} -> {})'.format(path, version, SCHEMA_VERSION))
+        conn.executescript('DROP TABLE IF EXISTS experiments; DROP TABLE IF EXISTS namespaces;')
+        conn.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+    conn.executescript(SCHEMA)
+    conn.commit()
+    _local.conn = conn
+    _local.path = path
+    return conn
+
+
+def get_namespace_mtime(namespace):
+    row = connect().execute('SELECT dir_mtime FROM namespaces WHERE namespace=?',
+                            (namespace,)).fetchone()
+    return row[0] if row else None
+
+
+def set_namespace_mtime(namespace, dir_mtime):
+    conn = connect()
+    with conn:
+        conn.execute('INSERT OR IGNORE INTO namespaces (namespace, dir_mtime) VALUES (?, ?)',
+                     (namespace, dir_mtime))
+        conn.execute('UPDATE namespaces SET dir_mtime=? WHERE namespace=?',
+                     (dir_mtime, namespace))
+
+
+# The generation of a namespace increases every time any of its experiments change
+# Returns (generation, time of the last change)
+def get_generation(namespace):
+    row = connect().execute('SELECT generation, changed_at FROM namespaces WHERE namespace=?',
+                            (namespace,)).fetchone()
+    return row if row else (0, None)
+
+
+def bump_generation(conn, namespace):
+    conn.execute('INSERT OR IGNORE INTO namespaces (namespace, dir_mtime) VALUES (?, -1)',
+                 (namespace,))
+    conn.execute('UPDATE namespaces SET generation=generation + 1, changed_at=? WHERE namespace=?',
+                 (time.time(), namespace))
+
+
+# Returns {experiment_id: (fingerprint, settled)} for every indexed experiment
+def get_fingerprints(namespace):
+    rows = connect().execute('SELECT experiment_id, fingerprint, settled FROM experiments WHERE namespace=?',
+                             (namespace,))
+    return {eid: (fingerprint, bool(settled)) for eid, fingerprint, settled in rows}
+
+
+def put_records(namespace, records):
+    if not records:
+        return
+    conn = connect()
+    with conn:
+        bump_generation(conn, namespace)
+        conn.executemany('''INSERT OR REPLACE INTO experiments
+            (namespace, experiment_id, dir_mtime, fingerprint, visible, settled, status, record)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', [(
+                namespace,
+                eid,
+                record['timestamp'],
+                fingerprint,
+                int(record['visible']),
+                int(record['settled']),
+                record['status'],
+                json.dumps(record),
+            ) for eid, fingerprint, record in records])
+
+
+def delete_records(namespace, experiment_ids):
+    if not experiment_ids:
+        return
+    conn = connect()
+    with conn:
+        bump_generation(conn, namespace)
+        conn.executemany('DELETE FROM experiments WHERE namespace=? AND experiment_id=?',
+                         [(namespace, eid) for eid in experiment_ids])
+
+
+# Force the next refresh to re-read this experiment from the filesystem
+def mark_stale(namespace, experiment_id):
+    conn = connect()
+    with conn:
+        conn.execute("UPDATE experiments SET fingerprint='', settled=0 WHERE namespace=? AND experiment_id=?",
+                     (namespace, experiment_id))
+
+
+# Returns records newest first; before is an optional (timestamp, experiment_id) to page from
+def query_records(namespace, limit=None, visible_only=True, before=None):
+    sql = 'SELECT record FROM experiments WHERE namespace=?'
+    params = [namespace]
+    if visible_only:
+        sql += ' AND visible=1'
+    if before is not None:
+        sql += ' AND (dir_mtime < ? OR (dir_mtime = ? AND experiment_id < ?))'
+        params.extend([before[0], before[0], before[1]])
+    sql += ' ORDER BY dir_mtime DESC, experiment_id DESC'
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    return [json.loads(row[0]) for row in connect().execute(sql, params)]
+
+
+# Returns {experiment_id: record} for the given experiments
+def get_records(namespace, experiment_ids):
+    conn = connect()
+    records = {}
+    for eid in experiment_ids:
+        row = conn.execute('SELECT record FROM experiments WHERE namespace=? AND experiment_id=?',
+                           (namespace, eid)).fetchone()
+        if row:
+            records[eid] = json.loads(row[0])
+    return records
+
+
+def count_experiments(namespace):
+    return connect().execute('SELECT COUNT(*) FROM experiments WHERE namespace=?',
+                             (namespace,)).fetchone()[0]
+
+
+# Returns {status: number of experiments}
+def count_statuses(namespace):
+    rows = connect().execute('SELECT status, COUNT(*) FROM experiments WHERE namespace=? GROUP BY status',
+                             (namespace,))
+    return dict(rows.fetchall())
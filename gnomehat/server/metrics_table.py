@@ -0,0 +1,119 @@
+# A columnar, in-memory table of the latest metrics (.last_summary.json) of every experiment in a namespace
+# Each numeric metric is a NumPy array plus a mask of which experiments have it,
+# so sorting and filtering 10k experiments doesn't touch 10k Python dicts.
+# Rows are updated one experiment at a time; the columns are rebuilt lazily when any row changed.
+import numbers
+import numpy as np
+
+# Sort by this key to order experiments by name
+EXPERIMENT_ID = 'experiment_id'
+
+
+class Column(object):
+    def __init__(self, name, values, mask, numeric):
+        self.name = name
+        self.values = values
+        self.mask = mask
+        self.numeric = numeric
+
+
+class MetricsTable(object):
+    def __init__(self):
+        self.rows = {}
+        self.generation = None
+        self.columns = None
+
+    def version(self, experiment_id):
+        row = self.rows.get(experiment_id)
+        return row['version'] if row else None
+
+    def update(self, experiment_id, version, timestamp, metrics, notes):
+        self.rows[experiment_id] = {
+            'version': version,
+            'timestamp': timestamp,
+            'metrics': metrics,
+            'notes': notes,
+        }
+        self.columns = None
+
+    # Drop every experiment not in experiment_ids
+    def retain(self, experiment_ids):
+        removed = set(self.rows) - set(experiment_ids)
+        for eid in removed:
+            del self.rows[eid]
+        if removed:
+            self.columns = None
+
+    def keys(self):
+        self.build()
+        return sorted(self.columns)
+
+    def build(self):
+        if self.columns is not None:
+            return
+        # Newest experiments first, by default
+        ids = sorted(self.rows, key=lambda eid: (self.rows[eid]['timestamp'], eid), reverse=True)
+        self.ids = ids
+        self.id_column = Column(EXPERIMENT_ID, np.array(ids, dtype=object), np.ones(len(ids), dtype=bool), False)
+        self.columns = {}
+        names = set(k for row in self.rows.values() for k in row['metrics'])
+        for name in names:
+            raw = [self.rows[eid]['metrics'].get(name) for eid in ids]
+            numeric = [is_number(v) for v in raw]
+            if any(numeric):
+                values = np.array([float(v) if n else np.nan for v, n in zip(raw, numeric)], dtype=np.float64)
+                self.columns[name] = Column(name, values, np.array(numeric, dtype=bool), True)
+            else:
+                mask = np.array([v is not None for v in raw], dtype=bool)
+                values = np.array(['' if v is None else str(v) for v in raw], dtype=object)
+                self.columns[name] = Column(name, values, mask, False)
+        notes = [self.rows[eid]['notes'] for eid in ids]
+        self.columns['notes'] = Column('notes', np.array(notes, dtype=object),
+                                       np.array([bool(n) for n in notes], dtype=bool), False)
+
+    # Returns (number of matching experiments, [experiment ids on the requested page])
+    # filters is a list of (key, min, max), where either bound may be None
+    def query(self, sort=None, descending=False, filters=(), offset=0, limit=None):
+        self.build()
+        selected = np.ones(len(self.ids), dtype=bool)
+        for key, low, high in filters:
+            column = self.columns.get(key)
+            if column is None or not column.numeric:
+                raise ValueError('Cannot filter on non-numeric metric {}'.format(key))
+            selected &= column.mask
+            with np.errstate(invalid='ignore'):
+                if low is not None:
+                    selected &= column.values >= low
+                if high is not None:
+                    selected &= column.values <= high
+        rows = np.flatnonzero(selected)
+
+        if sort is not None:
+            column = self.id_column if sort == EXPERIMENT_ID else self.columns.get(sort)
+            if column is None:
+                raise ValueError('Unknown metric {}'.format(sort))
+            present = rows[column.mask[rows]]
+            missing = rows[~column.mask[rows]]
+            order = np.argsort(column.values[present], kind='stable')
+            if descending:
+                order = order[::-1]
+            # Experiments without this metric always go last
+            rows = np.concatenate([present[order], missing])
+
+        total = len(rows)
+        end = None if limit is None else offset + limit
+        return total, [self.ids[i] for i in rows[offset:end]]
+
+    def row(self, experiment_id, number_format=None):
+        row = self.rows[experiment_id]
+        items = dict(row['metrics'])
+        if number_format:
+            for k in items:
+                if isinstance(items[k], float):
+                    items[k] = number_format % items[k]
+        items['notes'] = row['notes']
+        return items
+
+
+def is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
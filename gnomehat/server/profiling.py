@@ -0,0 +1,203 @@
+# Profile any single request on demand, eg. /default?_profile=1
+#   _profile=cprofile (or 1): deterministic profile of the request's thread, saved as a .prof file for pstats/snakeviz
+#   _profile=sample: a sampling profiler, saved as collapsed stacks for flamegraph.pl/speedscope
+#   _profile=both
+# The X-Gnomehat-Profile header works the same as the query flag.
+# Only admins may profile: requests from localhost, or carrying ADMIN_TOKEN as X-Gnomehat-Admin-Token.
+import os
+import io
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import collections
+import flask
+
+from gnomehat.server import config
+
+PROFILES_DIRNAME = '.gnomehat_profiles'
+PROFILES_KEPT = 100
+SAMPLE_INTERVAL_SECONDS = 0.002
+TOP_FUNCTIONS = 15
+LOCAL_ADDRESSES = ['127.0.0.1', '::1']
+MODES = {
+    '1': ['cprofile'],
+    'cprofile': ['cprofile'],
+    'sample': ['sample'],
+    'both': ['cprofile', 'sample'],
+}
+
+current = threading.local()
+
+
+def profiles_dir():
+    return os.path.join(config['EXPERIMENTS_DIR'], PROFILES_DIRNAME)
+
+
+def is_admin():
+    token = config.get('ADMIN_TOKEN')
+    if token and flask.request.headers.get('X-Gnomehat-Admin-Token') == token:
+        return True
+    # Behind a proxy on the same machine every request looks local
+    if 'X-Forwarded-For' in flask.request.headers:
+        return False
+    return flask.request.remote_addr in LOCAL_ADDRESSES
+
+
+def requested_modes():
+    flag = flask.request.args.get('_profile') or flask.request.headers.get('X-Gnomehat-Profile')
+    return MODES.get(flag)
+
+
+# Collects call stacks of one thread by looking at it from another thread every few milliseconds
+class Sampler(object):
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(SAMPLE_INTERVAL_SECONDS):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}:{}'.format(os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return ''.join('{} {}\n'.format(stack, n) for stack, n in self.stacks.most_common())
+
+
+def begin_request():
+    current.profile = None
+    modes = requested_modes()
+    if modes is None:
+        return
+    if not is_admin():
+        flask.abort(403)
+    profile = {'modes': modes, 'started_at': time.time()}
+    if 'sample' in modes:
+        profile['sampler'] = Sampler(threading.get_ident())
+        profile['sampler'].start()
+    if 'cprofile' in modes:
+        profile['cprofile'] = cProfile.Profile()
+        profile['cprofile'].enable()
+    current.profile = profile
+
+
+def end_request(response):
+    profile = getattr(current, 'profile', None)
+    if profile is None:
+        return response
+    current.profile = None
+    if 'cprofile' in profile:
+        profile['cprofile'].disable()
+    if 'sampler' in profile:
+        profile['sampler'].stop()
+    name = save_profile(profile, flask.request.endpoint or 'not_found')
+    response.headers['X-Gnomehat-Profile'] = name
+    return response
+
+
+def save_profile(profile, route):
+    os.makedirs(profiles_dir(), exist_ok=True)
+    started_at = profile['started_at']
+    name = '{}_{}_{:03d}'.format(route, time.strftime('%Y%m%d-%H%M%S', time.localtime(started_at)),
+                                 int(started_at * 1000) % 1000)
+    if 'cprofile' in profile:
+        profile['cprofile'].dump_stats(os.path.join(profiles_dir(), name + '.prof'))
+    if 'sampler' in profile:
+        with open(os.path.join(profiles_dir(), name + '.collapsed'), 'w') as fp:
+            fp.write(profile['sampler'].collapsed())
+    remove_old_profiles()
+    return name
+
+
+def remove_old_profiles():
+    filenames = sorted(list_profile_files(), key=lambda f: os.path.getmtime(os.path.join(profiles_dir(), f)))
+    for filename in filenames[:-PROFILES_KEPT]:
+        try:
+            os.remove(os.path.join(profiles_dir(), filename))
+        except FileNotFoundError:
+            pass
+
+
+def list_profile_files():
+    try:
+        return [f for f in os.listdir(profiles_dir()) if f.endswith('.prof') or f.endswith('.collapsed')]
+    except FileNotFoundError:
+        return []
+
+
+# Returns a list of recent profiles, newest first, each with its top functions by cumulative time
+def recent_profiles(limit=20):
+    filenames = sorted(list_profile_files(), reverse=True,
+                       key=lambda f: os.path.getmtime(os.path.join(profiles_dir(), f)))
+    profiles = []
+    for filename in filenames[:limit]:
+        path = os.path.join(profiles_dir(), filename)
+        try:
+            if filename.endswith('.prof'):
+                kind, total, top = 'cprofile', None, top_cprofile_functions(path)
+            else:
+                kind, (total, top) = 'sample', top_sampled_functions(path)
+        except (OSError, ValueError, EOFError) as e:
+            print('Failed to read profile {}: {}'.format(path, e))
+            continue
+        profiles.append({'filename': filename, 'kind': kind, 'samples': total, 'top': top})
+    return profiles
+
+
+# [(function, calls, cumulative seconds)]
+def top_cprofile_functions(path):
+    stats = pstats.Stats(path, stream=io.StringIO())
+    rows = []
+    for (filename, line, name), (cc, nc, tt, ct, callers) in stats.stats.items():
+        rows.append(('{}:{}:{}'.format(os.path.basename(filename), line, name), nc, ct))
+    rows.sort(key=lambda row: -row[2])
+    return rows[:TOP_FUNCTIONS]
+
+
+# Returns (total samples, [(function, samples, fraction of samples)]), counting a function once per stack
+def top_sampled_functions(path):
+    counts = collections.Counter()
+    total = 0
+    with open(path) as fp:
+        for line in fp:
+            stack, n = line.rsplit(' ', 1)
+            n = int(n)
+            total += n
+            functions = set(frame.rsplit(':', 1)[0] for frame in stack.split(';'))
+            for function in functions:
+                counts[function] += n
+    return total, [(f, n, n / total) for f, n in counts.most_common(TOP_FUNCTIONS)]
+
+
+# If the request raised an exception, end_request never ran
+def teardown_request(exception):
+    profile = getattr(current, 'profile', None)
+    if profile is None:
+        return
+    current.profile = None
+    if 'cprofile' in profile:
+        profile['cprofile'].disable()
+    if 'sampler' in profile:
+        profile['sampler'].stop()
+
+
+def install(app):
+    app.before_request(begin_request)
+    app.after_request(end_request)
+    app.teardown_request(teardown_request)
@@ -0,0 +1,185 @@
+# Run the app under a real WSGI server, selected by GNOMEHAT_SERVER_MODE in gnomehat_config.json:
+#   'development': Flask's built-in debugging server (the default)
+#   'threaded': a fixed pool of SERVER_THREADS threads, needs nothing beyond Flask
+#   'gunicorn': SERVER_WORKERS prefork processes of SERVER_THREADS threads each (pip install gunicorn)
+# In the threaded and gunicorn modes the server writes its pid to gnomehat_server.pid,
+# and SIGHUP (sent by `gnomehat restart`) reloads it without dropping any connections.
+import os
+import sys
+import signal
+import atexit
+import threading
+import importlib.util
+import concurrent.futures
+
+from werkzeug import serving
+
+from gnomehat.server import app, config
+
+PIDFILE_NAME = 'gnomehat_server.pid'
+# Set on re-exec, so the reloaded server takes over the listening socket
+LISTEN_FD_ENV = 'GNOMEHAT_SERVER_FD'
+SERVER_MODES = ['development', 'threaded', 'gunicorn']
+
+
+def pidfile_path(experiments_dir):
+    return os.path.join(experiments_dir, PIDFILE_NAME)
+
+
+# Returns the pid of the running server, or None if there is none
+def read_pid(experiments_dir):
+    try:
+        with open(pidfile_path(experiments_dir)) as fp:
+            pid = int(fp.read().strip())
+        os.kill(pid, 0)
+        return pid
+    except (FileNotFoundError, ValueError, ProcessLookupError, PermissionError):
+        return None
+
+
+# Ask a running server to reload its code and config; returns False if it can't
+def request_reload(experiments_dir):
+    pid = read_pid(experiments_dir)
+    if pid is None:
+        return False
+    os.kill(pid, signal.SIGHUP)
+    return True
+
+
+def run_development(start_app):
+    start_app()
+    app.run(config.get('GNOMEHAT_BIND_IP'),
+            port=config.get('GNOMEHAT_PORT'),
+            debug=config.get('DEBUG'))
+
+
+class RequestHandler(serving.WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+
+# Werkzeug's server, but requests are handled by a bounded pool instead of a new thread each
+class PooledWSGIServer(serving.BaseWSGIServer):
+    multithread = True
+    reloading = False
+
+    def __init__(self, host, port, threads, fd=None):
+        super().__init__(host, port, app, handler=RequestHandler, fd=fd)
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        # Werkzeug listens on a duplicate of an inherited socket
+        if fd is not None:
+            os.close(fd)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    # Werkzeug closes the listening socket when serve_forever() returns, unless it's being handed on
+    def server_close(self):
+        if not self.reloading:
+            super().server_close()
+
+
+def run_threaded(start_app):
+    start_app()
+    # Idle keep-alive connections, and clients that stall mid-request, are dropped after this long
+    RequestHandler.timeout = config['SERVER_KEEPALIVE_SECONDS']
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    # Front page event streams hold a thread each, so they get threads of their own
+    threads = config['SERVER_THREADS'] + config['EVENT_STREAMS_MAX']
+    server = PooledWSGIServer(config['GNOMEHAT_BIND_IP'], config['GNOMEHAT_PORT'],
+                              threads, fd=int(fd) if fd else None)
+    write_pidfile(config['EXPERIMENTS_DIR'])
+    reload_requested = threading.Event()
+
+    def on_sighup(signum, frame):
+        print('Received SIGHUP, reloading after in-flight requests finish')
+        reload_requested.set()
+        server.reloading = True
+        stop(server)
+
+    def on_sigterm(signum, frame):
+        stop(server)
+
+    signal.signal(signal.SIGHUP, on_sighup)
+    signal.signal(signal.SIGTERM, on_sigterm)
+    print('Serving on http://{}:{} with {} threads'.format(
+        config['GNOMEHAT_BIND_IP'], config['GNOMEHAT_PORT'], threads))
+    server.serve_forever()
+    server.pool.shutdown(wait=True)
+    if reload_requested.is_set():
+        # Keep the listening socket open across exec: new connections wait in its backlog
+        listen_fd = server.socket.fileno()
+        os.set_inheritable(listen_fd, True)
+        os.environ[LISTEN_FD_ENV] = str(listen_fd)
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+
+def stop(server):
+    # Event streams never finish by themselves
+    events = sys.modules.get('gnomehat.server.events')
+    if events is not None:
+        events.close_all()
+    # shutdown() waits for serve_forever() to return, so it can't run in the signal handler's thread
+    threading.Thread(target=server.shutdown).start()
+
+
+def write_pidfile(experiments_dir):
+    filename = pidfile_path(experiments_dir)
+    with open(filename, 'w') as fp:
+        fp.write(str(os.getpid()))
+
+    def remove_pidfile():
+        if read_pid(experiments_dir) == os.getpid():
+            os.remove(filename)
+    atexit.register(remove_pidfile)
+
+
+def run_gunicorn(start_app):
+    from gunicorn.app.base import BaseApplication
+
+    class GunicornServer(BaseApplication):
+        def load_config(self):
+            threads = config['SERVER_THREADS'] + config['EVENT_STREAMS_MAX']
+            options = {
+                'bind': '{}:{}'.format(config['GNOMEHAT_BIND_IP'], config['GNOMEHAT_PORT']),
+                'workers': config['SERVER_WORKERS'],
+                'threads': threads,
+                'worker_class': 'gthread',
+                'keepalive': config['SERVER_KEEPALIVE_SECONDS'],
+                'timeout': config['SERVER_TIMEOUT_SECONDS'],
+                'graceful_timeout': config['SERVER_TIMEOUT_SECONDS'],
+                'pidfile': pidfile_path(config['EXPERIMENTS_DIR']),
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        # Runs in each worker process, so each gets its own change feed and index connections
+        def load(self):
+            start_app()
+            return app
+
+    GunicornServer().run()
+
+
+def run(start_app):
+    mode = config.get('GNOMEHAT_SERVER_MODE') or 'development'
+    if mode not in SERVER_MODES:
+        raise ValueError('Unknown GNOMEHAT_SERVER_MODE {}, expected one of {}'.format(mode, SERVER_MODES))
+    if mode == 'gunicorn':
+        if importlib.util.find_spec('gunicorn') is None:
+            print('Warning: gunicorn is not installed (pip install gunicorn), using the threaded server')
+            mode = 'threaded'
+    print('Starting gnomehat server in {} mode'.format(mode))
+    if mode == 'gunicorn':
+        run_gunicorn(start_app)
+    elif mode == 'threaded':
+        run_threaded(start_app)
+    else:
+        run_development(start_app)
@@ -0,0 +1,224 @@
+# In-process latency statistics, served in Prometheus text format at /_stats
+# Every request is timed by route, and the main datasource functions by name, into fixed histogram buckets.
+# An audit hook counts the files opened, directories listed and subprocesses started by each request,
+# including by threads working for it (see run_as_part_of). There is no audit event for stat(), so
+# os.stat, os.path.isdir, os.path.getmtime and friends are not counted.
+# Requests slower than SLOW_REQUEST_SECONDS are logged with a breakdown of where the time went.
+import sys
+import time
+import bisect
+import inspect
+import functools
+import threading
+import collections
+import flask
+
+from gnomehat.server import config
+
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+# Audit events counted per request (see https://docs.python.org/3/library/audit_events.html)
+AUDIT_EVENTS = {
+    'open': 'open',
+    'os.listdir': 'listdir',
+    'os.scandir': 'scandir',
+    'subprocess.Popen': 'subprocess',
+    'os.system': 'subprocess',
+    'os.posix_spawn': 'subprocess',
+}
+SLOW_REQUESTS_KEPT = 50
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+lock = threading.Lock()
+request_seconds = collections.defaultdict(Histogram)
+function_seconds = collections.defaultdict(Histogram)
+request_calls = collections.Counter()
+slow_requests = collections.deque(maxlen=SLOW_REQUESTS_KEPT)
+collectors = []
+current = threading.local()
+installed = False
+
+
+def observe(histograms, key, value):
+    with lock:
+        histograms[key].observe(value)
+
+
+# Per-request accounting lives on the thread serving the request, and any threads working for it
+def begin_request():
+    current.start = time.perf_counter()
+    current.functions = collections.defaultdict(lambda: [0, 0.0])
+    current.calls = collections.Counter()
+    current.lock = threading.Lock()
+
+
+def end_request(route, status):
+    if getattr(current, 'start', None) is None:
+        return None
+    elapsed = time.perf_counter() - current.start
+    with current.lock:
+        calls = collections.Counter(current.calls)
+        functions = {name: list(entry) for name, entry in current.functions.items()}
+    current.start = None
+    with lock:
+        request_seconds[route].observe(elapsed)
+        for call, n in calls.items():
+            request_calls[(route, call)] += n
+    if elapsed >= config.get('SLOW_REQUEST_SECONDS', 1.0):
+        log_slow_request(route, status, elapsed, functions, calls)
+    return elapsed
+
+
+def log_slow_request(route, status, elapsed, functions, calls):
+    entry = {
+        'time': time.time(),
+        'url': flask.request.full_path.rstrip('?') if flask.has_request_context() else None,
+        'route': route,
+        'status': status,
+        'seconds': elapsed,
+        'functions': sorted(((name, n, t) for name, (n, t) in functions.items()), key=lambda x: -x[2]),
+        'calls': dict(calls),
+    }
+    slow_requests.append(entry)
+    print('Slow request: {} {} took {:.2f} sec'.format(entry['url'], status, elapsed))
+    if calls:
+        print('\t' + ', '.join('{} {}'.format(n, c) for c, n in sorted(calls.items())))
+    for name, n, seconds in entry['functions'][:10]:
+        print('\t{:.3f} sec in {} calls to {}'.format(seconds, n, name))
+
+
+def audit_hook(event, args):
+    call = AUDIT_EVENTS.get(event)
+    if call is not None and getattr(current, 'start', None) is not None:
+        with current.lock:
+            current.calls[call] += 1
+
+
+# The accounting of the request being served by this thread, or None
+def request_context():
+    if getattr(current, 'start', None) is None:
+        return None
+    return current.start, current.functions, current.calls, current.lock
+
+
+# Runs fn(*args) on a pool thread, counting its calls and time against the request that handed it over
+def run_as_part_of(context, fn, *args):
+    if context is None:
+        return fn(*args)
+    saved = tuple(getattr(current, attr, None) for attr in ['start', 'functions', 'calls', 'lock'])
+    current.start, current.functions, current.calls, current.lock = context
+    try:
+        return fn(*args)
+    finally:
+        current.start, current.functions, current.calls, current.lock = saved
+
+
+def timed(name, fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            observe(function_seconds, name, elapsed)
+            if getattr(current, 'start', None) is not None:
+                with current.lock:
+                    entry = current.functions[name]
+                    entry[0] += 1
+                    entry[1] += elapsed
+    wrapper.untimed = fn
+    return wrapper
+
+
+# Replace the named functions of module with timed versions
+# Only name entry points and I/O: timing costs a few microseconds a call, too much for small helpers.
+# Calls between functions of the module go through the module globals, so they're timed too
+def instrument_module(module, names):
+    prefix = module.__name__.split('.')[-1]
+    for name in names:
+        fn = getattr(module, name)
+        if not inspect.isfunction(fn) or hasattr(fn, 'untimed'):
+            continue
+        setattr(module, name, timed('{}.{}'.format(prefix, name), fn))
+
+
+# A collector returns a list of (metric name, type, help, [(labels dict, value)])
+def add_collector(collector):
+    collectors.append(collector)
+
+
+def install(app):
+    global installed
+    if installed:
+        return
+    installed = True
+    # Audit hooks can't be removed, so this only ever happens once per process
+    sys.addaudithook(audit_hook)
+
+    @app.before_request
+    def before_request():
+        begin_request()
+
+    @app.after_request
+    def after_request(response):
+        end_request(flask.request.endpoint or 'not_found', response.status_code)
+        return response
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in sorted(labels.items())) + '}'
+
+
+def format_histograms(name, help_text, label, histograms):
+    lines = ['# HELP {} {}'.format(name, help_text), '# TYPE {} histogram'.format(name)]
+    for key, h in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ['+Inf'], h.counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(name, format_labels({label: key, 'le': bound}), cumulative))
+        lines.append('{}_sum{} {}'.format(name, format_labels({label: key}), h.sum))
+        lines.append('{}_count{} {}'.format(name, format_labels({label: key}), h.count))
+    return lines
+
+
+def prometheus_text():
+    with lock:
+        requests = {k: copy_histogram(h) for k, h in request_seconds.items()}
+        functions = {k: copy_histogram(h) for k, h in function_seconds.items()}
+        calls = dict(request_calls)
+    lines = []
+    lines += format_histograms('gnomehat_request_seconds', 'Time to handle a request, by route', 'route', requests)
+    lines += format_histograms('gnomehat_function_seconds', 'Time spent in a function, including nested calls',
+                               'function', functions)
+    lines += ['# HELP gnomehat_request_calls_total Files opened, directories listed and subprocesses run by requests '
+              '(stat calls are not counted)',
+              '# TYPE gnomehat_request_calls_total counter']
+    for (route, call), n in sorted(calls.items()):
+        lines.append('gnomehat_request_calls_total{} {}'.format(format_labels({'route': route, 'call': call}), n))
+    for collector in collectors:
+        for name, metric_type, help_text, samples in collector():
+            lines += ['# HELP {} {}'.format(name, help_text), '# TYPE {} {}'.format(name, metric_type)]
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(name, format_labels(labels), value))
+    return '\n'.join(lines) + '\n'
+
+
+def copy_histogram(h):
+    copy = Histogram()
+    copy.counts, copy.sum, copy.count = list(h.counts), h.sum, h.count
+    return copy
@@ -0,0 +1,158 @@
+# Downscaled previews of experiment images, so a page of cards doesn't download every full-size sample
+# Thumbnails are generated in a process pool and kept in a size-bounded cache directory,
+# keyed by (path, mtime, size) so a rewritten image gets a fresh thumbnail.
+import os
+import io
+import hashlib
+import threading
+import concurrent.futures
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from gnomehat.server import config
+
+CACHE_DIRNAME = '.gnomehat_thumbnails'
+THUMBNAIL_SIZES = [64, 128, 256, 512]
+GENERATE_TIMEOUT_SECONDS = 30
+
+pool = None
+in_flight = {}
+lock = threading.Lock()
+cache_bytes = None
+
+
+def available():
+    return Image is not None
+
+
+def cache_dir():
+    return config.get('THUMBNAIL_CACHE_DIR') or os.path.join(config['EXPERIMENTS_DIR'], CACHE_DIRNAME)
+
+
+# Round a requested size up to one of a few fixed sizes, so the cache can't be flooded
+def normalize_size(size):
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        return None
+    for allowed in THUMBNAIL_SIZES:
+        if size <= allowed:
+            return allowed
+    return THUMBNAIL_SIZES[-1]
+
+
+def choose_format(accept_header):
+    if 'image/webp' in (accept_header or '') and webp_supported():
+        return 'webp'
+    return 'jpeg'
+
+
+def webp_supported():
+    return available() and 'WEBP' in Image.registered_extensions().values()
+
+
+# Returns the filename of a cached thumbnail of full_path, generating it if necessary
+# Returns None if no thumbnail could be made, in which case the caller should serve the original
+def get_thumbnail(full_path, size, fmt='jpeg'):
+    if not available():
+        return None
+    st = os.stat(full_path)
+    key = '{}:{}:{}:{}:{}'.format(os.path.abspath(full_path), st.st_mtime_ns, st.st_size, size, fmt)
+    filename = os.path.join(cache_dir(), '{}.{}'.format(hashlib.sha1(key.encode('utf-8')).hexdigest(), fmt))
+    try:
+        # Bump the mtime: eviction removes the least recently used thumbnails first
+        os.utime(filename)
+        return filename
+    except FileNotFoundError:
+        # Never made, or evicted by another request: make it again
+        pass
+
+    with lock:
+        future = in_flight.get(filename)
+        if future is None:
+            future = get_pool().submit(make_thumbnail, full_path, filename, size, fmt)
+            in_flight[filename] = future
+    try:
+        thumbnail_bytes = future.result(timeout=GENERATE_TIMEOUT_SECONDS)
+    except Exception as e:
+        print('Failed to generate thumbnail of {}: {}'.format(full_path, e))
+        return None
+    finally:
+        with lock:
+            in_flight.pop(filename, None)
+    add_to_cache(filename, thumbnail_bytes)
+    return filename
+
+
+def get_pool():
+    global pool
+    if pool is None:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=config.get('THUMBNAIL_WORKERS') or None)
+    return pool
+
+
+# Runs in a worker process: returns the size of the thumbnail written to filename
+def make_thumbnail(full_path, filename, size, fmt):
+    img = Image.open(full_path)
+    img.draft('RGB', (size, size))
+    img.thumbnail((size, size))
+    if img.mode not in ['RGB', 'L']:
+        img = img.convert('RGB')
+    buf = io.BytesIO()
+    img.save(buf, fmt, quality=85)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # Write atomically so readers never see a half-written thumbnail
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp_filename, 'wb') as fp:
+        fp.write(buf.getvalue())
+    os.rename(tmp_filename, filename)
+    return len(buf.getvalue())
+
+
+def add_to_cache(filename, thumbnail_bytes):
+    global cache_bytes
+    with lock:
+        if cache_bytes is None:
+            cache_bytes = sum(size for path, mtime, size in list_cache())
+        cache_bytes += thumbnail_bytes
+        over_budget = cache_bytes > config.get('THUMBNAIL_CACHE_MB', 1024) * 1024 * 1024
+    if over_budget:
+        evict(keep=filename)
+
+
+# Delete the least recently used thumbnails until the cache is at 90% of its budget
+def evict(keep=None):
+    global cache_bytes
+    budget = 0.9 * config.get('THUMBNAIL_CACHE_MB', 1024) * 1024 * 1024
+    entries = sorted(list_cache(), key=lambda x: x[1])
+    total = sum(size for path, mtime, size in entries)
+    for path, mtime, size in entries:
+        if total <= budget:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+    with lock:
+        cache_bytes = total
+
+
+def list_cache():
+    try:
+        entries = list(os.scandir(cache_dir()))
+    except FileNotFoundError:
+        return []
+    result = []
+    for entry in entries:
+        try:
+            st = entry.stat()
+        except FileNotFoundError:
+            continue
+        result.append((entry.path, st.st_mtime, st.st_size))
+    return result
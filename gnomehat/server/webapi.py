@@ -1,7 +1,10 @@
 # This file should contain all the @routes for the app
 # Every HTTP endpoint should be neatly lined up right here
+import io
+import csv
 import shutil
 import time
+import hashlib
 import socket
 import random
 import base64
@@ -14,11 +17,27 @@ import sys
 import pytz
 import subprocess
 
-from gnomehat import sysinfo, server_config
-from gnomehat.server import app, config
+from gnomehat import sysinfo, server_config, jobqueue
+from gnomehat.server import app, config, arg
 
-from gnomehat.server import datasource
-from gnomehat.server.datasource import get_results, get_images, get_all_experiment_metrics, get_directory_listing, get_worker_count, get_namespaces
+from gnomehat.server import datasource, downsample, events, fileserve, profiling, stats, thumbnails
+from gnomehat.server.cache import LRUCache
+from gnomehat.server.datasource import get_images, get_worker_count, get_namespaces
+
+MAX_API_RESULTS = 1000
+METRICS_PAGE_SIZE = 100
+LISTING_PAGE_SIZE = 1000
+TIMESERIES_POINTS = 500
+MAX_TIMESERIES_POINTS = 10000
+MAX_QUEUE_ROWS = 1000
+
+GALLERY_THUMBNAIL_SIZE = 512
+
+# Recently rendered pages, keyed by (url, fingerprint)
+render_cache = LRUCache(64)
+
+stats.install(app)
+profiling.install(app)
 
 
 @app.route('/')
@@ -34,21 +53,135 @@ def favicon():
 # TODO: Surely no one will ever create a namespace named 'metrics' or 'experiment'
 @app.route('/<namespace>')
 def front_page_namespace(namespace):
-    start_time = time.time()
     files_url = get_files_url()
     selectable_namespaces = get_namespaces(flask.request.url_root)
     for ns in selectable_namespaces:
         ns['selected'] = 'selected' if ns['name'].lower() == namespace.lower() else ''
-    kwargs = {
-        'results': get_results(files_url, namespace),
-        'files_url': files_url,
-        'worker_count': get_worker_count(),
-        'server_title': datasource.get_server_title(),
-        'namespaces': selectable_namespaces,
-    }
-    print("Generated results for front page in {:.2f} sec".format(
-        time.time() - start_time))
-    return flask.render_template('index.html', **kwargs)
+    worker_count = get_worker_count()
+    cursor = arg('cursor')
+    fingerprint = get_fingerprint_or_404(namespace, cursor, config['MAX_RESULTS_PER_PAGE'] + 1)
+
+    def render():
+        # Getting the fingerprint has just refreshed the index
+        page = get_results_page_or_400(files_url, namespace, cursor, refresh=False)
+        kwargs = {
+            'results': page['results'],
+            'next_cursor': page['next_cursor'],
+            'cursor': cursor,
+            'namespace': namespace,
+            'files_url': files_url,
+            'worker_count': worker_count,
+            'server_title': datasource.get_server_title(),
+            'namespaces': selectable_namespaces,
+        }
+        return flask.render_template('index.html', **kwargs)
+
+    return cached_page([fingerprint, selectable_namespaces, worker_count], render)
+
+
+# Serve a page that only depends on fingerprint, re-rendering it only when it changes
+# Browsers polling an unchanged page get a 304 Not Modified without any rendering at all
+# There is no Last-Modified: a page can change (eg. the worker count) without any experiment changing.
+def cached_page(fingerprint, render):
+    etag = hashlib.sha1(repr(fingerprint).encode('utf-8')).hexdigest()
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    key = (flask.request.url, etag)
+    body = render_cache.get(key)
+    if body is None:
+        body = render()
+        render_cache.put(key, body)
+    response = flask.make_response(body)
+    response.set_etag(etag)
+    # Allow caching, but always check with us first
+    response.cache_control.no_cache = True
+    return response.make_conditional(flask.request)
+
+
+def get_fingerprint_or_404(namespace, cursor=None, limit=None):
+    if not os.path.isdir(datasource.get_experiments_dir(namespace)):
+        flask.abort(404)
+    try:
+        return datasource.get_namespace_fingerprint(namespace, cursor, limit)[0]
+    except ValueError:
+        flask.abort(400)
+
+
+@app.route('/api/<namespace>/results')
+def api_results(namespace):
+    limit = arg('limit')
+    try:
+        limit = min(max(int(limit), 1), MAX_API_RESULTS) if limit else None
+    except ValueError:
+        flask.abort(400)
+    page = get_results_page_or_400(get_files_url(), namespace, arg('cursor'), limit)
+    return flask.jsonify(namespace=namespace, **page)
+
+
+# Server-sent events with the cards on the first page of a namespace that were added, changed or removed
+@app.route('/api/<namespace>/events')
+def api_events(namespace):
+    if not os.path.isdir(datasource.get_experiments_dir(namespace)):
+        flask.abort(404)
+    # Each open stream holds a server thread
+    if events.subscriber_count() >= config['EVENT_STREAMS_MAX']:
+        flask.abort(503)
+    response = flask.Response(events.event_stream(namespace, get_files_url()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/api/namespaces')
+def api_namespaces():
+    namespaces = get_namespaces(flask.request.url_root)
+    return flask.jsonify(namespaces=namespaces)
+
+
+# Full metric history of one or more experiments, downsampled for plotting
+# eg. /api/default/timeseries?experiments=a,b&keys=loss&points=500&method=lttb
+@app.route('/api/<namespace>/timeseries')
+def api_timeseries(namespace):
+    if not os.path.isdir(datasource.get_experiments_dir(namespace)):
+        flask.abort(404)
+    experiment_ids = [e for e in (arg('experiments') or '').split(',') if e]
+    keys = [k for k in (arg('keys') or '').split(',') if k]
+    points = min(max(parse_int_or_400(arg('points'), TIMESERIES_POINTS), 3), MAX_TIMESERIES_POINTS)
+    method = downsample.METHODS.get(arg('method') or 'lttb')
+    if not experiment_ids or method is None:
+        flask.abort(400)
+    result = {}
+    for eid in experiment_ids:
+        if '/' in eid or eid.startswith('.'):
+            flask.abort(400)
+        series = datasource.get_timeseries(namespace, eid)
+        result[eid] = {}
+        for key in keys or sorted(series):
+            if key not in series:
+                continue
+            steps, times, values = series[key]
+            selected = method(steps, values, points)
+            result[eid][key] = {
+                'length': len(steps),
+                'step': steps[selected].tolist(),
+                'time': times[selected].tolist(),
+                # NaN and infinity are not valid JSON
+                'value': [v if abs(v) < float('inf') else None for v in values[selected].tolist()],
+            }
+    return flask.jsonify(namespace=namespace, experiments=result)
+
+
+def get_results_page_or_400(files_url, namespace, cursor, limit=None, refresh=True):
+    if not os.path.isdir(datasource.get_experiments_dir(namespace)):
+        flask.abort(404)
+    try:
+        return datasource.get_results_page(files_url, namespace, cursor, limit, refresh=refresh)
+    except ValueError:
+        flask.abort(400)
 
 
 @app.route('/metrics')
@@ -60,21 +193,160 @@ def list_metrics():
 
 @app.route('/metrics/<namespace>')
 def view_metrics(namespace):
-    metrics = get_all_experiment_metrics(config['EXPERIMENTS_DIR'], namespace)
-    all_keys = set(k for experiment in metrics.values() for k in experiment.keys())
+    fingerprint = get_fingerprint_or_404(namespace)
+
+    def render():
+        table = datasource.get_metrics_table(namespace, refresh=False)
+        sort, descending, filters = parse_metrics_query()
+        page = parse_int_or_400(arg('page'), 0)
+        total, experiment_ids = query_metrics_or_400(table, sort, descending, filters,
+                                                     offset=page * METRICS_PAGE_SIZE,
+                                                     limit=METRICS_PAGE_SIZE)
+        metrics = {eid: table.row(eid, number_format='%.04f') for eid in experiment_ids}
+
+        # Move 'notes' to the rightmost column
+        all_keys = [k for k in table.keys() if k != 'notes']
+        all_keys.append('notes')
+
+        kwargs = {
+            'metrics': metrics,
+            'keys': all_keys,
+            'namespace': namespace,
+            'total': total,
+            'page': page,
+            'page_count': (total + METRICS_PAGE_SIZE - 1) // METRICS_PAGE_SIZE,
+            'sort': sort,
+            'descending': descending,
+            'filters': [f for f in flask.request.args.getlist('filter') if f],
+        }
+        return flask.render_template('metrics.html', **kwargs)
+
+    return cached_page(fingerprint, render)
+
+
+# Stream every matching row of the metrics table as CSV or JSON
+@app.route('/metrics/<namespace>/export')
+def export_metrics(namespace):
+    if not os.path.isdir(datasource.get_experiments_dir(namespace)):
+        flask.abort(404)
+    table = datasource.get_metrics_table(namespace)
+    sort, descending, filters = parse_metrics_query()
+    total, experiment_ids = query_metrics_or_400(table, sort, descending, filters)
+    keys = table.keys()
+
+    # Rows are read as they are sent, so a large export never holds them all at once
+    # An experiment deleted while the export is streaming is left out
+    def rows():
+        for eid in experiment_ids:
+            try:
+                yield eid, table.row(eid)
+            except KeyError:
+                continue
+
+    def generate_csv():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(['experiment_id'] + keys)
+        for eid, row in rows():
+            writer.writerow([eid] + [row.get(k, '') for k in keys])
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        yield buf.getvalue()
+
+    def generate_json():
+        yield '['
+        for i, (eid, row) in enumerate(rows()):
+            yield (',\n' if i else '\n') + json.dumps(dict(row, experiment_id=eid))
+        yield '\n]\n'
+
+    fmt = arg('format') or 'csv'
+    if fmt == 'csv':
+        response = flask.Response(generate_csv(), mimetype='text/csv')
+    elif fmt == 'json':
+        response = flask.Response(generate_json(), mimetype='application/json')
+    else:
+        flask.abort(400)
+    response.headers['Content-Disposition'] = 'attachment; filename={}_metrics.{}'.format(namespace, fmt)
+    return response
+
+
+# Metrics queries look like ?sort=loss&order=desc&filter=loss:0:0.5&filter=accuracy:0.9:
+def parse_metrics_query():
+    sort = arg('sort') or None
+    descending = arg('order') == 'desc'
+    filters = []
+    for text in flask.request.args.getlist('filter'):
+        if not text:
+            continue
+        try:
+            key, low, high = text.rsplit(':', 2)
+            filters.append((key, float(low) if low else None, float(high) if high else None))
+        except ValueError:
+            flask.abort(400)
+    return sort, descending, filters
+
+
+def query_metrics_or_400(table, sort, descending, filters, offset=0, limit=None):
+    try:
+        return table.query(sort, descending, filters, offset, limit)
+    except ValueError:
+        flask.abort(400)
 
-    # Move 'notes' to the rightmost column
-    if 'notes' in all_keys:
-        all_keys.remove('notes')
-    all_keys = list(sorted(all_keys))
-    all_keys.append('notes')
 
-    kwargs = {
-        'metrics': metrics,
-        'keys': all_keys,
-        'namespace': namespace,
-    }
-    return flask.render_template('metrics.html', **kwargs)
+def parse_int_or_400(value, default):
+    if not value:
+        return default
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        flask.abort(400)
+
+
+# Request latency and cache statistics, in Prometheus text format
+@app.route('/_stats')
+def view_stats():
+    return flask.Response(stats.prometheus_text(), mimetype='text/plain; version=0.0.4')
+
+
+# The most recent requests that took longer than SLOW_REQUEST_SECONDS, with a breakdown of each
+@app.route('/_stats/slow')
+def view_slow_requests():
+    return flask.jsonify(slow_requests=list(stats.slow_requests))
+
+
+# Recent request profiles, taken with ?_profile=1
+@app.route('/_profiles')
+def view_profiles():
+    if not profiling.is_admin():
+        flask.abort(403)
+    return flask.render_template('profiles.html', profiles=profiling.recent_profiles())
+
+
+@app.route('/_profiles/<filename>')
+def download_profile(filename):
+    if not profiling.is_admin():
+        flask.abort(403)
+    return flask.send_from_directory(profiling.profiles_dir(), filename, as_attachment=True)
+
+
+def collect_cache_stats():
+    cache_stats = render_cache.stats()
+    return [
+        ('gnomehat_render_cache_hits_total', 'counter', 'Pages served from the render cache',
+         [({}, cache_stats['hits'])]),
+        ('gnomehat_render_cache_misses_total', 'counter', 'Pages rendered from scratch',
+         [({}, cache_stats['misses'])]),
+        ('gnomehat_render_cache_size', 'gauge', 'Pages in the render cache',
+         [({}, cache_stats['size'])]),
+        ('gnomehat_card_loader_total', 'counter', 'Experiment directories read by the card loader',
+         [({'result': k}, v) for k, v in sorted(datasource.card_loader_stats.items())]),
+        ('gnomehat_event_streams', 'gauge', 'Open front page event streams',
+         [({}, events.subscriber_count())]),
+    ]
+
+
+stats.add_collector(collect_cache_stats)
 
 
 @app.route('/demos')
@@ -158,22 +430,39 @@ def static_file(path):
 # For a proper service this would be handled by eg. nginx
 @app.route('/experiments/<path:path>')
 def static_experiments_file(path):
-    if '../' in path:
+    if '..' in path.split('/'):
         print('Error: bad input path {}'.format(path))
         flask.abort(400)
     full_path = os.path.join(config['EXPERIMENTS_DIR'], path)
     if os.path.isdir(full_path):
-        listing = get_directory_listing(full_path)
-        return flask.render_template('listing.html',
-                                     files_url=get_files_url(),
-                                     listing=listing, cwd=path)
+        return render_listing(full_path, 'listing.html', files_url=get_files_url(), cwd=path)
+    elif arg('thumb') and datasource.has_image_extension(path):
+        size = thumbnails.normalize_size(arg('thumb'))
+        if size is None:
+            # Not a thumbnail size: serve the image itself, without queueing anything for the pool
+            return fileserve.serve_file(full_path)
+        return serve_thumbnail(path, size)
     else:
-        # Serve an ordinary file, defaulting to text
-        TEXT_EXTENSIONS = ['txt', 'py', 'json', 'sh', 'c', 'gitignore', 'log']
-        extension = path.lower().split('.')[-1]
-        mimetype = 'text/plain' if extension in TEXT_EXTENSIONS else None
-        return flask.send_from_directory(config['EXPERIMENTS_DIR'], path,
-                                         mimetype=mimetype)
+        # Serve an ordinary file, with support for resuming downloads
+        return fileserve.serve_file(full_path)
+
+
+# Serve a small preview of an image, or the image itself if no preview can be made
+def serve_thumbnail(path, size):
+    full_path = os.path.join(config['EXPERIMENTS_DIR'], path)
+    if not os.path.isfile(full_path):
+        flask.abort(404)
+    fmt = thumbnails.choose_format(flask.request.headers.get('Accept'))
+    filename = thumbnails.get_thumbnail(full_path, size, fmt)
+    if filename is None:
+        return fileserve.serve_file(full_path)
+    try:
+        response = flask.send_file(filename, mimetype='image/{}'.format(fmt))
+    except FileNotFoundError:
+        # Another request just evicted it from the cache
+        return fileserve.serve_file(full_path)
+    response.vary.add('Accept')
+    return response
 
 
 @app.route('/delete_job', methods=['POST'])
@@ -198,6 +487,7 @@ def stop_job():
     filename = os.path.join(config['EXPERIMENTS_DIR'], job_id, 'worker_finished')
     with open(filename, 'w') as fp:
         fp.write('OK')
+    datasource.invalidate_experiment(job_id)
     return 'OK'
 
 
@@ -210,9 +500,74 @@ def update_notes():
     print("Writing notes to {}".format(experiment_id))
     with open(os.path.join(dir_name, 'gnomehat_notes.txt'), 'w') as fp:
         fp.write(notes)
+    datasource.invalidate_experiment(experiment_id)
     return 'OK'
 
 
+@app.route('/set_priority', methods=['POST'])
+def set_priority():
+    print("Set priority: {}".format(flask.request.get_json()))
+    job_id = flask.request.get_json()['id'].replace('..', '')
+    try:
+        priority = int(flask.request.get_json()['priority'])
+    except (KeyError, TypeError, ValueError):
+        flask.abort(400)
+    namespace, _, experiment_id = job_id.partition('/')
+    dir_name = os.path.join(config['EXPERIMENTS_DIR'], namespace, experiment_id)
+    if not experiment_id or not os.path.isdir(dir_name):
+        flask.abort(404)
+    jobqueue.write_priority(dir_name, priority)
+    jobqueue.set_priority(config['EXPERIMENTS_DIR'], namespace, experiment_id, priority)
+    return 'OK'
+
+
+# Jobs waiting for a worker, in the order they will run, with a guess at when each will start
+@app.route('/queue')
+def view_queue():
+    estimates = jobqueue.queue_estimates(config['EXPERIMENTS_DIR'], MAX_QUEUE_ROWS)
+    now = time.time()
+    for job in estimates:
+        job['id'] = '{}/{}'.format(job['namespace'], job['experiment_id'])
+        job['waiting'] = format_duration(now - job['enqueued_at'])
+        job['starts_in'] = format_duration(job['estimated_start'] - now) if job['estimated_start'] > now else 'now'
+        job['resources_text'] = format_resources(job['resources'])
+    usage = sorted(jobqueue.namespace_usage(config['EXPERIMENTS_DIR']).items(), key=lambda item: -item[1])
+    kwargs = {
+        'jobs': estimates,
+        'queued_count': jobqueue.count_jobs(config['EXPERIMENTS_DIR']),
+        'running_count': jobqueue.count_jobs(config['EXPERIMENTS_DIR'], jobqueue.CLAIMED),
+        'usage': usage,
+        'half_life_hours': jobqueue.FAIR_SHARE_HALF_LIFE_HOURS,
+    }
+    return flask.render_template('queue.html', **kwargs)
+
+
+@app.route('/api/queue')
+def api_queue():
+    estimates = jobqueue.queue_estimates(config['EXPERIMENTS_DIR'], MAX_QUEUE_ROWS)
+    return flask.jsonify(jobs=estimates, usage=jobqueue.namespace_usage(config['EXPERIMENTS_DIR']))
+
+
+def format_duration(seconds):
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return '{}m'.format(minutes)
+    if minutes < 48 * 60:
+        return '{}h {}m'.format(minutes // 60, minutes % 60)
+    return '{}d {}h'.format(minutes // (24 * 60), minutes // 60 % 24)
+
+
+def format_resources(resources):
+    if not resources:
+        return 'default'
+    parts = ['{} cpu'.format(resources['cpus'])]
+    if resources.get('memory_mb'):
+        parts.append('{} MB'.format(resources['memory_mb']))
+    if resources.get('gpus') is not None:
+        parts.append('{:g} gpu'.format(resources['gpus']))
+    return ', '.join(parts)
+
+
 @app.route('/info')
 def get_info():
     info = server_config.get_config(config['EXPERIMENTS_DIR'])
@@ -236,6 +591,7 @@ def view_experiment(experiment_namespace, experiment_id):
             'name': name,
             'url_latest_5': url_latest_n,
             'url_latest': url_latest_n[-1],
+            'thumbnail_url_latest_5': ['{}?thumb={}'.format(url, GALLERY_THUMBNAIL_SIZE) for url in url_latest_n],
         })
     image_groups.sort(key=lambda x: x['name'])
 
@@ -255,16 +611,33 @@ def view_experiment(experiment_namespace, experiment_id):
 @app.route('/experiment/<experiment_namespace>/<experiment_id>/files')
 def view_experiment_listing(experiment_namespace, experiment_id):
     full_path = os.path.join(config['EXPERIMENTS_DIR'], experiment_namespace, experiment_id)
-    listing = get_directory_listing(full_path)
+    if not os.path.isdir(full_path):
+        flask.abort(404)
     kwargs = {
-        'listing': listing,
         'cwd': experiment_id,
         'experiment_namespace': experiment_namespace,
         'experiment_id': experiment_id,
         'experiment_notes': datasource.get_notes(os.path.join(experiment_namespace, experiment_id)),
         'files_url': get_files_url(experiment_namespace),
     }
-    return flask.render_template('experiment_listing.html', **kwargs)
+    return render_listing(full_path, 'experiment_listing.html', **kwargs)
+
+
+# One page of a directory listing, as HTML or, with ?format=json, as JSON
+# eg. ?sort=mtime&order=desc&glob=*.png&limit=100&cursor=...
+def render_listing(full_path, template, **kwargs):
+    sort = arg('sort') or 'name'
+    descending = arg('order') == 'desc'
+    pattern = arg('glob')
+    limit = min(max(parse_int_or_400(arg('limit'), LISTING_PAGE_SIZE), 1), LISTING_PAGE_SIZE)
+    try:
+        page = datasource.get_directory_page(full_path, sort, descending, pattern, arg('cursor'), limit)
+    except ValueError:
+        flask.abort(400)
+    if arg('format') == 'json':
+        return flask.jsonify(**page)
+    query = {'sort': sort, 'order': 'desc' if descending else 'asc', 'glob': pattern or ''}
+    return flask.render_template(template, query=query, **page, **kwargs)
 
 
 @app.route('/experiment/<experiment_namespace>/<experiment_id>/tensorboard')
@@ -11,7 +11,39 @@ DEFAULT_CONFIG = {
     'GNOMEHAT_SERVER_TITLE': 'Gnomehat Experiments',
     'DEBUG': False,
     'MAX_RESULTS_PER_PAGE': 100,
+    # 'development', 'threaded' or 'gunicorn' (pip install gunicorn)
+    'GNOMEHAT_SERVER_MODE': 'development',
+    'SERVER_WORKERS': 4,
+    'SERVER_THREADS': 8,
+    'SERVER_KEEPALIVE_SECONDS': 5,
+    'SERVER_TIMEOUT_SECONDS': 60,
+    # Live front page updates: each viewer holds one server thread, in addition to SERVER_THREADS
+    'EVENT_STREAMS_MAX': 32,
+    # Log a breakdown of any request slower than this
+    'SLOW_REQUEST_SECONDS': 1.0,
+    # Lets remote users profile requests (?_profile=1) and view /_profiles, via the X-Gnomehat-Admin-Token header
+    'ADMIN_TOKEN': None,
     'IMAGE_EXTENSIONS': ['jpg', 'png', 'tiff', 'bmp', 'gif'],
+    # Cache experiment metadata in a SQLite file instead of crawling on every request
+    'METADATA_INDEX': True,
+    'METADATA_INDEX_PATH': None,
+    # Watch EXPERIMENTS_DIR for changes: 'auto', 'inotify', 'poll' or 'off'
+    'CHANGE_FEED': 'auto',
+    'CHANGE_FEED_POLL_SECONDS': 2,
+    # Read experiment directories in parallel, giving up on any that hang
+    'CARD_LOADER_THREADS': 8,
+    'CARD_LOAD_TIMEOUT_SECONDS': 10,
+    'CARD_SLOW_SECONDS': 1.0,
+    # After a read times out, that experiment is shown without its card for this long before being tried again
+    'CARD_RETRY_SECONDS': 60,
+    # Downscaled image previews, cached in EXPERIMENTS_DIR/.gnomehat_thumbnails
+    'THUMBNAIL_CACHE_DIR': None,
+    'THUMBNAIL_CACHE_MB': 1024,
+    'THUMBNAIL_WORKERS': None,
+    # Let a fronting proxy send experiment files: None, 'x-accel-redirect' (nginx) or 'x-sendfile' (apache)
+    # With x-accel-redirect, FILE_OFFLOAD_PREFIX must be an internal location aliased to EXPERIMENTS_DIR
+    'FILE_OFFLOAD': None,
+    'FILE_OFFLOAD_PREFIX': '/_gnomehat_experiments/',
 }
 
 def write_config(experiments_dir, config):
@@ -0,0 +1,56 @@
+// Patch experiment cards on the front page as the server reports changes,
+// instead of reloading the whole page
+function watchCards(namespace) {
+    if (!window.EventSource) {
+        return;
+    }
+    var source = new EventSource("/api/" + namespace + "/events");
+    source.addEventListener("added", function(e) {
+        var data = JSON.parse(e.data);
+        var card = findCard(data.id);
+        if (card) {
+            replaceCard(card, data.html);
+        } else {
+            var cards = document.getElementById("cards");
+            cards.insertBefore(makeCard(data.html), cards.firstChild);
+            filterResults();
+        }
+    });
+    source.addEventListener("changed", function(e) {
+        var data = JSON.parse(e.data);
+        var card = findCard(data.id);
+        if (card) {
+            replaceCard(card, data.html);
+        }
+    });
+    source.addEventListener("removed", function(e) {
+        var card = findCard(JSON.parse(e.data).id);
+        if (card) {
+            card.remove();
+        }
+    });
+    // We fell too far behind to patch the page
+    source.addEventListener("reload", function(e) {
+        source.close();
+        window.location.reload();
+    });
+}
+
+function findCard(experimentId) {
+    return document.querySelector('#cards [data-id="' + CSS.escape(experimentId) + '"]');
+}
+
+function makeCard(html) {
+    var template = document.createElement("template");
+    template.innerHTML = html.trim();
+    return template.content.firstChild;
+}
+
+function replaceCard(card, html) {
+    // Don't clobber notes that are being typed
+    if (card.contains(document.activeElement)) {
+        return;
+    }
+    card.replaceWith(makeCard(html));
+    filterResults();
+}
@@ -19,6 +19,9 @@
 /*
  * Modified for Gnomehat: half-duplex only, added bufferLines
  * -lwneal 2019
+ * Each message is a frame of one or more lines; only the last bufferLines lines are kept.
+ * Speaks protocol 2: frames carry byte offsets, so a dropped connection is resumed
+ * without losing or repeating output, and scrolling to the top pages back through earlier output.
  */
 
 function wsrepl(customArgs) {
@@ -30,6 +33,8 @@ var defArgs = {
     port: 8080,
     socketProto: 'ws',
     bufferLines: 500,
+    pageBytes: 65536,
+    reconnectSeconds: 2,
     replElName: 'output',
     inputElName: 'msg',
     replSendColor: 'white',
@@ -56,7 +61,15 @@ var arg = Object.assign({}, defArgs, customArgs);
 
 // constants
 
-var splitBuf = [''];
+var lineBuf = [];
+var lineBytes = [];
+var encoder = new TextEncoder();
+// Where the displayed output starts and ends in stdout.txt, and which file that was
+var fileId = null;
+var startOffset = null;
+var endOffset = null;
+var pageRequested = false;
+var ws = null;
 var mainEl  = document.getElementById('repl');
 var hiddenEl = document.createElement('textarea');
 var replEl = document.createElement('pre');
@@ -82,48 +95,130 @@ function htmlDecode(str) {
     return hiddenEl.childNodes.length === 0 ? '' : hiddenEl.childNodes[0].nodeValue;
 }
 
-function replyToPage(str) {
-    // TODO: is there an easy way to keep a ring buffer of divs?
-    var len = splitBuf.length;
-    if (len > arg.bufferLines) {
-        for (var i = 0; i < len - 1; i++) {
-            splitBuf[i] = splitBuf[i+1];
-        }
-    } else {
-        splitBuf[len] = '';
-        replEl.scrollTop = 999999;
+function splitLines(str) {
+    return str.match(/[^\n]*\n|[^\n]+$/g) || [];
+}
+
+function render(scrollToBottom) {
+    replEl.innerHTML = '<span style="color:' + arg.replReplyColor + '">' + lineBuf.join('') + '</span>\n' + arg.replCursor;
+    if (scrollToBottom) {
+        replEl.scrollTop = replEl.scrollHeight;
     }
-    splitBuf[len - 1] = '<span style="color:' + arg.replReplyColor + '">' + htmlEncode(str) + '</span>';
-    replEl.innerHTML = splitBuf.join('') + '\n' + arg.replCursor;
 }
 
-// main
+// Lines from the file count their bytes, so the offset of the first line is known after trimming
+function replyToPage(str, fromFile) {
+    var lines = splitLines(str);
+    for (var i = 0; i < lines.length; i++) {
+        lineBuf.push(htmlEncode(lines[i]));
+        lineBytes.push(fromFile ? encoder.encode(lines[i]).length : 0);
+    }
+    // Stay scrolled to the bottom, unless the user has scrolled up to read something
+    var atBottom = replEl.scrollTop + replEl.clientHeight >= replEl.scrollHeight - 4;
+    if (atBottom && lineBuf.length > arg.bufferLines) {
+        var removed = lineBuf.length - arg.bufferLines;
+        lineBuf.splice(0, removed);
+        var removedBytes = lineBytes.splice(0, removed);
+        for (var j = 0; j < removedBytes.length; j++) {
+            startOffset += removedBytes[j];
+        }
+    }
+    render(atBottom);
+}
 
-sty.innerHTML = '#' + arg.replElName + ' {\n margin: ' + arg.replMargin + ';\n padding: ' + arg.replPadding + ';\n height: ' + arg.replHeight + ';\n width: ' + arg.replWidth + ';\n color: ' + arg.replSendColor + ';\n background-color: ' + arg.replClosedBgColor + ';\n border-width: ' + arg.replBorderWidth + ';\n border-color: ' + arg.replBorderColor + ';\n border-style: ' + arg.replBorderStyle + ';\n text-align: ' + arg.replTextAlign + ';\n overflow: ' + arg.replOverflow + ';\n}\n#' + arg.inputElName + ' {\n margin: ' + arg.inputMargin + ';\n padding: ' + arg.inputPadding + ';\n width: ' + arg.inputWidth + ';\n height: ' + arg.inputHeight + ';\n}';
-document.getElementsByTagName('head')[0].appendChild(sty);
+function prependToPage(str) {
+    var lines = splitLines(str);
+    var oldHeight = replEl.scrollHeight;
+    lineBuf = lines.map(htmlEncode).concat(lineBuf);
+    lineBytes = lines.map(function (line) { return encoder.encode(line).length; }).concat(lineBytes);
+    render(false);
+    replEl.scrollTop += replEl.scrollHeight - oldHeight;
+}
 
-var wsurl = arg.socketProto + '://' + arg.serverName + ':' + arg.port + '/stdoutstream';
-var ws = new WebSocket(wsurl);
+function handleMessage(message) {
+    if (message.type === 'data') {
+        // Paging back is only possible through one unbroken run of the same file
+        if (message.truncated || message.file_id !== fileId || message.skipped_bytes) {
+            if (message.truncated && endOffset !== null) {
+                replyToPage('[stdout.txt was truncated, following from the start]\n', false);
+            }
+            if (message.skipped_bytes) {
+                replyToPage('[... skipped ' + message.skipped_bytes + ' bytes of output ...]\n', false);
+            }
+            lineBytes = lineBytes.map(function () { return 0; });
+            fileId = message.file_id;
+            startOffset = message.offset;
+        } else if (startOffset === null) {
+            startOffset = message.offset;
+        }
+        endOffset = message.end;
+        replyToPage(message.text, true);
+    } else if (message.type === 'page') {
+        pageRequested = false;
+        if (message.file_id === fileId && message.end === startOffset) {
+            startOffset = message.offset;
+            prependToPage(message.text);
+        }
+    }
+}
 
-ws.addEventListener('open', function (event) {
-    replEl.style.backgroundColor = arg.replOpenBgColor;
-    // Send a Hello message
-    console.log('Connected to websocket server, sending HELLO message...');
+function requestPage() {
+    if (pageRequested || ws === null || ws.readyState !== WebSocket.OPEN || !startOffset) {
+        return;
+    }
+    pageRequested = true;
     ws.send(JSON.stringify({
-        "experiment_namespace": arg.experiment_namespace,
-        "experiment_id": arg.experiment_id
+        "type": "page_back",
+        "file_id": fileId,
+        "before": startOffset,
+        "bytes": arg.pageBytes
     }));
-    console.log('Listening to logs for namespace ' + arg.gnomehatNamespace + ' experiment ' + arg.gnomehatExperiment);
-});
+}
 
-ws.addEventListener('message', function (event) {
-    replyToPage(event.data, true);
-});
+function connect() {
+    var wsurl = arg.socketProto + '://' + arg.serverName + ':' + arg.port + '/stdoutstream';
+    ws = new WebSocket(wsurl);
+
+    ws.addEventListener('open', function (event) {
+        replEl.style.backgroundColor = arg.replOpenBgColor;
+        // Send a Hello message, asking for everything since the last byte we saw if this is a reconnect
+        console.log('Connected to websocket server, sending HELLO message...');
+        var hello = {
+            "experiment_namespace": arg.experiment_namespace,
+            "experiment_id": arg.experiment_id,
+            "protocol": 2
+        };
+        if (endOffset !== null) {
+            hello.resume_from = {"file_id": fileId, "offset": endOffset};
+        }
+        pageRequested = false;
+        ws.send(JSON.stringify(hello));
+        console.log('Listening to logs for namespace ' + arg.experiment_namespace + ' experiment ' + arg.experiment_id);
+    });
+
+    ws.addEventListener('message', function (event) {
+        handleMessage(JSON.parse(event.data));
+    });
+
+    ws.addEventListener('close', function (event) {
+        console.log('Websocket closed, reconnecting in ' + arg.reconnectSeconds + ' seconds');
+        replEl.style.backgroundColor = arg.replClosedBgColor;
+        setTimeout(connect, arg.reconnectSeconds * 1000);
+    });
+}
 
-ws.addEventListener('close', function (event) {
-    console.log('Websocket closed');
-    replEl.style.backgroundColor = arg.replClosedBgColor;
+// main
+
+sty.innerHTML = '#' + arg.replElName + ' {\n margin: ' + arg.replMargin + ';\n padding: ' + arg.replPadding + ';\n height: ' + arg.replHeight + ';\n width: ' + arg.replWidth + ';\n color: ' + arg.replSendColor + ';\n background-color: ' + arg.replClosedBgColor + ';\n border-width: ' + arg.replBorderWidth + ';\n border-color: ' + arg.replBorderColor + ';\n border-style: ' + arg.replBorderStyle + ';\n text-align: ' + arg.replTextAlign + ';\n overflow: ' + arg.replOverflow + ';\n}\n#' + arg.inputElName + ' {\n margin: ' + arg.inputMargin + ';\n padding: ' + arg.inputPadding + ';\n width: ' + arg.inputWidth + ';\n height: ' + arg.inputHeight + ';\n}';
+document.getElementsByTagName('head')[0].appendChild(sty);
+
+replEl.addEventListener('scroll', function (event) {
+    if (replEl.scrollTop === 0) {
+        requestPage();
+    }
 });
 
+connect();
+
 mainEl.appendChild(replEl);
 }
@@ -0,0 +1,106 @@
+# Append-only metric time series, one file per experiment
+# .last_summary.json only holds the latest value of each metric; this keeps every value.
+#
+# Usage, from inside a training script run by gnomehat:
+#   from gnomehat import timeseries
+#   for step in range(1000):
+#       timeseries.log(step, loss=loss, accuracy=accuracy)
+#
+# Each value is a fixed-size little-endian record (key id, step, wall time, value),
+# so millions of points can be loaded with a single numpy.frombuffer().
+# Key names live in a small text file alongside, one per line; the line number is the key id.
+import os
+import time
+import struct
+import atexit
+import threading
+
+DATA_FILENAME = '.gnomehat_metrics.bin'
+KEYS_FILENAME = '.gnomehat_metrics.keys'
+RECORD = struct.Struct('<Hqdd')
+FLUSH_SECONDS = 1.0
+
+
+class Writer(object):
+    def __init__(self, experiment_dir=None, flush_seconds=FLUSH_SECONDS):
+        if experiment_dir is None:
+            experiment_dir = os.environ.get('GNOMEHAT_EXPERIMENT_DIR', os.getcwd())
+        self.data_filename = os.path.join(experiment_dir, DATA_FILENAME)
+        self.keys_filename = os.path.join(experiment_dir, KEYS_FILENAME)
+        self.flush_seconds = flush_seconds
+        self.key_ids = {name: i for i, name in enumerate(read_keys(self.keys_filename))}
+        self.data_fp = open(self.data_filename, 'ab')
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+
+    def log(self, step, values=None, **kwargs):
+        values = dict(values or {}, **kwargs)
+        wall_time = time.time()
+        with self.lock:
+            records = []
+            for name, value in values.items():
+                records.append(RECORD.pack(self.key_id(name), int(step), wall_time, float(value)))
+            self.data_fp.write(b''.join(records))
+            if wall_time - self.last_flush > self.flush_seconds:
+                self.flush_locked()
+
+    # Key names must be on disk before any record that refers to them
+    def key_id(self, name):
+        if name not in self.key_ids:
+            with open(self.keys_filename, 'a') as fp:
+                fp.write(name.replace('\n', ' ') + '\n')
+            self.key_ids[name] = len(self.key_ids)
+        return self.key_ids[name]
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        self.data_fp.flush()
+        self.last_flush = time.time()
+
+    def close(self):
+        with self.lock:
+            self.data_fp.close()
+
+
+def read_keys(keys_filename):
+    try:
+        with open(keys_filename) as fp:
+            return [line.rstrip('\n') for line in fp]
+    except FileNotFoundError:
+        return []
+
+
+default_writer = None
+
+
+def log(step, values=None, **kwargs):
+    global default_writer
+    if default_writer is None:
+        default_writer = Writer()
+        atexit.register(default_writer.close)
+    default_writer.log(step, values, **kwargs)
+
+
+# Returns {key: (steps, wall times, values)} as numpy arrays, reading only bytes from offset onwards
+# A partially-written record at the end of the file is ignored
+def read_series(experiment_dir, offset=0):
+    import numpy as np
+    dtype = np.dtype([('key', '<u2'), ('step', '<i8'), ('time', '<f8'), ('value', '<f8')])
+    keys = read_keys(os.path.join(experiment_dir, KEYS_FILENAME))
+    try:
+        with open(os.path.join(experiment_dir, DATA_FILENAME), 'rb') as fp:
+            fp.seek(offset)
+            data = fp.read()
+    except FileNotFoundError:
+        return {}, offset
+    count = len(data) // dtype.itemsize
+    records = np.frombuffer(data, dtype=dtype, count=count)
+    series = {}
+    for key_id, name in enumerate(keys):
+        selected = records[records['key'] == key_id]
+        if len(selected):
+            series[name] = (selected['step'], selected['time'], selected['value'])
+    return series, offset + count * dtype.itemsize
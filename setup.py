@@ -48,6 +48,11 @@ setup(name='gnomehat',
         "pytz",
         "websockets",
         "docopt",
+        "numpy",
     ],
+    extras_require={
+        # GNOMEHAT_SERVER_MODE = 'gunicorn'
+        "production": ["gunicorn"],
+    },
     python_requires='>3',
 )
@@ -0,0 +1,117 @@
+import unittest
+import tempfile
+import shutil
+import errno
+import queue
+import asyncio
+import os
+
+from gnomehat import changefeed
+
+
+class TestChangeFeed(unittest.TestCase):
+
+    def setUp(self):
+        self.experiments_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.experiments_dir, 'default'))
+
+    def tearDown(self):
+        shutil.rmtree(self.experiments_dir)
+
+    def collect_events(self, mode):
+        events = queue.Queue()
+        feed = changefeed.ChangeFeed(self.experiments_dir, mode=mode, poll_seconds=0.05)
+        feed.subscribe(events.put)
+        feed.start()
+        try:
+            # Give the feed a moment to take its first snapshot or add its watches
+            drain(events, 0.2)
+            dir_path = os.path.join(self.experiments_dir, 'default', 'foo_00000001')
+            os.mkdir(dir_path)
+            self.assertEqual(events.get(timeout=2), changefeed.Event(
+                changefeed.EXPERIMENT_CREATED, 'default', 'foo_00000001', None))
+            drain(events, 0.2)
+
+            open(os.path.join(dir_path, 'worker_started'), 'w').close()
+            with open(os.path.join(dir_path, 'stdout.txt'), 'w') as fp:
+                fp.write('hello\n')
+            with open(os.path.join(dir_path, 'sample_0001.png'), 'w') as fp:
+                fp.write('not really a png')
+            kinds = set()
+            while len(kinds) < 3:
+                kinds.add(events.get(timeout=2).kind)
+            self.assertEqual(kinds, set([changefeed.STATUS_CHANGED,
+                                         changefeed.STDOUT_APPENDED,
+                                         changefeed.IMAGE_WRITTEN]))
+        finally:
+            feed.stop()
+
+    def test_polling(self):
+        self.collect_events('poll')
+
+    @unittest.skipUnless(changefeed.inotify_supported('/tmp'), 'inotify not available')
+    def test_inotify(self):
+        self.collect_events('inotify')
+
+    @unittest.skipUnless(changefeed.inotify_supported('/tmp'), 'inotify not available')
+    def test_inotify_failure(self):
+        events = queue.Queue()
+        feed = changefeed.ChangeFeed(self.experiments_dir, mode='inotify', poll_seconds=0.05)
+        feed.subscribe(events.put)
+        feed.start()
+        try:
+            drain(events, 0.2)
+            # Running out of watches for a new experiment falls back to polling, which no longer trusts itself
+            def add_watch(libc, fd, path, namespace, experiment_id):
+                raise OSError(errno.ENOSPC, 'inotify_add_watch {}: No space left on device'.format(path))
+            feed.add_watch = add_watch
+            os.mkdir(os.path.join(self.experiments_dir, 'default', 'foo_00000001'))
+            self.assertEqual(events.get(timeout=2).kind, changefeed.RESCAN)
+            self.assertEqual((feed.mode, feed.trusted), ('poll', False))
+
+            drain(events, 0.2)
+            os.mkdir(os.path.join(self.experiments_dir, 'default', 'foo_00000002'))
+            self.assertEqual(events.get(timeout=2), changefeed.Event(
+                changefeed.EXPERIMENT_CREATED, 'default', 'foo_00000002', None))
+        finally:
+            feed.stop()
+
+    def test_experiment_set(self):
+        experiments = changefeed.ExperimentSet(self.experiments_dir, miss_refresh_seconds=60)
+        os.mkdir(os.path.join(self.experiments_dir, 'default', 'foo_00000001'))
+        self.assertTrue(experiments.contains('default', 'foo_00000001'))
+        self.assertFalse(experiments.contains('missing', 'foo_00000001'))
+        self.assertFalse(experiments.contains('..', 'default'))
+
+        # Without a feed, a new experiment is found once the namespace is listed again
+        os.mkdir(os.path.join(self.experiments_dir, 'default', 'foo_00000002'))
+        self.assertFalse(experiments.contains('default', 'foo_00000002'))
+        experiments.miss_refresh_seconds = 0
+        self.assertTrue(experiments.contains('default', 'foo_00000002'))
+
+        # Feed events update the set without listing anything
+        experiments.on_change(changefeed.Event(changefeed.EXPERIMENT_DELETED, 'default', 'foo_00000001', None))
+        experiments.on_change(changefeed.Event(changefeed.EXPERIMENT_CREATED, 'default', 'foo_00000003', None))
+        self.assertEqual(experiments.namespaces['default'][0], set(['foo_00000002', 'foo_00000003']))
+
+        # Namespaces that don't exist aren't cached, and only max_namespaces that do are
+        experiments.max_namespaces = 1
+        os.makedirs(os.path.join(self.experiments_dir, 'other', 'bar'))
+        self.assertTrue(experiments.contains('other', 'bar'))
+        self.assertFalse(experiments.contains('missing', 'bar'))
+        self.assertEqual(list(experiments.namespaces), ['other'])
+        self.assertTrue(asyncio.run(experiments.contains_async('other', 'bar')))
+        self.assertTrue(asyncio.run(experiments.contains_async('default', 'foo_00000002')))
+        self.assertEqual(list(experiments.namespaces), ['default'])
+
+
+def drain(events, seconds):
+    try:
+        while True:
+            events.get(timeout=seconds)
+    except queue.Empty:
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main()
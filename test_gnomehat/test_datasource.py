@@ -0,0 +1,260 @@
+import unittest
+import threading
+import tempfile
+import shutil
+import json
+import time
+import os
+
+from gnomehat import server_config
+from gnomehat.server import app, config
+from gnomehat.server import datasource, events, index
+from gnomehat.server.cache import LRUCache
+
+
+def make_experiment(experiments_dir, namespace, experiment_id, status=None, notes='', metrics=None):
+    dir_path = os.path.join(experiments_dir, namespace, experiment_id)
+    os.makedirs(dir_path)
+    with open(os.path.join(dir_path, 'gnomehat_start.sh'), 'w') as fp:
+        fp.write("#!/bin/bash\nscript -q -c 'python main.py' /dev/null\n")
+    with open(os.path.join(dir_path, 'gnomehat_notes.txt'), 'w') as fp:
+        fp.write(notes)
+    with open(os.path.join(dir_path, 'stdout.txt'), 'w') as fp:
+        fp.write('[12:00:00] hello\n[12:00:01] world\n')
+    if status:
+        open(os.path.join(dir_path, status), 'w').close()
+    if metrics:
+        with open(os.path.join(dir_path, '.last_summary.json'), 'w') as fp:
+            fp.write(json.dumps(metrics))
+    return dir_path
+
+
+class TestDatasource(unittest.TestCase):
+
+    def setUp(self):
+        self.experiments_dir = tempfile.mkdtemp()
+        config.clear()
+        config.update(server_config.get_config(self.experiments_dir))
+        # Pretend the namespace was created long ago, so its mtime can be trusted
+        self.settle_seconds = datasource.MTIME_SETTLE_SECONDS
+        datasource.MTIME_SETTLE_SECONDS = -1
+        datasource.failed_reads.clear()
+        self.context = app.test_request_context('/')
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+        datasource.MTIME_SETTLE_SECONDS = self.settle_seconds
+        shutil.rmtree(self.experiments_dir)
+
+    def test_index_matches_crawl(self):
+        make_experiment(self.experiments_dir, 'default', 'foo_00000001', status='worker_finished', notes='first')
+        make_experiment(self.experiments_dir, 'default', 'foo_00000002', metrics={'loss': 0.5})
+        config['METADATA_INDEX'] = False
+        crawled = datasource.get_results('/experiments', 'default')
+        config['METADATA_INDEX'] = True
+        indexed = datasource.get_results('/experiments', 'default')
+        key = lambda x: x['dir_name']
+        self.assertEqual(sorted(crawled, key=key), sorted(indexed, key=key))
+        self.assertEqual(index.count_experiments('default'), 2)
+
+    def test_index_refresh(self):
+        dir_path = make_experiment(self.experiments_dir, 'default', 'foo_00000001')
+        results = datasource.get_results('/experiments', 'default')
+        self.assertEqual(results[0]['subtitle'], '[12:00:01] world')
+
+        # Appending to a file inside a running experiment is noticed
+        with open(os.path.join(dir_path, 'gnomehat_notes.txt'), 'a') as fp:
+            fp.write('new notes')
+        results = datasource.get_results('/experiments', 'default')
+        self.assertEqual(results[0]['subtitle'], 'new notes')
+
+        # New and deleted experiments are noticed
+        make_experiment(self.experiments_dir, 'default', 'bar_00000002')
+        self.assertEqual(len(datasource.get_results('/experiments', 'default')), 2)
+        shutil.rmtree(dir_path)
+        self.assertEqual(len(datasource.get_results('/experiments', 'default')), 1)
+
+    def test_failed_read_retried(self):
+        make_experiment(self.experiments_dir, 'default', 'foo_00000001', status='worker_finished')
+        self.assertEqual(len(datasource.get_results('/experiments', 'default')), 1)
+
+        # A new experiment that can't be read yet (eg. half written) is read again on the next refresh,
+        # although the namespace hasn't changed since
+        read_experiment = datasource.read_experiment
+        def half_written(dir_path):
+            raise ValueError('half written')
+        datasource.read_experiment = half_written
+        try:
+            make_experiment(self.experiments_dir, 'default', 'foo_00000002', status='worker_finished')
+            self.assertEqual(len(datasource.get_results('/experiments', 'default')), 1)
+        finally:
+            datasource.read_experiment = read_experiment
+        self.assertEqual(len(datasource.get_results('/experiments', 'default')), 2)
+        self.assertEqual(datasource.failed_reads, {})
+
+    def test_metrics_from_index(self):
+        make_experiment(self.experiments_dir, 'default', 'foo_00000001', notes='hi', metrics={'loss': 0.5})
+        metrics = datasource.get_all_experiment_metrics(self.experiments_dir, 'default')
+        self.assertEqual(metrics, {'foo_00000001': {'loss': '0.5000', 'notes': 'hi'}})
+
+    def test_results_pagination(self):
+        for i in range(7):
+            dir_path = make_experiment(self.experiments_dir, 'default', 'foo_{:08d}'.format(i))
+            os.utime(dir_path, (1000000 + i // 2, 1000000 + i // 2))
+        for use_index in [False, True]:
+            config['METADATA_INDEX'] = use_index
+            seen = []
+            cursor = None
+            while True:
+                page = datasource.get_results_page('/experiments', 'default', cursor, limit=3)
+                seen.extend(result['dir_name'] for result in page['results'])
+                cursor = page['next_cursor']
+                if cursor is None:
+                    break
+            expected = ['default/foo_{:08d}'.format(i) for i in reversed(range(7))]
+            self.assertEqual(seen, expected)
+        with self.assertRaises(ValueError):
+            datasource.get_results_page('/experiments', 'default', cursor='garbage')
+
+    def test_concurrent_loader(self):
+        dir_paths = [make_experiment(self.experiments_dir, 'default', 'foo_{:08d}'.format(i)) for i in range(8)]
+        records = datasource.read_experiments(dir_paths)
+        self.assertEqual([r['experiment_id'] for r in records],
+                         ['default/foo_{:08d}'.format(i) for i in range(8)])
+
+        # One hung directory doesn't hold up the others
+        read_experiment = datasource.read_experiment
+        unhang = threading.Event()
+        def hang_on_first(dir_path):
+            if dir_path == dir_paths[0]:
+                unhang.wait(5)
+                return None
+            return read_experiment(dir_path)
+        datasource.read_experiment = hang_on_first
+        config['CARD_LOAD_TIMEOUT_SECONDS'] = 0.2
+        timed_out = datasource.card_loader_stats['timed_out']
+        try:
+            records = datasource.read_experiments(dir_paths)
+            self.assertIsNone(records[0])
+            self.assertTrue(all(records[1:]))
+            self.assertEqual(datasource.card_loader_stats['timed_out'], timed_out + 1)
+
+            # While it is hung, and for a while after, it isn't read again, so it can't take another thread
+            started = time.time()
+            records = datasource.read_experiments(dir_paths)
+            self.assertLess(time.time() - started, 0.2)
+            self.assertIsNone(records[0])
+            self.assertTrue(all(records[1:]))
+            self.assertEqual(datasource.card_loader_stats['timed_out'], timed_out + 1)
+        finally:
+            unhang.set()
+            datasource.read_experiment = read_experiment
+            datasource.card_loader_retry_after.clear()
+
+    def test_namespace_summary(self):
+        make_experiment(self.experiments_dir, 'default', 'foo_00000001', status='worker_finished')
+        make_experiment(self.experiments_dir, 'default', 'foo_00000002', status='worker_error')
+        make_experiment(self.experiments_dir, 'default', 'foo_00000003', status='worker_lockfile')
+        summary = datasource.get_namespace_summary('default')
+        self.assertEqual(summary['count'], 3)
+        self.assertIsNone(summary['running'])
+
+        # Once the namespace is indexed, per-status counts are available
+        datasource.get_results('/experiments', 'default')
+        summary = datasource.get_namespace_summary('default')
+        self.assertEqual((summary['count'], summary['running'], summary['finished'], summary['failed']),
+                         (3, 1, 1, 1))
+
+        # Until the namespace changes, the index isn't refreshed again for every summary
+        refreshed = []
+        refresh_index = datasource.refresh_index
+        datasource.refresh_index = lambda namespace: refreshed.append(namespace) or refresh_index(namespace)
+        try:
+            datasource.get_namespace_summary('default')
+            self.assertEqual(refreshed, [])
+            make_experiment(self.experiments_dir, 'default', 'foo_00000004', status='worker_finished')
+            summary = datasource.get_namespace_summary('default')
+            self.assertEqual(refreshed, ['default'])
+            self.assertEqual((summary['count'], summary['finished']), (4, 2))
+        finally:
+            datasource.refresh_index = refresh_index
+
+    def test_metrics_table(self):
+        for i in range(6):
+            metrics = {'loss': 1.0 - i / 10.}
+            if i % 2:
+                metrics['accuracy'] = i / 10.
+            make_experiment(self.experiments_dir, 'default', 'foo_{:08d}'.format(i), metrics=metrics)
+        table = datasource.get_metrics_table('default')
+        self.assertEqual(table.keys(), ['accuracy', 'loss', 'notes'])
+
+        total, ids = table.query(sort='loss', offset=1, limit=2)
+        self.assertEqual((total, ids), (6, ['foo_00000004', 'foo_00000003']))
+
+        # Experiments without the sort key go last
+        total, ids = table.query(sort='accuracy', descending=True)
+        self.assertEqual(ids[:3], ['foo_00000005', 'foo_00000003', 'foo_00000001'])
+
+        total, ids = table.query(filters=[('accuracy', 0.2, None), ('loss', None, 0.6)])
+        self.assertEqual(ids, ['foo_00000005'])
+
+        # Changing one experiment updates the table
+        with open(os.path.join(self.experiments_dir, 'default', 'foo_00000000', '.last_summary.json'), 'w') as fp:
+            fp.write(json.dumps({'loss': 0.0}))
+        table = datasource.get_metrics_table('default')
+        self.assertEqual(table.query(sort='loss', limit=1)[1], ['foo_00000000'])
+
+    def test_directory_page(self):
+        dir_path = make_experiment(self.experiments_dir, 'default', 'foo_00000001')
+        for i in range(25):
+            with open(os.path.join(dir_path, 'sample_{:03d}.png'.format(i)), 'w') as fp:
+                fp.write('x' * i)
+        for sort, descending in [('name', False), ('size', True)]:
+            names, cursor = [], None
+            while True:
+                page = datasource.get_directory_page(dir_path, sort, descending, '*.png', cursor, limit=10)
+                names.extend(item['name'] for item in page['listing'])
+                cursor = page['next_cursor']
+                if cursor is None:
+                    break
+            expected = ['sample_{:03d}.png'.format(i) for i in range(25)]
+            self.assertEqual(names, expected[::-1] if descending else expected)
+            self.assertEqual(page['total'], 25)
+        with self.assertRaises(ValueError):
+            datasource.get_directory_page(dir_path, 'color')
+
+    def test_cache_bounded_by_weight(self):
+        cache = LRUCache(16, weigh=len, max_weight=5)
+        cache.put('a', [1, 2, 3])
+        cache.put('b', [1, 2])
+        cache.put('c', [1, 2])
+        # Over the total weight, the least recently used go first
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual((cache.get('b'), cache.get('c'), cache.weight), ([1, 2], [1, 2], 4))
+        # Too heavy to keep at all, replacing what was there
+        cache.put('b', list(range(6)))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.weight, 2)
+
+    def test_front_page_events(self):
+        make_experiment(self.experiments_dir, 'default', 'foo_00000001')
+        dir_path = make_experiment(self.experiments_dir, 'default', 'foo_00000002')
+        channel = events.Channel('default', '/experiments')
+        self.assertEqual(channel.diff(), [])
+
+        with open(os.path.join(dir_path, 'gnomehat_notes.txt'), 'w') as fp:
+            fp.write('new notes')
+        make_experiment(self.experiments_dir, 'default', 'foo_00000003')
+        shutil.rmtree(os.path.join(self.experiments_dir, 'default', 'foo_00000001'))
+        messages = {name: data['id'] for name, data in channel.diff()}
+        self.assertEqual(messages, {
+            'added': 'default/foo_00000003',
+            'changed': 'default/foo_00000002',
+            'removed': 'default/foo_00000001',
+        })
+        self.assertEqual(channel.diff(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+from gnomehat import server_config
+from gnomehat.server import app, config
+from gnomehat.server import webapi
+
+
+class TestFileServe(unittest.TestCase):
+
+    def setUp(self):
+        self.experiments_dir = tempfile.mkdtemp()
+        config.clear()
+        config.update(server_config.get_config(self.experiments_dir))
+        os.makedirs(os.path.join(self.experiments_dir, 'default', 'foo'))
+        self.data = bytes(range(256)) * 100
+        with open(os.path.join(self.experiments_dir, 'default', 'foo', 'checkpoint.pth'), 'wb') as fp:
+            fp.write(self.data)
+        self.client = app.test_client()
+        self.url = '/experiments/default/foo/checkpoint.pth'
+
+    def tearDown(self):
+        shutil.rmtree(self.experiments_dir)
+
+    def test_range_requests(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.data, self.data)
+        etag = response.headers['ETag']
+
+        response = self.client.get(self.url, headers={'Range': 'bytes=100-199', 'If-Range': etag})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, self.data[100:200])
+        self.assertEqual(response.headers['Content-Range'], 'bytes 100-199/25600')
+
+        # A stale If-Range gets the whole file
+        response = self.client.get(self.url, headers={'Range': 'bytes=100-199', 'If-Range': '"stale"'})
+        self.assertEqual((response.status_code, response.data), (200, self.data))
+
+        response = self.client.get(self.url, headers={'Range': 'bytes=30000-'})
+        self.assertEqual(response.status_code, 416)
+
+        response = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_offload(self):
+        config['FILE_OFFLOAD'] = 'x-accel-redirect'
+        response = self.client.get(self.url)
+        self.assertEqual(response.headers['X-Accel-Redirect'], '/_gnomehat_experiments/default/foo/checkpoint.pth')
+        self.assertEqual(response.data, b'')
+
+        # The path is a URI, so unusual file names are quoted
+        with open(os.path.join(self.experiments_dir, 'default', 'foo', 'epoch 1 #2%.pth'), 'wb') as fp:
+            fp.write(self.data)
+        response = self.client.get('/experiments/default/foo/epoch%201%20%232%25.pth')
+        self.assertEqual(response.headers['X-Accel-Redirect'],
+                         '/_gnomehat_experiments/default/foo/epoch%201%20%232%25.pth')
@@ -0,0 +1,171 @@
+import unittest
+import tempfile
+import threading
+import select
+import sqlite3
+import shutil
+import time
+import fcntl
+import socket
+import subprocess
+import os
+
+from gnomehat import jobqueue
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.experiments_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.experiments_dir)
+
+    def test_claim_in_order(self):
+        jobqueue.enqueue(self.experiments_dir, 'default', 'foo_00000002', enqueued_at=2)
+        jobqueue.enqueue(self.experiments_dir, 'default', 'foo_00000001', enqueued_at=1)
+        self.assertEqual(jobqueue.claim(self.experiments_dir, 'a'), ('default', 'foo_00000001'))
+        self.assertEqual(jobqueue.claim(self.experiments_dir, 'a'), ('default', 'foo_00000002'))
+        self.assertIsNone(jobqueue.claim(self.experiments_dir, 'a'))
+
+        jobqueue.release(self.experiments_dir, 'default', 'foo_00000002')
+        self.assertEqual(jobqueue.claim(self.experiments_dir, 'b'), ('default', 'foo_00000002'))
+        jobqueue.finish(self.experiments_dir, 'default', 'foo_00000002')
+        self.assertEqual(jobqueue.count_jobs(self.experiments_dir, jobqueue.DONE), 1)
+
+    def test_concurrent_claims(self):
+        for i in range(50):
+            jobqueue.enqueue(self.experiments_dir, 'default', 'foo_{:08d}'.format(i), wake=False)
+        claimed = []
+
+        def worker(name):
+            while True:
+                job = jobqueue.claim(self.experiments_dir, name)
+                if job is None:
+                    return
+                claimed.append(job)
+        threads = [threading.Thread(target=worker, args=(str(i),)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(claimed), [('default', 'foo_{:08d}'.format(i)) for i in range(50)])
+
+    def test_recover(self):
+        jobqueue.enqueue(self.experiments_dir, 'default', 'claimed', wake=False)
+        jobqueue.enqueue(self.experiments_dir, 'default', 'done', wake=False)
+        jobqueue.claim(self.experiments_dir, 'a')
+        jobqueue.finish(self.experiments_dir, 'default', 'done')
+        runnable = [('default', 'claimed', 1, None, 0), ('default', 'done', 2, None, 0), ('default', 'missing', 3, None, 0)]
+        self.assertEqual(jobqueue.recover(self.experiments_dir, runnable), 2)
+
+        # Claims are only taken back once they time out
+        timeout = jobqueue.CLAIM_TIMEOUT_SECONDS
+        jobqueue.CLAIM_TIMEOUT_SECONDS = -1
+        try:
+            self.assertEqual(jobqueue.recover(self.experiments_dir, runnable), 1)
+        finally:
+            jobqueue.CLAIM_TIMEOUT_SECONDS = timeout
+        self.assertEqual(jobqueue.count_jobs(self.experiments_dir), 3)
+
+    def test_reap_dead_workers(self):
+        for experiment_id in ['dead', 'alive', 'remote']:
+            os.makedirs(os.path.join(self.experiments_dir, 'default', experiment_id))
+            jobqueue.enqueue(self.experiments_dir, 'default', experiment_id, wake=False)
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        jobqueue.claim(self.experiments_dir, '{}_{}'.format(socket.gethostname(), dead.pid))
+        jobqueue.claim(self.experiments_dir, jobqueue.worker_name())
+        jobqueue.claim(self.experiments_dir, 'elsewhere_1234')
+        # Another machine's job is alive while it holds its worker_lockfile
+        lockfile = open(os.path.join(self.experiments_dir, 'default', 'remote', 'worker_lockfile'), 'w')
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        for job in ['dead', 'alive', 'remote']:
+            jobqueue.mark_running(self.experiments_dir, 'default', job, gpus=1)
+        conn = jobqueue.connect(self.experiments_dir)
+        conn.execute('UPDATE jobs SET claimed_at=?', (time.time() - 30 * 24 * 3600,))
+
+        self.assertEqual(jobqueue.reap(self.experiments_dir), [('default', 'dead')])
+        self.assertEqual(jobqueue.count_jobs(self.experiments_dir, jobqueue.CLAIMED), 2)
+        lockfile.close()
+        self.assertEqual(jobqueue.reap(self.experiments_dir), [('default', 'remote')])
+
+        # Without output, a reaped job is charged nothing; a running one no more than the horizon
+        usage = jobqueue.namespace_usage(self.experiments_dir)['default']
+        self.assertAlmostEqual(usage, jobqueue.FAIR_SHARE_HORIZON_HOURS, places=3)
+
+    def test_claim_what_fits(self):
+        jobqueue.enqueue(self.experiments_dir, 'default', 'big', enqueued_at=1, resources={'cpus': 8}, wake=False)
+        jobqueue.enqueue(self.experiments_dir, 'default', 'small', enqueued_at=2, resources={'cpus': 1}, wake=False)
+        jobqueue.enqueue(self.experiments_dir, 'default', 'plain', enqueued_at=3, wake=False)
+        fits = lambda resources: resources is None or resources['cpus'] <= 2
+        self.assertEqual(jobqueue.claim(self.experiments_dir, 'a', fits=fits), ('default', 'small'))
+        self.assertEqual(jobqueue.claim(self.experiments_dir, 'a', fits=fits), ('default', 'plain'))
+        self.assertIsNone(jobqueue.claim(self.experiments_dir, 'a', fits=fits))
+
+        # A released job can have its request corrected
+        jobqueue.release(self.experiments_dir, 'default', 'small', resources={'cpus': 4})
+        self.assertIsNone(jobqueue.claim(self.experiments_dir, 'a', fits=fits))
+        self.assertEqual(jobqueue.claim(self.experiments_dir, 'a'), ('default', 'big'))
+
+    def test_migrate_old_queue(self):
+        conn = sqlite3.connect(jobqueue.queue_path(self.experiments_dir))
+        conn.execute('CREATE TABLE jobs (namespace TEXT NOT NULL, experiment_id TEXT NOT NULL, state TEXT NOT NULL, '
+                     'enqueued_at REAL NOT NULL, claimed_by TEXT, claimed_at REAL, finished_at REAL, '
+                     'PRIMARY KEY (namespace, experiment_id))')
+        conn.execute("INSERT INTO jobs VALUES ('default', 'old', 'queued', 1, NULL, NULL, NULL)")
+        conn.commit()
+        conn.close()
+        jobqueue.enqueue(self.experiments_dir, 'default', 'new', enqueued_at=2, resources={'cpus': 2}, wake=False)
+        self.assertEqual(jobqueue.claim(self.experiments_dir, 'a'), ('default', 'old'))
+        self.assertEqual(jobqueue.claim(self.experiments_dir, 'a', fits=lambda r: r['cpus'] == 2), ('default', 'new'))
+
+    def test_priority_and_fair_share(self):
+        for i in range(4):
+            jobqueue.enqueue(self.experiments_dir, 'sweep', 'job_{}'.format(i), enqueued_at=1 + i, wake=False)
+        jobqueue.enqueue(self.experiments_dir, 'alice', 'job_0', enqueued_at=10, wake=False)
+        order = lambda: [(job['namespace'], job['experiment_id'])
+                         for job in jobqueue.queue_estimates(self.experiments_dir)]
+        # Namespaces take turns, instead of alice waiting for the whole sweep
+        self.assertEqual(order(), [('sweep', 'job_0'), ('alice', 'job_0'), ('sweep', 'job_1'),
+                                   ('sweep', 'job_2'), ('sweep', 'job_3')])
+        self.assertTrue(jobqueue.set_priority(self.experiments_dir, 'sweep', 'job_3', 5))
+        # Priority goes first, but still counts towards the sweep's share
+        self.assertEqual(order()[:3], [('sweep', 'job_3'), ('alice', 'job_0'), ('sweep', 'job_0')])
+        self.assertEqual(jobqueue.claim(self.experiments_dir, 'a'), ('sweep', 'job_3'))
+        self.assertFalse(jobqueue.set_priority(self.experiments_dir, 'sweep', 'job_3', 0))
+
+        # After the sweep has used a GPU for two hours, alice goes first
+        jobqueue.mark_running(self.experiments_dir, 'sweep', 'job_3', gpus=1, cpus=8)
+        jobqueue.finish(self.experiments_dir, 'sweep', 'job_3')
+        now = time.time()
+        jobqueue.connect(self.experiments_dir).execute(
+            'UPDATE jobs SET claimed_at=?, finished_at=? WHERE experiment_id=?',
+            (now - (jobqueue.FAIR_SHARE_HALF_LIFE_HOURS + 2) * 3600, now - jobqueue.FAIR_SHARE_HALF_LIFE_HOURS * 3600,
+             'job_3'))
+        self.assertAlmostEqual(jobqueue.namespace_usage(self.experiments_dir)['sweep'], 2.0, places=3)
+        self.assertEqual(jobqueue.claim(self.experiments_dir, 'a'), ('alice', 'job_0'))
+
+        # Start times are guessed from how long the namespace's jobs took, one slot per running job
+        estimates = jobqueue.queue_estimates(self.experiments_dir)
+        self.assertEqual([job['position'] for job in estimates], [1, 2, 3])
+        self.assertAlmostEqual(estimates[1]['estimated_start'] - estimates[0]['estimated_start'], 2 * 3600, places=0)
+
+    def test_wakeup(self):
+        path, fd = jobqueue.open_wakeup_fifo(self.experiments_dir, jobqueue.worker_name())
+        self.assertEqual(select.select([fd], [], [], 0)[0], [])
+        jobqueue.enqueue(self.experiments_dir, 'default', 'foo_00000001')
+        self.assertEqual(select.select([fd], [], [], 1)[0], [fd])
+        jobqueue.drain_wakeups(fd)
+        self.assertEqual(select.select([fd], [], [], 0)[0], [])
+
+        # A FIFO nobody reads from any more is cleaned up once it is old
+        os.remove(path)
+        os.mkfifo(path)
+        os.utime(path, (time.time() - 3600, time.time() - 3600))
+        self.assertEqual(jobqueue.wake_workers(self.experiments_dir), 0)
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
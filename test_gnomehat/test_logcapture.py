@@ -0,0 +1,93 @@
+import unittest
+import tempfile
+import shutil
+import gzip
+import time
+import os
+
+from gnomehat import logcapture
+
+
+class TestLogCapture(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'stdout.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_lines(self, filename=None):
+        with open(filename or self.filename, 'rb') as fp:
+            return fp.read().decode('utf-8', 'replace').splitlines()
+
+    def unstamped(self, lines):
+        for line in lines:
+            self.assertRegex(line, r'^\[\d\d:\d\d:\d\d\] ')
+        return [line[11:] for line in lines]
+
+    def test_chunks_and_line_endings(self):
+        capture = logcapture.LogCapture(self.filename)
+        # Lines split across chunks are stamped once, and \r\n split across chunks is one line ending
+        for chunk in [b'one\ntw', b'o\r', b'\nthree\rfour\r\n', b'\xff', b'partial']:
+            capture.write(chunk)
+        capture.note('Worker finished')
+        capture.close()
+        lines = self.read_lines()
+        self.assertEqual(lines[-1], '[Worker finished]')
+        # Bytes that aren't valid text are kept as they are
+        self.assertEqual(self.unstamped(lines[:-1]), ['one', 'two', 'three', 'four', '\ufffdpartial'])
+
+    def test_append_to_existing(self):
+        with open(self.filename, 'w') as fp:
+            fp.write('no newline')
+        capture = logcapture.LogCapture(self.filename)
+        capture.write(b'more\n')
+        capture.close()
+        self.assertEqual(self.read_lines()[0], 'no newlinemore')
+
+    def test_rotation(self):
+        capture = logcapture.LogCapture(self.filename, rotate_bytes=1000)
+        for i in range(200):
+            capture.write('line {:03d}\n'.format(i).encode())
+        capture.close()
+        segments = sorted(f for f in os.listdir(self.tmp_dir) if f != 'stdout.txt')
+        self.assertEqual(segments, ['stdout.txt.{}.gz'.format(i) for i in range(1, len(segments) + 1)])
+        lines = []
+        for i in range(1, len(segments) + 1):
+            with gzip.open(os.path.join(self.tmp_dir, 'stdout.txt.{}.gz'.format(i))) as fp:
+                lines.extend(fp.read().decode().splitlines())
+        lines.extend(self.read_lines())
+        self.assertEqual(self.unstamped(lines), ['line {:03d}'.format(i) for i in range(200)])
+
+    def test_rotation_without_newlines(self):
+        capture = logcapture.LogCapture(self.filename, rotate_bytes=1000)
+        for i in range(20):
+            capture.write(b'.' * 150)
+        capture.close()
+        # At twice rotate_bytes, the line is split between files
+        with gzip.open(self.filename + '.1.gz') as fp:
+            self.assertEqual(self.unstamped([fp.read().decode()]), ['.' * 14 * 150])
+        with open(self.filename, 'rb') as fp:
+            self.assertEqual(fp.read(), b'.' * 6 * 150)
+
+    def test_pump(self):
+        capture = logcapture.LogCapture(self.filename, flush_seconds=0.01)
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b'hello\n' * 1000)
+        os.close(write_fd)
+        self.assertTrue(logcapture.pump(read_fd, capture))
+        self.assertEqual(len(self.read_lines()), 1000)
+
+        # An abort is noticed even while the job prints nothing
+        read_fd, write_fd = os.pipe()
+        started = time.monotonic()
+        self.assertFalse(logcapture.pump(read_fd, capture, should_abort=lambda: True, abort_check_seconds=0.05))
+        self.assertLess(time.monotonic() - started, 1)
+        os.close(read_fd)
+        os.close(write_fd)
+        capture.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
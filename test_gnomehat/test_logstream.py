@@ -0,0 +1,145 @@
+import unittest
+import tempfile
+import asyncio
+import shutil
+import os
+
+from gnomehat import logstream
+
+
+class TestLogStream(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'stdout.txt')
+        self.poll_seconds = logstream.POLL_SECONDS
+        logstream.POLL_SECONDS = 0.01
+
+    def tearDown(self):
+        logstream.POLL_SECONDS = self.poll_seconds
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, text, mode='a'):
+        with open(self.filename, mode) as fp:
+            fp.write(text)
+
+    # Returns the text of frames up to the next one with data, with any notices inline
+    async def next_text(self, subscriber):
+        text = ''
+        while True:
+            frame = await asyncio.wait_for(subscriber.get_frame(), 1)
+            text += logstream.frame_text(frame, self.filename)
+            if frame.data:
+                return text, frame
+
+    def test_shared_follower(self):
+        async def run():
+            self.write('old\n' * 5)
+            # Subscribers arriving while the file is first read share the one follower
+            (first, backlog), (second, _) = await asyncio.gather(logstream.subscribe(self.filename, tail_lines=2),
+                                                                 logstream.subscribe(self.filename))
+            self.assertEqual((backlog.offset, backlog.data), (12, b'old\nold\n'))
+            self.assertEqual(len(logstream.followers), 1)
+
+            # Partial lines wait for their newline
+            self.write('new')
+            self.write(' line\n')
+            for subscriber in [first, second]:
+                text, frame = await self.next_text(subscriber)
+                self.assertEqual((text, frame.offset, logstream.frame_end(frame)), ('new line\n', 20, 29))
+
+            # New subscribers get their backlog from memory
+            self.assertEqual((await logstream.subscribe(self.filename, tail_lines=2))[1].data, b'old\nnew line\n')
+
+            self.write('restarted\n', mode='w')
+            text, frame = await self.next_text(first)
+            self.assertIn('truncated', text)
+            self.assertEqual((frame.offset, frame.data), (0, b'restarted\n'))
+
+            for subscriber in list(logstream.followers[os.path.abspath(self.filename)].subscribers):
+                logstream.unsubscribe(self.filename, subscriber)
+            self.assertEqual(logstream.followers, {})
+        asyncio.run(run())
+
+    def test_file_created_later(self):
+        async def run():
+            subscriber, backlog = await logstream.subscribe(self.filename, tail_lines=10)
+            self.assertEqual(backlog.data, b'')
+            self.write('hello\n')
+            frame = await asyncio.wait_for(subscriber.get_frame(), 1)
+            self.assertEqual(frame.data, b'hello\n')
+            self.assertEqual(frame.file_id, os.stat(self.filename).st_ino)
+            logstream.unsubscribe(self.filename, subscriber)
+        asyncio.run(run())
+
+    def test_read_between_steps(self):
+        async def run():
+            self.write('A\nB\n')
+            first, _ = await logstream.subscribe(self.filename)
+            follower = logstream.followers[os.path.abspath(self.filename)]
+            self.write('C\n')
+            # A read done in the executor, but not yet applied on the loop, changes nothing
+            self.assertEqual(follower.read()[1:], (4, b'C\n', False))
+            self.assertEqual(follower.offset, 4)
+            second, frame = await logstream.subscribe(self.filename, resume_from=(follower.inode, 2))
+            self.assertEqual((frame.offset, frame.data), (2, b'B\n'))
+            text, frame = await self.next_text(second)
+            self.assertEqual((frame.offset, frame.data), (4, b'C\n'))
+            for subscriber in [first, second]:
+                logstream.unsubscribe(self.filename, subscriber)
+        asyncio.run(run())
+
+    def test_slow_subscriber(self):
+        async def run():
+            subscriber = logstream.Subscriber(high_water_bytes=100)
+            for i in range(100):
+                subscriber.put(1, 9 * i, 'line {:03d}\n'.format(i).encode())
+            # The oldest lines are dropped and counted, and frames are split at line breaks
+            frame = await subscriber.get_frame(max_bytes=20, max_seconds=0)
+            self.assertEqual((frame.dropped_lines, frame.dropped_bytes), (89, 801))
+            self.assertEqual((frame.offset, frame.data), (801, b'line 089\nline 090\n'))
+            frame = await subscriber.get_frame()
+            self.assertEqual(frame.data, b''.join('line {:03d}\n'.format(i).encode() for i in range(91, 100)))
+            self.assertEqual(frame.dropped_bytes, 0)
+            subscriber.close()
+            self.assertIsNone(await subscriber.get_frame())
+        asyncio.run(run())
+
+    def test_resume_and_page_back(self):
+        async def run():
+            self.write(''.join('line {:03d}\n'.format(i) for i in range(100)))
+            subscriber, backlog = await logstream.subscribe(self.filename, tail_lines=10)
+            file_id = backlog.file_id
+            logstream.unsubscribe(self.filename, subscriber)
+
+            # A client that saw up to line 50 reconnects, and gets exactly lines 50 to 99
+            subscriber, first = await logstream.subscribe(self.filename, tail_lines=10, resume_from=(file_id, 450))
+            self.assertEqual((first.offset, first.truncated, first.dropped_bytes), (450, False, 0))
+            self.assertEqual(first.data, b''.join('line {:03d}\n'.format(i).encode() for i in range(50, 100)))
+            logstream.unsubscribe(self.filename, subscriber)
+
+            # Too far behind: the gap is reported
+            logstream.RING_LINES, ring_lines = 10, logstream.RING_LINES
+            logstream.MAX_RESUME_BYTES, max_resume_bytes = 95, logstream.MAX_RESUME_BYTES
+            try:
+                subscriber, first = await logstream.subscribe(self.filename, resume_from=(file_id, 0))
+            finally:
+                logstream.RING_LINES, logstream.MAX_RESUME_BYTES = ring_lines, max_resume_bytes
+            self.assertEqual((first.offset, first.dropped_bytes), (810, 810))
+            logstream.unsubscribe(self.filename, subscriber)
+
+            # A different file starts over
+            subscriber, first = await logstream.subscribe(self.filename, tail_lines=1, resume_from=(file_id + 1, 450))
+            self.assertEqual((first.truncated, first.data), (True, b'line 099\n'))
+            logstream.unsubscribe(self.filename, subscriber)
+
+            # Pages start on a whole line
+            page = logstream.page_before(self.filename, file_id, 450, max_bytes=40)
+            self.assertEqual((page.offset, page.data), (414, b'line 046\nline 047\nline 048\nline 049\n'))
+            self.assertEqual(logstream.page_before(self.filename, file_id, 18).data, b'line 000\nline 001\n')
+            self.assertEqual(logstream.page_before(self.filename, file_id + 1, 18).data, b'')
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
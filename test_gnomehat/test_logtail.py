@@ -0,0 +1,68 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+from gnomehat import logtail
+
+
+class TestLogTail(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'stdout.txt')
+        self.block_size = logtail.BLOCK_SIZE
+        logtail.BLOCK_SIZE = 16
+
+    def tearDown(self):
+        logtail.BLOCK_SIZE = self.block_size
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, text, mode='a'):
+        with open(self.filename, mode) as fp:
+            fp.write(text)
+
+    def test_tail_matches_readlines(self):
+        self.write(''.join('line number {}\n'.format(i) for i in range(100)))
+        for n in [1, 5, 99, 100, 200]:
+            expected = open(self.filename).readlines()[-n:]
+            self.assertEqual(logtail.tail_lines(self.filename, n), expected)
+        self.assertEqual(logtail.tail_lines(os.path.join(self.tmp_dir, 'missing.txt'), 5), [])
+
+    def test_tail_follows_appends_and_truncation(self):
+        self.write('a\nb\n')
+        self.assertEqual(logtail.tail_lines(self.filename, 2), ['a\n', 'b\n'])
+        self.write('partial')
+        self.assertEqual(logtail.tail_lines(self.filename, 2), ['b\n', 'partial'])
+        self.write(' line\nc\n')
+        self.assertEqual(logtail.tail_lines(self.filename, 2), ['partial line\n', 'c\n'])
+        self.write('new\n', mode='w')
+        self.assertEqual(logtail.tail_lines(self.filename, 2), ['new\n'])
+
+    def test_read_from(self):
+        self.write('hel')
+        self.assertEqual(logtail.read_from(self.filename, 0), ('', 0))
+        self.write('lo\nwor')
+        text, offset = logtail.read_from(self.filename, 0)
+        self.assertEqual(text, 'hello\n')
+        self.write('ld\n')
+        text, offset = logtail.read_from(self.filename, offset)
+        self.assertEqual(text, 'world\n')
+        self.assertEqual(logtail.read_from(self.filename, offset), ('', offset))
+
+    def test_read_end(self):
+        self.assertIsNone(logtail.read_end(self.filename, 10))
+        self.write('short\n')
+        self.assertEqual(logtail.read_end(self.filename, 10), 'short\n')
+        self.write('a much longer line\nlast\n', mode='w')
+        self.assertEqual(logtail.read_end(self.filename, 10), 'last\n')
+
+    def test_tqdm(self):
+        self.write('epoch 1\n 45%|####     | 45/100 [00:10<00:12,  4.51it/s]\nepoch 2\n')
+        line = logtail.find_last_line(self.filename, logtail.TQDM_PATTERN)
+        self.assertEqual(logtail.parse_tqdm(line), ('45', '00:10', '00:12'))
+        self.assertIsNone(logtail.parse_tqdm('no progress bar here'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+import tempfile
+import shutil
+import json
+import os
+
+from gnomehat import scheduler
+
+
+class TestScheduler(unittest.TestCase):
+
+    def make_scheduler(self, cpus=8, memory_mb=16384, gpus=2, busy=()):
+        provider = scheduler.FakeGpuProvider(gpus, busy=busy)
+        return scheduler.SlotScheduler(range(cpus), memory_mb, provider.gpus(), provider)
+
+    def test_pack_cpu_jobs(self):
+        slots = self.make_scheduler(gpus=0)
+        # With no GPUs, the default request is a single core
+        self.assertEqual(slots.allocate('a', None), scheduler.Allocation([0], 0, []))
+        self.assertEqual(slots.allocate('b', {'cpus': 3, 'memory_mb': 8192}).cpus, [1, 2, 3])
+        self.assertEqual(slots.allocate('c', {'cpus': 2}).cpus, [4, 5])
+        # Out of memory, then out of cores
+        self.assertIsNone(slots.allocate('d', {'cpus': 1, 'memory_mb': 9000}))
+        self.assertIsNone(slots.allocate('d', {'cpus': 3}))
+        # Even a fraction of a GPU never fits on a host without any
+        self.assertFalse(slots.can_ever_fit({'gpus': 0.5}))
+        self.assertTrue(slots.can_ever_fit({'gpus': 0}))
+
+        # Freed cores are reused, contiguous ones first
+        slots.release('b')
+        self.assertEqual(slots.allocate('d', {'cpus': 2}).cpus, [1, 2])
+        self.assertEqual(slots.allocate('e', {'cpus': 2}).cpus, [6, 7])
+        self.assertEqual(slots.running(), 4)
+
+    def test_pack_gpu_jobs(self):
+        slots = self.make_scheduler(gpus=2)
+        self.assertEqual(slots.allocate('a', None).gpus, [0])
+        # Fractions share the fullest GPU that has room, leaving the other free
+        self.assertEqual(slots.allocate('b', {'gpus': 0.5}).gpus, [1])
+        self.assertEqual(slots.allocate('c', {'gpus': 0.25}).gpus, [1])
+        self.assertIsNone(slots.allocate('d', {'gpus': 0.5}))
+        self.assertEqual(slots.allocate('d', {'gpus': 0}).gpus, [])
+
+        slots.release('a')
+        self.assertIsNone(slots.allocate('e', {'gpus': 2}))
+        for job_id in ['b', 'c']:
+            slots.release(job_id)
+        self.assertEqual(slots.allocate('e', {'gpus': 2}).gpus, [0, 1])
+
+    def test_busy_gpus(self):
+        slots = self.make_scheduler(gpus=2, busy=[0])
+        slots.refresh_gpus()
+        self.assertEqual(slots.allocate('a', None).gpus, [1])
+        self.assertFalse(slots.fits(None))
+        self.assertTrue(slots.can_ever_fit({'gpus': 2}))
+        self.assertFalse(slots.can_ever_fit({'gpus': 3}))
+
+    def test_requests(self):
+        self.assertEqual(scheduler.parse_memory('8G'), 8192)
+        self.assertEqual(scheduler.parse_memory('512mb'), 512)
+        self.assertRaises(ValueError, scheduler.parse_memory, 'lots')
+        self.assertRaises(ValueError, scheduler.normalize_request, {'gpus': 1.5})
+        self.assertRaises(ValueError, scheduler.normalize_request, {'cpus': 0})
+
+        dirname = tempfile.mkdtemp()
+        try:
+            self.assertEqual(scheduler.read_resources(dirname), scheduler.DEFAULT_REQUEST)
+            scheduler.write_resources(dirname, {'cpus': 2, 'gpus': 0.5})
+            self.assertEqual(scheduler.read_resources(dirname), {'cpus': 2, 'memory_mb': 0, 'gpus': 0.5})
+            with open(os.path.join(dirname, scheduler.RESOURCES_FILENAME), 'w') as fp:
+                json.dump({'cpus': -1}, fp)
+            self.assertEqual(scheduler.read_resources(dirname), scheduler.DEFAULT_REQUEST)
+        finally:
+            shutil.rmtree(dirname)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+import tempfile
+import shutil
+import os
+import threading
+
+from gnomehat import server_config
+from gnomehat.server import app, config
+from gnomehat.server import datasource, webapi, stats, profiling
+
+
+class TestStats(unittest.TestCase):
+
+    def setUp(self):
+        self.experiments_dir = tempfile.mkdtemp()
+        config.clear()
+        config.update(server_config.get_config(self.experiments_dir))
+        os.makedirs(os.path.join(self.experiments_dir, 'default'))
+        self.client = app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.experiments_dir)
+
+    def test_histogram(self):
+        h = stats.Histogram()
+        for value in [0.0005, 0.003, 0.003, 100]:
+            h.observe(value)
+        self.assertEqual(h.count, 4)
+        self.assertEqual(h.counts[0], 1)
+        self.assertEqual(h.counts[stats.BUCKETS.index(0.005)], 2)
+        self.assertEqual(h.counts[-1], 1)
+
+    def test_stats_endpoint(self):
+        config['SLOW_REQUEST_SECONDS'] = 0
+        self.client.get('/default')
+        text = self.client.get('/_stats').data.decode('utf-8')
+        self.assertIn('gnomehat_request_seconds_bucket{le="+Inf",route="front_page_namespace"}', text)
+        self.assertIn('gnomehat_function_seconds_count{function="datasource.get_results_page"}', text)
+        self.assertIn('gnomehat_request_calls_total{call="scandir",route="front_page_namespace"}', text)
+        self.assertIn('gnomehat_render_cache_misses_total', text)
+        slow = self.client.get('/_stats/slow').json['slow_requests']
+        self.assertTrue(any(r['route'] == 'front_page_namespace' for r in slow))
+
+    def test_front_page_cached(self):
+        refreshed = []
+        refresh_index = datasource.refresh_index
+        datasource.refresh_index = lambda namespace: refreshed.append(namespace) or refresh_index(namespace)
+        try:
+            response = self.client.get('/default')
+        finally:
+            datasource.refresh_index = refresh_index
+        self.assertEqual(response.status_code, 200)
+        # Rendering uses the index the fingerprint just refreshed
+        self.assertEqual(refreshed, ['default'])
+        self.assertNotIn('Last-Modified', response.headers)
+        response = self.client.get('/default', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_pool_threads_counted(self):
+        stats.begin_request()
+        context = stats.request_context()
+        thread = threading.Thread(target=stats.run_as_part_of, args=(context, os.listdir, self.experiments_dir))
+        thread.start()
+        thread.join()
+        self.assertEqual(stats.current.calls['listdir'], 1)
+        stats.end_request('test', 200)
+        self.assertIsNone(stats.request_context())
+
+    def test_profile_request(self):
+        response = self.client.get('/default?_profile=both')
+        name = response.headers['X-Gnomehat-Profile']
+        self.assertEqual(sorted(os.listdir(profiling.profiles_dir())), [name + '.collapsed', name + '.prof'])
+        profiles = profiling.recent_profiles()
+        self.assertEqual(len(profiles), 2)
+        self.assertTrue(all(p['top'] or p['kind'] == 'sample' for p in profiles))
+        self.assertEqual(self.client.get('/_profiles').status_code, 200)
+
+        # Only admins may profile
+        response = self.client.get('/default?_profile=1', environ_base={'REMOTE_ADDR': '10.1.2.3'})
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get('/_profiles', headers={'X-Forwarded-For': '10.1.2.3'})
+        self.assertEqual(response.status_code, 403)
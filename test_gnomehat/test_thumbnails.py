@@ -0,0 +1,87 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+from PIL import Image
+
+from gnomehat import server_config
+from gnomehat.server import app, config
+from gnomehat.server import thumbnails, webapi
+
+
+class TestThumbnails(unittest.TestCase):
+
+    def setUp(self):
+        self.experiments_dir = tempfile.mkdtemp()
+        config.clear()
+        config.update(server_config.get_config(self.experiments_dir))
+        config['THUMBNAIL_WORKERS'] = 1
+        thumbnails.cache_bytes = None
+        self.experiment_dir = os.path.join(self.experiments_dir, 'default', 'foo')
+        os.makedirs(self.experiment_dir)
+        self.image_path = os.path.join(self.experiment_dir, 'sample_000001.png')
+        Image.new('RGB', (1024, 768), (200, 30, 30)).save(self.image_path)
+
+    def tearDown(self):
+        if thumbnails.pool is not None:
+            thumbnails.pool.shutdown()
+            thumbnails.pool = None
+        config['THUMBNAIL_CACHE_MB'] = 1024
+        shutil.rmtree(self.experiments_dir)
+
+    def test_generate(self):
+        filename = thumbnails.get_thumbnail(self.image_path, 128)
+        self.assertTrue(filename.startswith(thumbnails.cache_dir()))
+        with Image.open(filename) as img:
+            self.assertEqual(img.format, 'JPEG')
+            self.assertEqual(img.size, (128, 96))
+
+        # A thumbnail evicted by another request is made again
+        os.remove(filename)
+        self.assertEqual(thumbnails.get_thumbnail(self.image_path, 128), filename)
+        self.assertTrue(os.path.exists(filename))
+
+    def test_cache_key(self):
+        small = thumbnails.get_thumbnail(self.image_path, 128)
+        self.assertEqual(thumbnails.get_thumbnail(self.image_path, 128), small)
+        self.assertNotEqual(thumbnails.get_thumbnail(self.image_path, 256), small)
+
+        # Rewriting the image, with a new mtime and size, gets a fresh thumbnail
+        Image.new('RGB', (512, 512), (30, 200, 30)).save(self.image_path)
+        os.utime(self.image_path, (1, 1))
+        rewritten = thumbnails.get_thumbnail(self.image_path, 128)
+        self.assertNotEqual(rewritten, small)
+        with Image.open(rewritten) as img:
+            self.assertEqual(img.size, (128, 128))
+
+    def test_least_recently_used_evicted(self):
+        os.makedirs(thumbnails.cache_dir())
+        paths = []
+        for i in range(3):
+            path = os.path.join(thumbnails.cache_dir(), 'thumb{}.jpeg'.format(i))
+            with open(path, 'wb') as fp:
+                fp.write(b'x' * 1000)
+            os.utime(path, (i + 1, i + 1))
+            paths.append(path)
+        # Using the oldest makes it the most recently used
+        os.utime(paths[0])
+
+        # A budget of 2500 bytes is cut to 2250, which leaves room for two
+        config['THUMBNAIL_CACHE_MB'] = 2500 / (1024 * 1024)
+        thumbnails.evict()
+        self.assertEqual([os.path.exists(path) for path in paths], [True, False, True])
+        self.assertEqual(thumbnails.cache_bytes, 2000)
+
+    def test_gallery_uses_thumbnails(self):
+        response = app.test_client().get('/experiment/default/foo')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'sample_000001.png?thumb=', response.data)
+
+    def test_bad_size_serves_original(self):
+        with open(self.image_path, 'rb') as fp:
+            original = fp.read()
+        response = app.test_client().get('/experiments/default/foo/sample_000001.png?thumb=huge')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, original)
+        self.assertIsNone(thumbnails.pool)
@@ -0,0 +1,56 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+import numpy as np
+
+from gnomehat import timeseries
+from gnomehat.server import downsample
+
+
+class TestTimeSeries(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_write_and_read(self):
+        writer = timeseries.Writer(self.tmp_dir)
+        for step in range(100):
+            writer.log(step, loss=1.0 / (step + 1), accuracy=step / 100.)
+        writer.close()
+        series, offset = timeseries.read_series(self.tmp_dir)
+        self.assertEqual(sorted(series), ['accuracy', 'loss'])
+        steps, times, values = series['loss']
+        self.assertEqual(steps.tolist(), list(range(100)))
+        self.assertAlmostEqual(values[9], 0.1)
+
+        # Reopening appends, reusing the existing key ids
+        writer = timeseries.Writer(self.tmp_dir)
+        writer.log(100, loss=0.0, lr=0.1)
+        writer.close()
+        series, new_offset = timeseries.read_series(self.tmp_dir, offset)
+        self.assertEqual(series['loss'][0].tolist(), [100])
+        self.assertEqual(series['lr'][2].tolist(), [0.1])
+        self.assertNotIn('accuracy', series)
+
+        # A half-written record at the end is ignored
+        with open(os.path.join(self.tmp_dir, timeseries.DATA_FILENAME), 'ab') as fp:
+            fp.write(b'\x00\x00\x01')
+        series, offset = timeseries.read_series(self.tmp_dir, new_offset)
+        self.assertEqual((series, offset), ({}, new_offset))
+
+    def test_downsample(self):
+        x = np.arange(10000)
+        y = np.sin(x / 100.)
+        y[5000] = 10
+        for method in downsample.METHODS.values():
+            indices = method(x, y, 200)
+            self.assertLessEqual(len(indices), 200)
+            self.assertTrue(np.all(np.diff(indices) > 0))
+            # The spike survives downsampling
+            self.assertIn(5000, indices)
+        self.assertEqual(len(downsample.lttb(x[:50], y[:50], 200)), 50)